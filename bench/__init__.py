@@ -0,0 +1 @@
+"""Офлайн-бенчмарк бота: заглушка OpenRouter, воспроизводимые ленты каналов и раннер."""
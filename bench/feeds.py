@@ -0,0 +1,283 @@
+"""Ленты постов для бенчмарка: формат трассы, генератор, запись с реальных каналов
+и фейковые источники событий Pyrogram / Bot API, которые их воспроизводят.
+
+Трасса — JSONL, одна запись на событие:
+    {"t": 1.25, "chat_id": -1001, "username": "news1", "title": "News 1",
+     "message_id": 42, "text": "...", "media": "photo" | "video" | null, "edit": false}
+t — секунды от начала трассы; при воспроизведении делится на speed.
+
+    python -m bench.feeds generate --posts 500 --rate 10 --out trace.jsonl
+    python -m bench.feeds record --channel @news --limit 300 --out trace.jsonl
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# Метка поста в тексте: заглушка OpenRouter повторяет текст, и раннер по метке
+# сопоставляет отправленное сообщение с моментом поступления поста
+MARKER_RE = re.compile(r"\(сюжет (\d+)\)")
+
+_WORDS = (
+    "правительство заявило новый закон рынок нефть рубль доллар выборы министр регион "
+    "компания банк ставка инфляция суд решение президент встреча переговоры санкции "
+    "экспорт импорт бюджет налог зарплата пенсия школа больница дорога мост погода "
+    "снегопад авария пожар полиция расследование эксперт аналитик прогноз рост снижение "
+    "цена тариф электричество газ вода транспорт метро аэропорт рейс туризм спорт матч"
+).split()
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r["t"])
+
+
+def save_trace(records: List[Dict[str, Any]], path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 14))]
+    return " ".join(words).capitalize() + "."
+
+
+def generate_trace(posts: int, rate: float, channels: int, dup_rate: float = 0.1, media_only_rate: float = 0.05,
+                   edit_rate: float = 0.0, seed: int = 1, album_rate: float = 0.0) -> List[Dict[str, Any]]:
+    """Синтетическая лента: пуассоновский поток постов по channels каналам.
+
+    dup_rate — доля перепостов уже вышедшей новости в другом канале (почти-дубликаты),
+    media_only_rate — доля постов без текста, edit_rate — доля правок уже вышедших постов,
+    album_rate — доля альбомов: 2–4 сообщения с общим media_group_id, подпись у первого.
+    """
+    rng = random.Random(seed)
+    t = 0.0
+    next_id = {i: 1 for i in range(channels)}
+    bodies: List[str] = []
+    published: List[Dict[str, Any]] = []
+    records: List[Dict[str, Any]] = []
+    for n in range(posts):
+        t += rng.expovariate(rate)
+        ch = rng.randrange(channels)
+        chat = {"chat_id": -1000000000000 - ch, "username": f"bench_news{ch}", "title": f"Bench News {ch}"}
+        if published and rng.random() < edit_rate:
+            edit = dict(rng.choice(published), t=round(t, 3), edit=True)
+            edit["text"] = edit["text"] + " " + _sentence(rng)
+            records.append(edit)
+            continue
+        if bodies and rng.random() < dup_rate:
+            body = rng.choice(bodies)
+        else:
+            body = " ".join(_sentence(rng) for _ in range(rng.randint(2, 6)))
+            bodies.append(body)
+        media = rng.choice(["photo", "video", None, None])
+        text = "" if rng.random() < media_only_rate else f"(сюжет {n}) {body} @bench_news{ch}"
+        record = {"t": round(t, 3), **chat, "message_id": next_id[ch], "text": text,
+                  "media": media if not text else (media if rng.random() < 0.3 else None), "edit": False}
+        next_id[ch] += 1
+        records.append(record)
+        if text:
+            published.append(record)
+        if text and rng.random() < album_rate:
+            record["media"] = "photo"
+            record["media_group_id"] = f"album-{n}"
+            for i in range(rng.randint(1, 3)):
+                records.append(dict(record, t=round(t + 0.05 * (i + 1), 3), message_id=next_id[ch], text="",
+                                    media=rng.choice(["photo", "video"])))
+                next_id[ch] += 1
+    return records
+
+
+async def record_trace(channel: str, limit: int) -> List[Dict[str, Any]]:
+    """Снимает историю реального канала через Pyrogram (сессия и ключи — из .env бота)."""
+    from dotenv import load_dotenv
+    from pyrogram import Client
+
+    load_dotenv()
+    client = Client(name=os.getenv("PYROGRAM_SESSION", "pyrogram"), api_id=int(os.environ["TELEGRAM_API_ID"]),
+                    api_hash=os.environ["TELEGRAM_API_HASH"])
+    messages = []
+    async with client:
+        async for msg in client.get_chat_history(channel, limit=limit):
+            messages.append(msg)
+    messages.reverse()
+    if not messages:
+        return []
+    start = messages[0].date.timestamp()
+    records = []
+    for msg in messages:
+        media = "photo" if msg.photo else "video" if (msg.video or msg.animation) else None
+        records.append({
+            "t": round(msg.date.timestamp() - start, 3), "chat_id": msg.chat.id,
+            "username": msg.chat.username or channel.lstrip("@"), "title": msg.chat.title,
+            "message_id": msg.id, "text": msg.text or msg.caption or "", "media": media, "edit": False,
+        })
+    return records
+
+
+def pyrogram_message(record: Dict[str, Any], date: Optional[datetime] = None) -> SimpleNamespace:
+    """Объект с теми полями pyrogram.types.Message, которые читает бот."""
+    text = record.get("text") or None
+    media = record.get("media")
+    return SimpleNamespace(
+        id=record["message_id"],
+        chat=SimpleNamespace(id=record["chat_id"], title=record.get("title"), username=record.get("username")),
+        text=text if not media else None,
+        caption=text if media else None,
+        date=date or datetime.now(timezone.utc),
+        edit_date=datetime.now(timezone.utc) if record.get("edit") else None,
+        photo=SimpleNamespace(file_id=f"photo-{record['message_id']}") if media == "photo" else None,
+        video=SimpleNamespace(file_id=f"video-{record['message_id']}") if media == "video" else None,
+        animation=None,
+        media_group_id=record.get("media_group_id"),
+    )
+
+
+def bot_api_update(record: Dict[str, Any], date: Optional[datetime] = None) -> SimpleNamespace:
+    """Объект с теми полями telegram.Update(channel_post=...), которые читает бот."""
+    text = record.get("text") or None
+    media = record.get("media")
+    msg = SimpleNamespace(
+        chat_id=record["chat_id"],
+        message_id=record["message_id"],
+        chat=SimpleNamespace(id=record["chat_id"], title=record.get("title"), username=record.get("username")),
+        text=text if not media else None,
+        caption=text if media else None,
+        date=date or datetime.now(timezone.utc),
+        photo=[SimpleNamespace(file_id=f"photo-{record['message_id']}")] if media == "photo" else [],
+        video=SimpleNamespace(file_id=f"video-{record['message_id']}") if media == "video" else None,
+        animation=None,
+        media_group_id=record.get("media_group_id"),
+    )
+    if record.get("edit"):
+        return SimpleNamespace(effective_message=msg, channel_post=None, edited_channel_post=msg)
+    return SimpleNamespace(effective_message=msg, channel_post=msg, edited_channel_post=None)
+
+
+class FakePyroClient:
+    """Подменяет pyrogram.Client в бенчмарке: каналы из трассы, обработчики вызываются напрямую.
+
+    publish() кладёт пост в историю канала и, если push не «потерян» (push_loss),
+    вызывает зарегистрированный ботом on_message — как это сделал бы Pyrogram.
+    Потерянные посты бот подбирает fallback-опросом через get_chat_history.
+    """
+
+    def __init__(self, channels: Dict[str, Dict[str, Any]], push_loss: float = 0.0, seed: int = 1, **_: Any) -> None:
+        self.channels = channels
+        self.push_loss = push_loss
+        self._rng = random.Random(seed)
+        self._history: Dict[int, List[SimpleNamespace]] = {}
+        self._on_message: List[Callable[..., Awaitable[None]]] = []
+        self._on_edited: List[Callable[..., Awaitable[None]]] = []
+        self.history_calls = 0
+        self.downloads = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def join_chat(self, username: str) -> None:
+        pass
+
+    async def get_chat(self, username: Any) -> SimpleNamespace:
+        info = self.channels.get(str(username).lstrip("@"))
+        if info is None:
+            raise ValueError(f"unknown channel {username}")
+        return SimpleNamespace(id=info["chat_id"], title=info.get("title"), username=info.get("username"))
+
+    def on_message(self, *_: Any, **__: Any) -> Callable:
+        def register(fn: Callable[..., Awaitable[None]]) -> Callable[..., Awaitable[None]]:
+            self._on_message.append(fn)
+            return fn
+        return register
+
+    def on_edited_message(self, *_: Any, **__: Any) -> Callable:
+        def register(fn: Callable[..., Awaitable[None]]) -> Callable[..., Awaitable[None]]:
+            self._on_edited.append(fn)
+            return fn
+        return register
+
+    async def get_chat_history(self, chat_id: int, limit: int = 0, **_: Any) -> AsyncIterator[SimpleNamespace]:
+        self.history_calls += 1
+        for msg in list(reversed(self._history.get(chat_id, [])))[:limit or None]:
+            yield msg
+
+    async def download_media(self, file_id: str, in_memory: bool = False, **_: Any) -> io.BytesIO:
+        self.downloads += 1
+        return io.BytesIO(file_id.encode("utf-8") * 1024)
+
+    async def publish(self, record: Dict[str, Any]) -> None:
+        msg = pyrogram_message(record)
+        if record.get("edit"):
+            for fn in self._on_edited:
+                await fn(self, msg)
+            return
+        self._history.setdefault(record["chat_id"], []).append(msg)
+        if self._rng.random() < self.push_loss:
+            return
+        for fn in self._on_message:
+            await fn(self, msg)
+
+
+async def replay(records: List[Dict[str, Any]], emit: Callable[[Dict[str, Any]], Awaitable[None]],
+                 speed: float = 1.0, on_arrival: Optional[Callable[[Dict[str, Any], float], None]] = None) -> None:
+    """Воспроизводит трассу в реальном времени (t / speed), каждый пост — отдельной задачей,
+    чтобы торможение обработчиков (backpressure) не сдвигало расписание поступления."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    for record in records:
+        delay = start + record["t"] / speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if on_arrival is not None:
+            on_arrival(record, loop.time())
+        tasks.append(asyncio.create_task(emit(record)))
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate or record channel post traces")
+    sub = parser.add_subparsers(dest="command", required=True)
+    gen = sub.add_parser("generate", help="synthetic trace")
+    gen.add_argument("--posts", type=int, default=300)
+    gen.add_argument("--rate", type=float, default=10.0, help="posts per second")
+    gen.add_argument("--channels", type=int, default=10)
+    gen.add_argument("--dup-rate", type=float, default=0.1)
+    gen.add_argument("--media-only-rate", type=float, default=0.05)
+    gen.add_argument("--edit-rate", type=float, default=0.0)
+    gen.add_argument("--album-rate", type=float, default=0.0)
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--out", default="-")
+    rec = sub.add_parser("record", help="dump a real channel history via Pyrogram")
+    rec.add_argument("--channel", required=True)
+    rec.add_argument("--limit", type=int, default=300)
+    rec.add_argument("--out", default="-")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        records = generate_trace(args.posts, args.rate, args.channels, args.dup_rate, args.media_only_rate,
+                                 args.edit_rate, args.seed, args.album_rate)
+    else:
+        records = asyncio.run(record_trace(args.channel, args.limit))
+    if args.out == "-":
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    else:
+        save_trace(records, args.out)
+        print(f"{len(records)} records -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Локальная заглушка OpenRouter /api/v1/chat/completions.
+
+Отвечает «пересказом», который повторяет исходный текст (так раннер узнаёт пост
+в отправленном сообщении), с настраиваемой задержкой, долей ответов 429 и
+поддержкой stream: true (SSE). Батч-запросы бота получают JSON-массив.
+
+Запуск отдельно:  python -m bench.mock_openrouter --port 8089 --latency 0.8 --rate-429 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Dict, List, Optional
+
+_BATCH_ITEM_RE = re.compile(r"Новость (\d+):\n(.*?)(?=\n\nНовость \d+:|\n\nДополнительные указания стиля:|\Z)", re.S)
+_USER_TEXT_RE = re.compile(r"Текст для переформулирования:\n(.*?)(?=\n\nДополнительные указания стиля:|\Z)", re.S)
+
+
+class MockOpenRouter:
+    """HTTP/1.1-сервер на asyncio с keep-alive; статистика запросов — в self.stats."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.3, rate_429: float = 0.0,
+                 retry_after: float = 1.0, chunk_delay: float = 0.02, seed: Optional[int] = None) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.chunk_delay = chunk_delay
+        self.stats: Dict[str, int] = {"requests": 0, "ok": 0, "rate_limited": 0, "streams": 0, "batches": 0}
+        self._rng = random.Random(seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> int:
+        assert self._server is not None
+        return self._server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/v1/chat/completions"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _delay(self) -> float:
+        # Логнормальный хвост: большинство ответов около latency, редкие — в разы дольше
+        return max(0.0, self.latency * self._rng.lognormvariate(0.0, self.jitter)) if self.jitter else self.latency
+
+    @staticmethod
+    def answer(body: Dict) -> str:
+        user = next((m["content"] for m in reversed(body.get("messages", [])) if m.get("role") == "user"), "")
+        if user.startswith("Переформулируй каждую из"):
+            items = [text.strip() for _, text in _BATCH_ITEM_RE.findall(user)]
+            return json.dumps([f"Пересказ: {text}" for text in items], ensure_ascii=False)
+        m = _USER_TEXT_RE.search(user)
+        return f"Пересказ: {(m.group(1) if m else user).strip()}"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers: Dict[str, str] = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                raw = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+                if not await self._respond(writer, request_line.decode("latin-1"), raw):
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, request_line: str, raw: bytes) -> bool:
+        """Пишет ответ; False — соединение надо закрыть (после потокового ответа)."""
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != "POST" or not parts[1].endswith("/chat/completions"):
+            self._write(writer, "404 Not Found", b'{"error": "not found"}')
+            return True
+        self.stats["requests"] += 1
+        body = json.loads(raw or b"{}")
+        if self._rng.random() < self.rate_429:
+            self.stats["rate_limited"] += 1
+            await asyncio.sleep(0.01)
+            self._write(writer, "429 Too Many Requests", b'{"error": {"code": 429, "message": "rate limited"}}',
+                        {"Retry-After": f"{self.retry_after:g}"})
+            return True
+        content = self.answer(body)
+        if content.startswith("["):
+            self.stats["batches"] += 1
+        usage = {"prompt_tokens": sum(len(m.get("content", "")) for m in body.get("messages", [])) // 3,
+                 "completion_tokens": len(content) // 3}
+        await asyncio.sleep(self._delay())
+        if body.get("stream"):
+            self.stats["streams"] += 1
+            await self._stream(writer, body.get("model", "mock"), content, usage)
+            self.stats["ok"] += 1
+            return False
+        payload = {"id": f"mock-{self.stats['requests']}", "model": body.get("model", "mock"),
+                   "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}], "usage": usage}
+        self._write(writer, "200 OK", json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        await writer.drain()
+        self.stats["ok"] += 1
+        return True
+
+    async def _stream(self, writer: asyncio.StreamWriter, model: str, content: str, usage: Dict) -> None:
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        writer.write(b": OPENROUTER PROCESSING\n\n")
+        words: List[str] = content.split(" ")
+        for i in range(0, len(words), 3):
+            piece = " ".join(words[i:i + 3]) + (" " if i + 3 < len(words) else "")
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": piece}}]}
+            writer.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await writer.drain()
+            await asyncio.sleep(self.chunk_delay)
+        writer.write(f"data: {json.dumps({'model': model, 'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    @staticmethod
+    def _write(writer: asyncio.StreamWriter, status: str, body: bytes, extra: Optional[Dict[str, str]] = None) -> None:
+        head = [f"HTTP/1.1 {status}", "Content-Type: application/json", f"Content-Length: {len(body)}"]
+        head.extend(f"{k}: {v}" for k, v in (extra or {}).items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    server = MockOpenRouter(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                            retry_after=args.retry_after, chunk_delay=args.chunk_delay, seed=args.seed)
+    await server.start(args.host, args.port)
+    print(f"[Mock] OpenRouter stub on {server.url}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"[Mock] {time.strftime('%H:%M:%S')} {server.stats}")
+    finally:
+        await server.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="OpenRouter stub for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="median response latency, s")
+    parser.add_argument("--jitter", type=float, default=0.3, help="lognormal sigma of latency (0 = fixed)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After for 429, s")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="pause between SSE chunks, s")
+    parser.add_argument("--seed", type=int, default=None)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Бенчмарк очистки текста: прежний clean_text (два re.sub) против TextNormalizer.
+
+Корпус — тексты из трасс (--trace, можно несколько) или синтетические посты с
+типичным «шумом» каналов: ссылки t.me, эмодзи, блоки хэштегов, рекламный хвост.
+
+    python -m bench.normalize --posts 50000
+    python -m bench.normalize --trace trace.jsonl --repeat 20 --rules rules.json
+"""
+import argparse
+import os
+import random
+import re
+import time
+from typing import Callable, List
+
+from bench.feeds import _sentence, load_trace
+
+_FOOTERS = [
+    "\n\n👉 Подписаться на канал | Прислать новость\nhttps://t.me/bench_news",
+    "\n\n#новости #экономика #россия",
+    "\n\n⚡️ Читать нас в Telegram: t.me/bench_news",
+    "\n\n@bench_news",
+    "",
+]
+
+
+def synthetic_corpus(posts: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(posts):
+        body = " ".join(_sentence(rng) for _ in range(rng.randint(2, 12)))
+        prefix = rng.choice(["", "⚡️", "❗️Срочно: ", "🔥 "])
+        corpus.append(prefix + body + rng.choice(_FOOTERS) + rng.choice(_FOOTERS))
+    return corpus
+
+
+def legacy_clean_text(text: str) -> str:
+    text = re.sub(r'@\w+', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def measure(name: str, fn: Callable[[str], str], corpus: List[str], repeat: int) -> List[str]:
+    out: List[str] = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        out = [fn(text) for text in corpus]
+    elapsed = time.perf_counter() - started
+    total = len(corpus) * repeat
+    size = sum(len(t.encode("utf-8")) for t in corpus) * repeat
+    print(f"{name:<12} {total / elapsed:>12,.0f} posts/s {size / elapsed / 1e6:>8.1f} MB/s "
+          f"{elapsed / total * 1e6:>8.1f} µs/post")
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark text normalization")
+    parser.add_argument("--trace", action="append", help="JSONL trace(s) to take post texts from")
+    parser.add_argument("--posts", type=int, default=20000, help="synthetic posts when no --trace is given")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--rules", help="NORMALIZE_RULES_FILE to benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.rules:
+        os.environ["NORMALIZE_RULES_FILE"] = args.rules
+    import bot
+
+    if args.trace:
+        corpus = [r["text"] for path in args.trace for r in load_trace(path) if r.get("text")]
+    else:
+        corpus = synthetic_corpus(args.posts, args.seed)
+    bot.load_normalizers()
+    normalizer = bot.get_normalizer()
+
+    legacy = measure("legacy", legacy_clean_text, corpus, args.repeat)
+    current = measure("normalizer", normalizer.normalize, corpus, args.repeat)
+
+    chars_in = sum(len(t) for t in corpus)
+    tokens_in = sum(bot.estimate_tokens(t) for t in corpus)
+    for name, result in (("legacy", legacy), ("normalizer", current)):
+        chars = sum(len(t) for t in result)
+        tokens = sum(bot.estimate_tokens(t) for t in result)
+        print(f"{name:<12} chars {chars_in:,} -> {chars:,} ({1 - chars / chars_in:.1%} saved), "
+              f"~tokens {tokens_in:,} -> {tokens:,} ({1 - tokens / tokens_in:.1%} saved)")
+    by_rule = {k: v // args.repeat for k, v in sorted(normalizer.saved_chars.items(), key=lambda kv: -kv[1])}
+    print(f"saved chars by rule (per pass): {by_rule}")
+
+
+if __name__ == "__main__":
+    main()
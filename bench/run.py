@@ -0,0 +1,358 @@
+"""Раннер бенчмарка: гоняет настоящие обработчики бота на заглушках и считает
+пропускную способность, задержки и отбросы.
+
+Режимы (--mode):
+  pyrogram   — посты идут в on_new_message/on_edited_message через FakePyroClient
+               (вместе с fallback-опросом и догоном пропущенного при --push-loss);
+  channel    — посты идут в on_channel_post как апдейты Bot API;
+  paraphrase — прямые вызовы paraphrase() (только LLM-путь, без конвейера);
+  stream     — прямые вызовы paraphrase_stream().
+
+Задержка поста — от момента поступления по расписанию трассы до вызова
+send_message фейкового бота (или до ответа paraphrase в режимах paraphrase/stream).
+
+    python -m bench.run --posts 300 --rate 20 --latency 0.8 --rate-429 0.05
+    python -m bench.run --trace trace.jsonl --speed 10 --baseline bench/baseline.json
+    python -m bench.run --save-baseline bench/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set
+
+from bench.feeds import MARKER_RE, FakePyroClient, bot_api_update, generate_trace, load_trace, replay
+from bench.mock_openrouter import MockOpenRouter
+
+
+class FakeBot:
+    """Минимальный telegram.Bot: фиксирует время каждой отправки."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.sent: List[Dict[str, Any]] = []
+        self._next_id = 1
+
+    async def _call(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id: int, text: str, **_: Any) -> SimpleNamespace:
+        await self._call()
+        self._next_id += 1
+        self.sent.append({"chat_id": chat_id, "text": text, "at": asyncio.get_running_loop().time()})
+        return SimpleNamespace(message_id=self._next_id, chat_id=chat_id, text=text)
+
+    async def send_media_group(self, chat_id: int, media: List[Any], **_: Any) -> List[SimpleNamespace]:
+        await self._call()
+        caption = next((m.caption for m in media if m.caption), None)
+        self.sent.append({"chat_id": chat_id, "text": caption or "", "at": asyncio.get_running_loop().time(),
+                          "album": len(media)})
+        messages = []
+        for m in media:
+            self._next_id += 1
+            file = SimpleNamespace(file_id=f"bot-{self._next_id}")
+            messages.append(SimpleNamespace(message_id=self._next_id, chat_id=chat_id, caption=m.caption,
+                                            photo=[file] if m.type == "photo" else [],
+                                            video=file if m.type == "video" else None))
+        return messages
+
+    async def edit_message_text(self, text: str, chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                                **_: Any) -> SimpleNamespace:
+        await self._call()
+        self.sent.append({"chat_id": chat_id, "text": text, "at": asyncio.get_running_loop().time(), "edit": True})
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    async def edit_message_caption(self, chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                                   caption: Optional[str] = None, **_: Any) -> SimpleNamespace:
+        await self._call()
+        self.sent.append({"chat_id": chat_id, "text": caption or "", "at": asyncio.get_running_loop().time(),
+                          "edit": True})
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, caption=caption)
+
+    async def send_chat_action(self, **_: Any) -> bool:
+        return True
+
+
+class FakeApplication:
+    """То, что бот берёт у telegram.ext.Application: bot и bot_data."""
+
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+        self.bot_data: Dict[str, Any] = {}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+
+def ensure_markers(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Записанные с реальных каналов посты получают метку, по которой их узнаёт раннер."""
+    out = []
+    for i, record in enumerate(records):
+        text = record.get("text") or ""
+        if text and not MARKER_RE.search(text):
+            record = dict(record, text=f"(сюжет {100000 + i}) {text}")
+        out.append(record)
+    return out
+
+
+def configure_env(args: argparse.Namespace, mock: MockOpenRouter, records: List[Dict[str, Any]], workdir: str) -> None:
+    channels = sorted({r["username"] for r in records})
+    # Всё, что указывает на заглушки, задаётся жёстко; настройки производительности
+    # можно переопределить переменными окружения, как у самого бота
+    os.environ.update({
+        "NEWSBOT_DB": os.path.join(workdir, "bench.db"),
+        "STATE_FILE": os.path.join(workdir, "chat_state.json"),
+        "OPENROUTER_API_KEY": "bench",
+        "OPENROUTER_URLS": mock.url,
+        "DEST_USER_ID": "1",
+        "TARGET_CHAT_ID": "",
+        "TELEGRAM_API_ID": "1",
+        "TELEGRAM_API_HASH": "bench",
+        "WATCH_CHANNELS": ",".join(channels),
+        "METRICS_PORT": "0",
+        "METRICS_LOG_INTERVAL": "0",
+        "STREAM_INTERACTIVE": "0",
+    })
+    os.environ.setdefault("OPENROUTER_MODELS", "bench/model-a,bench/model-b")
+    os.environ.setdefault("SEND_RATE_PRIVATE", str(args.send_rate))
+    os.environ.setdefault("PARAPHRASE_CACHE_SIZE", "0" if args.no_cache else "5000")
+    os.environ.setdefault("PIPELINE_STATS_INTERVAL", "3600")
+    # Fallback-опрос должен успеть подобрать «потерянные» push-и за время прогона
+    os.environ.setdefault("POLL_MIN_INTERVAL", "1")
+    os.environ.setdefault("POLL_MAX_INTERVAL", "3")
+
+
+async def wait_drained(bot_module: Any, app: FakeApplication, fake_bot: FakeBot, timeout: float, idle: float) -> None:
+    """Ждёт, пока конвейер и очередь отправки опустеют и ничего не отправляется idle секунд."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    last_count, last_change = -1, loop.time()
+    while loop.time() < deadline:
+        await asyncio.sleep(0.1)
+        pipeline = app.bot_data.get("pipeline")
+        sender = app.bot_data.get("outbound_sender")
+        busy = (pipeline is not None and any(pipeline.depths().values())) or (sender is not None and sender.pending())
+        if len(fake_bot.sent) != last_count:
+            last_count, last_change = len(fake_bot.sent), loop.time()
+            continue
+        if not busy and loop.time() - last_change >= idle:
+            return
+    print(f"[Bench] drain timeout after {timeout:.0f}s", file=sys.stderr)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.trace:
+        records = load_trace(args.trace)
+    else:
+        records = generate_trace(args.posts, args.rate, args.channels, args.dup_rate, args.media_only_rate,
+                                 args.edit_rate, args.seed, args.album_rate)
+    records = ensure_markers(records)
+
+    mock = MockOpenRouter(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                          retry_after=args.retry_after, chunk_delay=args.chunk_delay, seed=args.seed)
+    await mock.start()
+    workdir = tempfile.mkdtemp(prefix="newsbot-bench-")
+    configure_env(args, mock, records, workdir)
+
+    import bot  # после configure_env: синглтоны бота читают окружение при первом обращении
+
+    fake_bot = FakeBot(args.send_latency)
+    app = FakeApplication(fake_bot)
+    loop = asyncio.get_running_loop()
+    arrivals: Dict[int, float] = {}
+    finished: Dict[int, float] = {}
+
+    def on_arrival(record: Dict[str, Any], at: float) -> None:
+        m = MARKER_RE.search(record.get("text") or "")
+        if m and not record.get("edit"):
+            arrivals.setdefault(int(m.group(1)), at)
+
+    # Метки постов, отброшенных или упавших в конвейере. Правки и повторный приход уже
+    # взятого поста (push и догон) — не отдельные входные посты
+    resolved: Set[int] = set()
+
+    def track(method: Any, skip: tuple) -> Any:
+        async def wrapper(self: Any, job: Any, reason: str) -> None:
+            m = MARKER_RE.search(job.text or "")
+            if m and job.claim and reason not in skip:
+                resolved.add(int(m.group(1)))
+            await method(self, job, reason)
+        return wrapper
+
+    bot.PostPipeline._drop = track(bot.PostPipeline._drop, ("processed",))
+    bot.PostPipeline._fail = track(bot.PostPipeline._fail, ())
+
+    if args.mode in ("pyrogram", "channel"):
+        bot.get_pipeline(app)
+        if args.mode == "pyrogram":
+            channels = {r["username"]: r for r in records}
+            fake_pyro = FakePyroClient(channels, push_loss=args.push_loss, seed=args.seed)
+            bot.PyroClient = lambda **kw: fake_pyro
+            await bot.start_pyrogram_monitor(app)
+            emit = fake_pyro.publish
+        else:
+            context = SimpleNamespace(application=app, bot=fake_bot)
+
+            async def emit(record: Dict[str, Any]) -> None:
+                await bot.on_channel_post(bot_api_update(record), context)
+    else:
+        async def emit(record: Dict[str, Any]) -> None:
+            text = record.get("text")
+            m = MARKER_RE.search(text or "")
+            if not text or not m:
+                return
+            try:
+                if args.mode == "stream":
+                    async def on_partial(_: str) -> None:
+                        pass
+                    await bot.paraphrase_stream(text, record.get("title"), "bench", None, None, on_partial)
+                else:
+                    await bot.paraphrase(text, record.get("title"), "bench", None, None)
+            except Exception as e:
+                print(f"[Bench] paraphrase error: {e}", file=sys.stderr)
+                return
+            finished.setdefault(int(m.group(1)), loop.time())
+
+    started = loop.time()
+    await replay(records, emit, speed=args.speed, on_arrival=on_arrival)
+    if args.mode in ("pyrogram", "channel"):
+        await wait_drained(bot, app, fake_bot, args.timeout, args.idle)
+        for item in fake_bot.sent:
+            m = MARKER_RE.search(item["text"])
+            if m:
+                finished.setdefault(int(m.group(1)), item["at"])
+    wall = loop.time() - started
+
+    latencies = [finished[k] - arrivals[k] for k in finished if k in arrivals]
+    last = max(finished.values(), default=started)
+    snapshot = bot.METRICS.snapshot()
+    dropped = {row["reason"]: int(row["value"]) for row in snapshot.get("newsbot_dropped_total", [])}
+    failed = int(sum(row["value"] for row in snapshot.get("newsbot_pipeline_failed_total", [])))
+    # Входной пост должен быть опубликован, отброшен или учтён как сбой — иначе он потерян
+    unaccounted = (len(set(arrivals) - set(finished) - resolved)
+                   if args.mode in ("pyrogram", "channel") else None)
+    report = {
+        "scenario": {k: v for k, v in vars(args).items() if k not in ("baseline", "save_baseline", "output", "timeout", "idle", "max_regression")},
+        "posts": len(records),
+        "with_text": sum(1 for r in records if r.get("text") and not r.get("edit")),
+        "published": len(finished),
+        "messages_sent": len(fake_bot.sent),
+        "dropped": dropped,
+        "failed": failed,
+        "unaccounted": unaccounted,
+        "throughput_pps": round(len(finished) / max(1e-9, last - started), 3),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p90": percentile(latencies, 0.90),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": round(max(latencies), 3) if latencies else None,
+        "llm": dict(mock.stats),
+        "wall_sec": round(wall, 3),
+    }
+
+    pipeline = app.bot_data.get("pipeline")
+    if pipeline is not None:
+        await pipeline.close()
+    sender = app.bot_data.get("outbound_sender")
+    if sender is not None:
+        await sender.close()
+    for key in ("pyrogram_fallback_task", "send_permission_task"):
+        task = app.bot_data.get(key)
+        if task is not None:
+            task.cancel()
+    await bot.close_openrouter_client()
+    await mock.close()
+    return report
+
+
+# Метрика → True, если больше — лучше
+COMPARED = {"throughput_pps": True, "latency_p50": False, "latency_p90": False, "latency_p99": False}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> bool:
+    """Печатает сравнение с базовым прогоном; False — есть регрессия больше max_regression."""
+    if report["scenario"] != baseline.get("scenario"):
+        diff = {k: (baseline.get("scenario", {}).get(k), v) for k, v in report["scenario"].items()
+                if baseline.get("scenario", {}).get(k) != v}
+        print(f"[Bench] warning: scenario differs from baseline: {diff}")
+    ok = True
+    print(f"{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for key, higher_is_better in COMPARED.items():
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            print(f"{key:<16}{str(old):>12}{str(new):>12}{'n/a':>10}")
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > max_regression else ""
+        ok = ok and not flag
+        print(f"{key:<16}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline NewsBot benchmark")
+    parser.add_argument("--mode", choices=("pyrogram", "channel", "paraphrase", "stream"), default="pyrogram")
+    parser.add_argument("--trace", help="JSONL trace to replay (default: generate one)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier for trace timestamps")
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20.0, help="generated posts per second")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--dup-rate", type=float, default=0.1)
+    parser.add_argument("--media-only-rate", type=float, default=0.05)
+    parser.add_argument("--edit-rate", type=float, default=0.0)
+    parser.add_argument("--album-rate", type=float, default=0.0, help="share of posts published as albums")
+    parser.add_argument("--push-loss", type=float, default=0.0, help="share of posts only visible to fallback polling")
+    parser.add_argument("--latency", type=float, default=0.5, help="median mock LLM latency, s")
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--send-latency", type=float, default=0.02, help="fake Bot API call latency, s")
+    parser.add_argument("--send-rate", type=float, default=1000.0,
+                        help="SEND_RATE_PRIVATE for the run (Telegram's 1/s would cap throughput at 1 post/s)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the paraphrase cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300.0, help="max wait for the pipeline to drain, s")
+    parser.add_argument("--idle", type=float, default=4.0, help="drain when nothing was sent for this long, s")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare with a saved report")
+    parser.add_argument("--max-regression", type=float, default=0.15)
+    parser.add_argument("--save-baseline", help="save this report as the new baseline")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    print(f"[Bench] done in {time.time() - t0:.1f}s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    ok = True
+    if report["unaccounted"]:
+        print(f"[Bench] {report['unaccounted']} posts neither published, dropped nor failed "
+              f"(published {report['published']}, dropped {sum(report['dropped'].values())}, "
+              f"failed {report['failed']})", file=sys.stderr)
+        ok = False
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        ok = compare(report, baseline, args.max_regression) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,45 @@
 import os
+import sys
+import abc
+import signal
+import bisect
+import heapq
 import asyncio
-from typing import Optional, Set, List, Dict
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, Set, List, Dict, Tuple
 import time
 import re
+import math
+import json
+import hashlib
+import sqlite3
+import random
+import zlib
+import uuid
+import difflib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 
-import requests
+import httpx
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import InputMediaPhoto, InputMediaVideo, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 from pathlib import Path
+from dataclasses import dataclass, field, asdict, fields
 from pyrogram import Client as PyroClient, filters as pyro_filters
 
+try:
+    import h2  # noqa: F401  (HTTP/2 для httpx)
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 OPENROUTER_MODEL = "openai/gpt-3.5-turbo-16k"
+# Параметры сэмплирования входят в ключ кеша пересказов
+OPENROUTER_SAMPLING = {"temperature": 0.3, "max_tokens": 400, "seed": 7}
 SYSTEM_PROMPT = (
     "Ты — редактор новостного экономического телеграм-канала. Пиши краткие и интересные новости для аудитории мужчин 20-35 лет."
     "1.Стиль: разговорный с элементами официального. Простой и плавный текст. Начинай с самых важных моментов (до 10 слов)."
@@ -42,14 +68,235 @@ SYSTEM_PROMPT = (
 )
 
 
-def clean_text(text: str) -> str:
-    """Удаляет теги Telegram-каналов и другие служебные символы из текста"""
-    # Удаляем теги каналов (@username)
-    text = re.sub(r'@\w+', '', text)
-    # Удаляем лишние пробелы
-    text = re.sub(r'\s+', ' ', text)
-    # Удаляем пробелы в начале и конце
-    return text.strip()
+# Правила очистки по умолчанию: (имя, выражение, замена, начало). «Начало» —
+# выражение для первого символа совпадения: если у всех правил это символ или
+# класс символов, текст просматривается быстрым поиском по их объединению, и
+# правила пробуются только в найденных позициях.
+# Порядок важен — при совпадении в одной позиции срабатывает правило, стоящее раньше.
+NormalizeRule = Tuple[str, str, str, Optional[str]]
+# Строка рекламного блока: «Подписаться на канал | Прислать новость» и т.п.
+_PROMO_LINE = (r"[^\w\n]*(?i:подписаться|подпишись|подписывайтесь|подписывайся|прислать новость"
+               r"|предложить новость|читать нас в)\b[^\n]*")
+# Строка из одних ссылок t.me, упоминаний и хэштегов (или пустая)
+_PROMO_AUX_LINE = r"[^\w\n]*(?:(?:(?:https?://)?(?:t|telegram)\.me/\S+|[@#]\w+)[^\w\n]*)*"
+DEFAULT_NORMALIZE_RULES: List[NormalizeRule] = [
+    # Рекламный хвост: блок таких строк в самом конце поста, но не первая строка
+    ("promo_tail", rf"\n(?:{_PROMO_AUX_LINE}\n)*{_PROMO_LINE}(?:\n(?:{_PROMO_LINE}|{_PROMO_AUX_LINE}))*\s*\Z",
+     " ", r"\n"),
+    ("tg_link", r"(?:https?://)?(?:t|telegram)\.me/\S+", " ", r"[ht]"),
+    ("mention", r"@\w+", "", r"@"),
+    # Два и больше хэштега подряд; одиночный хэштег в тексте оставляем
+    ("hashtag_block", r"#\w+(?:[^\S\n]*#\w+)+", " ", r"#"),
+    ("emoji", r"[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D\u20E3]+", " ",
+     r"[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D\u20E3]"),
+]
+# Перевод строки по одному (чтобы правила, начинающиеся с \n, видели начало строки),
+# прочие пробельные символы — только там, где это не одиночный пробел
+_WHITESPACE_PATTERN = r"\n|[^\S\n]{2,}|[^\S \n]"
+# Пробельные символы, кроме обычного пробела: с них начинается совпадение _WHITESPACE_PATTERN,
+# если это не серия обычных пробелов (её схлопывает _SPACES_RE в промежутках)
+_NON_SPACE_WHITESPACE = r"\t\n\v\f\r\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000"
+_SPACES_RE = re.compile(r" {2,}")
+
+
+def _first_char_class(first: str) -> Optional[str]:
+    """Содержимое класса символов для «начала» правила; None — если это не символ и не класс."""
+    m = re.fullmatch(r"\[([^\]\[^][^\]\[]*)\]", first)
+    if m:
+        return m.group(1)
+    if len(first) == 1 or re.fullmatch(r"\\.", first):
+        return re.escape(first) if len(first) == 1 else first
+    return None
+
+
+class TextNormalizer:
+    """Очистка текста поста за один проход одним заранее скомпилированным выражением.
+
+    Правила объединяются в альтернативу именованных групп, пробелы схлопываются
+    в том же проходе. Считает, сколько символов и (оценочно) токенов убрано.
+    """
+
+    def __init__(self, rules: List[NormalizeRule]) -> None:
+        self.rules = rules
+        parts = [f"(?P<_r{i}>{pattern})" for i, (_, pattern, _, _) in enumerate(rules)]
+        parts.append(f"(?P<_ws>{_WHITESPACE_PATTERN})")
+        pattern = "|".join(parts)
+        classes = [_first_char_class(first) if first else None for _, _, _, first in rules]
+        self._gate: Optional[re.Pattern] = None
+        if all(c is not None for c in classes):
+            # Поиск по одному классу символов идёт в C без попыток правил в каждой позиции
+            self._gate = re.compile(f"[{''.join(classes)}{_NON_SPACE_WHITESPACE}]")
+        elif all(first for _, _, _, first in rules):
+            starts = "|".join(first for _, _, _, first in rules)
+            pattern = f"(?={starts}|\\s)(?:{pattern})"
+        self._regex = re.compile(pattern, re.M)
+        self._names = {f"_r{i}": name for i, (name, _, _, _) in enumerate(rules)}
+        self._names["_ws"] = "whitespace"
+        self._repl = {f"_r{i}": repl for i, (_, _, repl, _) in enumerate(rules)}
+        self._repl["_ws"] = " "
+        self.posts = 0
+        self.chars_in = 0
+        self.saved_chars: Dict[str, int] = {}
+        self._saved_tokens = 0
+        # Убранные куски, ещё не учтённые в saved_tokens: оценка токенов — не на горячем пути
+        self._removed: List[str] = []
+
+    @property
+    def saved_tokens(self) -> int:
+        self._refresh_saved_tokens()
+        return self._saved_tokens
+
+    def _refresh_saved_tokens(self) -> None:
+        """Оценивает токены накопленных убранных кусков одним вызовом estimate_tokens."""
+        if self._removed:
+            tokens = estimate_tokens(" ".join(self._removed))
+            self._removed.clear()
+            self._saved_tokens += tokens
+            METRICS.inc("newsbot_normalize_saved_tokens_total", tokens)
+
+    def _matches(self, text: str) -> Iterator["re.Match[str]"]:
+        gate = self._gate
+        if gate is None:
+            yield from self._regex.finditer(text)
+            return
+        match = self._regex.match
+        pos = 0
+        while True:
+            g = gate.search(text, pos)
+            if g is None:
+                return
+            m = match(text, g.start())
+            if m is None:
+                pos = g.start() + 1
+                continue
+            yield m
+            pos = m.end() if m.end() > m.start() else m.start() + 1
+
+    def normalize(self, text: str) -> str:
+        out: List[str] = []
+        ends_space = True  # в начале пробел не нужен
+        pos = 0
+        saved: Dict[str, int] = {}
+        removed = self._removed
+        spaces = 0
+        gated = self._gate is not None
+        for m in self._matches(text):
+            seg = text[pos:m.start()]
+            if seg:
+                if gated and "  " in seg:
+                    collapsed = _SPACES_RE.sub(" ", seg)
+                    spaces += len(seg) - len(collapsed)
+                    seg = collapsed
+                # Между совпадениями бывает максимум одиночный пробел с краю
+                if ends_space and seg[0] == " ":
+                    seg = seg[1:]
+                if seg:
+                    out.append(seg)
+                    ends_space = seg[-1] == " "
+            group = m.lastgroup
+            repl = self._repl[group]
+            if repl == " ":
+                emitted = 0 if ends_space else 1
+                if emitted:
+                    out.append(" ")
+                ends_space = True
+            else:
+                emitted = len(repl)
+                if repl:
+                    out.append(repl)
+                    ends_space = repl[-1] == " "
+            name = self._names[group]
+            saved[name] = saved.get(name, 0) + len(m.group()) - emitted
+            if group != "_ws":
+                removed.append(m.group())
+            pos = m.end()
+        tail = text[pos:]
+        if gated and "  " in tail:
+            collapsed = _SPACES_RE.sub(" ", tail)
+            spaces += len(tail) - len(collapsed)
+            tail = collapsed
+        if tail and ends_space and tail[0] == " ":
+            tail = tail[1:]
+        out.append(tail)
+        result = "".join(out).strip()
+        if spaces:
+            saved["whitespace"] = saved.get("whitespace", 0) + spaces
+
+        self.posts += 1
+        self.chars_in += len(text)
+        for name, count in saved.items():
+            if count:
+                self.saved_chars[name] = self.saved_chars.get(name, 0) + count
+                METRICS.inc("newsbot_normalize_saved_chars_total", count, rule=name)
+        if len(removed) > 256:
+            self._refresh_saved_tokens()
+        return result
+
+
+_normalizers: Dict[str, TextNormalizer] = {}
+
+
+def _rules_from_config(base: List[NormalizeRule], config: Dict, where: str) -> List[NormalizeRule]:
+    disabled = set(config.get("disable", []))
+    rules = [rule for rule in base if rule[0] not in disabled]
+    for raw in config.get("rules", []):
+        name, pattern = str(raw.get("name", "custom")), raw.get("pattern", "")
+        try:
+            re.compile(pattern, re.M)
+        except re.error as e:
+            print(f"[Normalize] bad rule {name} in {where}: {e}")
+            continue
+        rules.append((name, pattern, str(raw.get("replace", " ")), raw.get("first")))
+    return rules
+
+
+def load_normalizers() -> None:
+    """Компилирует правила очистки один раз: общие и по каналам из NORMALIZE_RULES_FILE.
+
+    Файл — JSON: {"default": {...}, "channels": {"-100123": {...}, "@name": {...}}},
+    где у секции есть "disable" (имена встроенных правил) и "rules"
+    ([{"name", "pattern", "replace", "first"}]). Правила канала дополняют общие.
+    "first" — необязательное выражение для первого символа совпадения; если оно
+    есть у всех правил, очистка заметно быстрее.
+    """
+    config: Dict = {}
+    path = os.getenv("NORMALIZE_RULES_FILE", "").strip()
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Normalize] cannot load {path}: {e}")
+    default_rules = _rules_from_config(DEFAULT_NORMALIZE_RULES, config.get("default", {}), "default")
+    _normalizers.clear()
+    _normalizers[""] = TextNormalizer(default_rules)
+    for key, section in config.get("channels", {}).items():
+        _normalizers[str(key).lower()] = TextNormalizer(_rules_from_config(default_rules, section, str(key)))
+
+
+def bind_channel_rules(username: str, chat_id: int) -> None:
+    """Правила, заданные в файле по @username, применяются и по id канала."""
+    if not _normalizers:
+        load_normalizers()
+    normalizer = _normalizers.get(f"@{username.lstrip('@').lower()}")
+    if normalizer is not None:
+        _normalizers.setdefault(str(chat_id), normalizer)
+
+
+def get_normalizer(chat_id: Optional[int] = None) -> TextNormalizer:
+    if not _normalizers:
+        load_normalizers()
+    if chat_id is not None:
+        normalizer = _normalizers.get(str(chat_id))
+        if normalizer is not None:
+            return normalizer
+    return _normalizers[""]
+
+
+def clean_text(text: str, chat_id: Optional[int] = None) -> str:
+    """Удаляет теги и ссылки Telegram, рекламные хвосты, блоки хэштегов, эмодзи и лишние пробелы"""
+    return get_normalizer(chat_id).normalize(text)
+
 
 def build_paraphrase_prompt(text: str, source: Optional[str] = None, extra_style: Optional[str] = None) -> str:
     style_line = f"\n\nДополнительные указания стиля:\n{extra_style}" if extra_style else ""
@@ -65,68 +312,1042 @@ def build_paraphrase_prompt(text: str, source: Optional[str] = None, extra_style
             f"Текст для переформулирования:\n{text}{style_line}"
         )
 
-def _openrouter_request_sync(prompt: str, api_key: str, app_url: Optional[str]) -> str:
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "X-Title": "NewsBot",
-    }
-    if app_url:
-        headers["HTTP-Referer"] = app_url
-
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [
-            {"role": "user", "content": prompt},
-        ],
-        "temperature": 0.3,
-        "max_tokens": 400,
-        "seed": 7
-    }
-
-    # Попробуем разные URL эндпоинты
-    urls_to_try = [
-        "https://openrouter.ai/api/v1/chat/completions",
-        "https://openrouter.co/v1/chat/completions",
-        "https://openrouter.ai/api/v1/chat/completions"
-    ]
-
-    max_retries = 4
-    backoff = 2.0
-    
-    for url in urls_to_try:
-        for attempt in range(max_retries):
-            try:
-                r = requests.post(url, headers=headers, json=payload, timeout=60)
-                if r.status_code == 429:
-                    retry_after = r.headers.get("Retry-After")
-                    wait = float(retry_after) if retry_after else backoff * (2 ** attempt)
-                    time.sleep(min(wait, 30))
-                    continue
-                r.raise_for_status()
-                data = r.json()
-                content = data["choices"][0]["message"]["content"].strip()
-                if not content:
-                    print(f"[OpenRouter] Empty response from {url}")
-                    continue
-                return content
-            except requests.exceptions.RequestException as e:
-                print(f"[OpenRouter] URL {url} failed: {e}")
-                if attempt == max_retries - 1:
-                    break
-                time.sleep(backoff * (2 ** attempt))
+_TOKEN_PIECE_RE = re.compile(r"[A-Za-z]+|[^\W\d_]+|\d+|[^\w\s]|_")
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов BPE без токенизатора модели.
+
+    Латиница ≈ 4 символа на токен, кириллица и прочие алфавиты ≈ 2.5,
+    числа ≈ 3 цифры, каждый знак препинания — отдельный токен.
+    """
+    total = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        ch = piece[0]
+        if ch.isdigit():
+            total += math.ceil(len(piece) / 3)
+        elif ch.isalpha():
+            total += math.ceil(len(piece) / (4.0 if ch.isascii() else 2.5))
         else:
-            # Если этот URL сработал, выходим из цикла
+            total += 1
+    return total
+
+
+def truncate_to_tokens(text: str, budget: int, keep_tail: bool = False) -> str:
+    """Обрезает текст по границам предложений, чтобы он уложился в budget токенов.
+
+    Новости пишутся «перевёрнутой пирамидой», поэтому по умолчанию сохраняется
+    начало; keep_tail=True сохраняет конец (свежие правки редактора в стиле).
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    sentences = _SENTENCE_SPLIT_RE.split(text)
+    if keep_tail:
+        sentences.reverse()
+    kept: List[str] = []
+    used = 0
+    for sentence in sentences:
+        cost = estimate_tokens(sentence) + 1
+        if used + cost > budget:
             break
+        kept.append(sentence)
+        used += cost
+    if not kept:
+        # Одно огромное предложение — режем по символам пропорционально бюджету
+        ratio = budget / max(1, estimate_tokens(text))
+        cut = max(1, int(len(text) * ratio))
+        return "… " + text[-cut:] if keep_tail else text[:cut] + " …"
+    if keep_tail:
+        kept.reverse()
+        return "… " + " ".join(kept)
+    return " ".join(kept) + " …"
+
+
+@dataclass
+class PromptBudget:
+    """Лимиты токенов на запрос пересказа."""
+    input_budget: int
+    style_budget: int
+    output_ratio: float
+    output_min: int
+    output_max: int
+    use_system: bool
+
+    def output_tokens(self, input_tokens: int) -> int:
+        # Пересказ по длине близок к исходнику: резерв пропорционален входу
+        return max(self.output_min, min(self.output_max, int(input_tokens * self.output_ratio) + 40))
+
+
+def get_prompt_budget() -> PromptBudget:
+    return PromptBudget(
+        input_budget=max(300, _env_int("PROMPT_TOKEN_BUDGET", 3000)),
+        style_budget=max(50, _env_int("PROMPT_STYLE_TOKEN_BUDGET", 500)),
+        output_ratio=_env_float("PROMPT_OUTPUT_RATIO", 1.3),
+        output_min=max(16, _env_int("PROMPT_OUTPUT_MIN_TOKENS", 150)),
+        output_max=max(16, _env_int("PROMPT_OUTPUT_MAX_TOKENS", 1200)),
+        use_system=os.getenv("PROMPT_USE_SYSTEM", "1").strip() != "0",
+    )
+
+
+def build_paraphrase_messages(text: str, source: Optional[str] = None,
+                              extra_style: Optional[str] = None) -> Tuple[List[Dict[str, str]], int]:
+    """Собирает messages для OpenRouter в рамках бюджета токенов и подбирает max_tokens."""
+    budget = get_prompt_budget()
+    if extra_style:
+        extra_style = truncate_to_tokens(extra_style, budget.style_budget, keep_tail=True)
+    messages: List[Dict[str, str]] = []
+    overhead = estimate_tokens(build_paraphrase_prompt("", source, extra_style))
+    if budget.use_system:
+        messages.append({"role": "system", "content": SYSTEM_PROMPT})
+        overhead += estimate_tokens(SYSTEM_PROMPT)
+    text = truncate_to_tokens(text, max(100, budget.input_budget - overhead))
+    messages.append({"role": "user", "content": build_paraphrase_prompt(text, source, extra_style)})
+    return messages, budget.output_tokens(estimate_tokens(text))
+
+
+def paraphrase_cache_params() -> Dict:
+    """Всё, кроме текста/стиля/модели, что влияет на ответ, — часть ключа кеша."""
+    return {**OPENROUTER_SAMPLING, **asdict(get_prompt_budget())}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    """Счётчики, gauge-и и гистограммы процесса в памяти.
+
+    Отдаются в текстовом формате Prometheus (render) на /metrics и как JSON
+    (snapshot) в лог. Gauge-и не хранятся, а собираются функциями в момент чтения.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+    def __init__(self) -> None:
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        self._gauges: Dict[str, Dict[str, Callable[[], List[Tuple[Dict[str, str], float]]]]] = {}
+
+    @staticmethod
+    def _labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        series = self._counters.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        series = self._histograms.setdefault(name, {})
+        key = self._labels(labels)
+        # [счётчики по корзинам..., сумма, число наблюдений]
+        state = series.get(key)
+        if state is None:
+            state = series[key] = [0.0] * (len(self.BUCKETS) + 2)
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def register_gauge(self, name: str, collect: Callable[[], List[Tuple[Dict[str, str], float]]],
+                       key: str = "") -> None:
+        """key различает источники одной метрики; повторная регистрация с тем же
+        name и key заменяет прежнюю (после перезапуска не держим старые объекты)."""
+        self._gauges.setdefault(name, {})[key] = collect
+
+    def _collect_gauges(self) -> Dict[str, Dict[Labels, float]]:
+        out: Dict[str, Dict[Labels, float]] = {}
+        for name, collectors in self._gauges.items():
+            series = out.setdefault(name, {})
+            for collect in list(collectors.values()):
+                try:
+                    for labels, value in collect():
+                        series[self._labels(labels)] = float(value)
+                except Exception as e:
+                    print(f"[Metrics] gauge {name} error: {e}")
+        return out
+
+    @staticmethod
+    def _fmt(name: str, labels: Labels, value: float, extra: Labels = ()) -> str:
+        pairs = labels + extra
+        if pairs:
+            inner = ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs)
+            return f"{name}{{{inner}}} {float(value)!r}"
+        return f"{name} {float(value)!r}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        def header(name: str, kind: str) -> None:
+            _, help_text = self._meta.get(name, (kind, ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(self._counters.items()):
+            header(name, "counter")
+            lines.extend(self._fmt(name, labels, value) for labels, value in series.items())
+        for name, series in sorted(self._collect_gauges().items()):
+            header(name, "gauge")
+            lines.extend(self._fmt(name, labels, value) for labels, value in series.items())
+        for name, series in sorted(self._histograms.items()):
+            header(name, "histogram")
+            for labels, state in series.items():
+                for bound, count in zip(self.BUCKETS, state):
+                    lines.append(self._fmt(f"{name}_bucket", labels, count, (("le", f"{bound:g}"),)))
+                lines.append(self._fmt(f"{name}_bucket", labels, state[-1], (("le", "+Inf"),)))
+                lines.append(self._fmt(f"{name}_sum", labels, state[-2]))
+                lines.append(self._fmt(f"{name}_count", labels, state[-1]))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """То же, что render(), но словарём для JSON-лога (гистограммы — count/sum/квантили по корзинам)."""
+        out: Dict[str, List[Dict[str, Any]]] = {}
+        for name, series in list(self._counters.items()) + list(self._collect_gauges().items()):
+            out[name] = [{**dict(labels), "value": value} for labels, value in series.items()]
+        for name, series in self._histograms.items():
+            rows = []
+            for labels, state in series.items():
+                count = state[-1]
+                row: Dict[str, Any] = {**dict(labels), "count": count, "sum": round(state[-2], 3)}
+                for q in (0.5, 0.95):
+                    bound = next((b for b, c in zip(self.BUCKETS, state) if c >= q * count), None)
+                    row[f"p{int(q * 100)}_le"] = bound
+                rows.append(row)
+            out[name] = rows
+        return out
+
+
+METRICS = Metrics()
+METRICS.describe("newsbot_ingest_total", "counter", "Posts received from channels by source")
+METRICS.describe("newsbot_dropped_total", "counter", "Posts dropped before the LLM call by reason")
+METRICS.describe("newsbot_pipeline_failed_total", "counter", "Posts that failed in a pipeline stage")
+METRICS.describe("newsbot_stage_seconds", "histogram", "Time spent in a pipeline stage handler")
+METRICS.describe("newsbot_end_to_end_seconds", "histogram", "Source post date to our publish")
+METRICS.describe("newsbot_pipeline_seconds", "histogram", "Pipeline intake to our publish")
+METRICS.describe("newsbot_llm_request_seconds", "histogram", "OpenRouter request latency by model and outcome")
+METRICS.describe("newsbot_llm_retries_total", "counter", "OpenRouter attempts retried on another target")
+METRICS.describe("newsbot_llm_hedges_total", "counter", "Hedged OpenRouter requests")
+METRICS.describe("newsbot_llm_tokens_total", "counter", "Tokens reported by OpenRouter by model and kind")
+METRICS.describe("newsbot_llm_slot_wait_seconds", "histogram", "Wait for an OpenRouter request slot by priority")
+METRICS.describe("newsbot_llm_queue_wait_seconds", "histogram", "Wait of a channel post in the LLM scheduler")
+METRICS.describe("newsbot_send_seconds", "histogram", "Outbound queue entry to delivered message")
+METRICS.describe("newsbot_send_failures_total", "counter", "Messages that could not be delivered by reason")
+METRICS.describe("newsbot_send_retries_total", "counter", "Send retries by reason")
+METRICS.describe("newsbot_queue_depth", "gauge", "Items waiting in pipeline and outbound queues")
+METRICS.describe("newsbot_normalize_saved_chars_total", "counter", "Characters removed by text normalization by rule")
+METRICS.describe("newsbot_normalize_saved_tokens_total", "counter", "Estimated tokens removed by text normalization")
+METRICS.describe("newsbot_album_parts_total", "counter", "Album messages merged into one post by source")
+METRICS.describe("newsbot_media_downloads_total", "counter", "Album media downloaded for re-upload")
+METRICS.describe("newsbot_component_restarts_total", "counter", "Background components and shard workers restarted after a crash")
+
+
+async def _metrics_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+        while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", METRICS.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server() -> Optional[asyncio.AbstractServer]:
+    """Локальный HTTP /metrics (METRICS_PORT, 0 — выключен; воркер шарда N — на METRICS_PORT+1+N)."""
+    port = _env_int("METRICS_PORT", 0)
+    if port <= 0:
+        return None
+    if _shard_index is not None:
+        port += 1 + _shard_index
+    host = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+    server = await asyncio.start_server(_metrics_http, host, port)
+    print(f"[Metrics] serving http://{host}:{port}/metrics")
+    return server
+
+
+async def metrics_log_loop(interval: float) -> None:
+    """Раз в interval секунд пишет снимок метрик одной JSON-строкой."""
+    while True:
+        await asyncio.sleep(interval)
+        record: Dict[str, Any] = {"ts": round(time.time(), 3), "event": "metrics", "metrics": METRICS.snapshot()}
+        if _shard_index is not None:
+            record["shard"] = _shard_index
+        print(json.dumps(record, ensure_ascii=False))
+
+
+class TokenBucket:
+    """Асинхронный token bucket: не больше rate операций в секунду с запасом capacity."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+# Приоритеты запросов к LLM: меньше — важнее
+LLM_PRIORITY_EDITOR = 0
+LLM_PRIORITY_CHANNEL = 1
+_LLM_PRIORITY_NAMES = {LLM_PRIORITY_EDITOR: "editor", LLM_PRIORITY_CHANNEL: "channel"}
+
+
+class PrioritySlots:
+    """Семафор на capacity одновременных запросов: освободившийся слот получает
+    ожидающий с меньшим priority, при равных — пришедший раньше."""
+
+    def __init__(self, capacity: int) -> None:
+        self._free = capacity
+        self._waiters: List[Tuple[int, int, "asyncio.Future[None]"]] = []
+        self._seq = 0
+
+    async def acquire(self, priority: int) -> None:
+        started = time.monotonic()
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+        else:
+            fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+            self._seq += 1
+            heapq.heappush(self._waiters, (priority, self._seq, fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Слот уже передан нам — отдаём следующему
+                    self.release()
+                raise
+        METRICS.observe("newsbot_llm_slot_wait_seconds", time.monotonic() - started,
+                        priority=_LLM_PRIORITY_NAMES.get(priority, str(priority)))
+
+    def release(self) -> None:
+        while self._waiters:
+            fut = heapq.heappop(self._waiters)[2]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._free += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def get_model_pool() -> List[str]:
+    """Упорядоченный пул моделей: OPENROUTER_MODELS, иначе OPENROUTER_MODEL, иначе модель по умолчанию."""
+    raw = os.getenv("OPENROUTER_MODELS", "").strip() or os.getenv("OPENROUTER_MODEL", "").strip()
+    models = [m.strip() for m in raw.split(",") if m.strip()]
+    return models or [OPENROUTER_MODEL]
+
+
+def get_endpoint_pool() -> List[str]:
+    raw = os.getenv("OPENROUTER_URLS", "").strip()
+    urls = [u.strip() for u in raw.split(",") if u.strip()]
+    return urls or [OPENROUTER_URL, "https://openrouter.co/v1/chat/completions"]
+
+
+Target = Tuple[str, str]  # (модель, URL)
+
+
+class ModelRouter:
+    """Выбор модели и эндпоинта по скользящим p50/p95 задержки и доле ошибок.
+
+    Для каждой пары (модель, URL) хранится окно последних window запросов.
+    После 429/5xx/сетевой ошибки пара «остывает» (cooldown) и не выбирается,
+    пока есть другие. При равных показателях предпочитается порядок из конфига.
+    """
+
+    def __init__(self, models: List[str], urls: List[str], window: int, default_latency: float) -> None:
+        self.targets: List[Target] = [(m, u) for m in models for u in urls]
+        self.default_latency = default_latency
+        self._latency: Dict[Target, deque] = {t: deque(maxlen=window) for t in self.targets}
+        self._outcomes: Dict[Target, deque] = {t: deque(maxlen=window) for t in self.targets}
+        self._cooldown: Dict[Target, float] = {t: 0.0 for t in self.targets}
+
+    def record(self, target: Target, latency: Optional[float], ok: bool, cooldown: float = 0.0) -> None:
+        self._outcomes[target].append(ok)
+        if ok and latency is not None:
+            self._latency[target].append(latency)
+        if cooldown > 0:
+            self._cooldown[target] = max(self._cooldown[target], time.monotonic() + cooldown)
+
+    def percentile(self, target: Target, q: float) -> Optional[float]:
+        samples = sorted(self._latency[target])
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def error_rate(self, target: Target) -> float:
+        outcomes = self._outcomes[target]
+        return (len(outcomes) - sum(outcomes)) / len(outcomes) if outcomes else 0.0
+
+    def cooldown_left(self, target: Target) -> float:
+        return max(0.0, self._cooldown[target] - time.monotonic())
+
+    def ranked(self, exclude: Tuple[Target, ...] = ()) -> List[Target]:
+        """Доступные пары от самой здоровой к худшей; «остывающие» — в конце."""
+        def score(item: Tuple[int, Target]) -> Tuple[bool, float]:
+            idx, target = item
+            p50 = self.percentile(target, 0.5) or self.default_latency
+            return (self.cooldown_left(target) > 0, p50 * (1 + 4 * self.error_rate(target)) * (1 + 0.05 * idx))
+        items = [(i, t) for i, t in enumerate(self.targets) if t not in exclude]
+        return [t for _, t in sorted(items, key=score)]
+
+    def hedge_delay(self, target: Target) -> float:
+        """Когда дублировать запрос: после p95 пары (пока статистики мало — после default_latency)."""
+        if len(self._latency[target]) < 5:
+            return self.default_latency
+        return self.percentile(target, 0.95) or self.default_latency
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "model": m,
+                "url": u,
+                "p50": self.percentile((m, u), 0.5),
+                "p95": self.percentile((m, u), 0.95),
+                "errors": self.error_rate((m, u)),
+                "samples": len(self._outcomes[(m, u)]),
+            }
+            for m, u in self.targets
+        ]
 
-    raise RuntimeError("OpenRouter недоступен после попыток с разными URL")
+
+class TokenUsage:
+    """Учёт токенов по моделям (из поля usage ответа OpenRouter) для контроля расходов."""
+
+    def __init__(self) -> None:
+        self.by_model: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, usage: Optional[Dict]) -> None:
+        if not usage:
+            return
+        prompt_tokens = int(usage.get("prompt_tokens") or 0)
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        totals = self.by_model.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["completion_tokens"] += completion_tokens
+        METRICS.inc("newsbot_llm_tokens_total", prompt_tokens, model=model, kind="prompt")
+        METRICS.inc("newsbot_llm_tokens_total", completion_tokens, model=model, kind="completion")
+        print(f"[OpenRouter] usage {model}: prompt={prompt_tokens} completion={completion_tokens}")
+
+
+class _AttemptFailed(Exception):
+    pass
+
+
+class OpenRouterClient:
+    """Асинхронный клиент OpenRouter: один пул keep-alive соединений на весь процесс.
+
+    Модель и эндпоинт для каждого запроса выбирает ModelRouter; при hedge=True,
+    если ответ не пришёл за p95 выбранной пары, параллельно запрашивается следующая,
+    и берётся тот ответ, что пришёл первым.
+    """
+
+    def __init__(self, api_key: str, app_url: Optional[str], max_concurrency: int, timeout: float,
+                 router: ModelRouter, hedge: bool, max_attempts: int) -> None:
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "X-Title": "NewsBot",
+        }
+        if app_url:
+            headers["HTTP-Referer"] = app_url
+        self.api_key = api_key
+        self.app_url = app_url
+        self.router = router
+        self.usage = TokenUsage()
+        self.hedge = hedge
+        self.max_attempts = max_attempts
+        self._client = httpx.AsyncClient(
+            headers=headers,
+            http2=_HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(
+                # запас под дублирующие (hedged) запросы
+                max_connections=max_concurrency * 2,
+                max_keepalive_connections=max_concurrency * 2,
+                keepalive_expiry=120.0,
+            ),
+        )
+        # Ограничиваем число одновременных запросов к LLM, а не размер пула потоков;
+        # свободный слот первыми получают команды редактора
+        self._slots = PrioritySlots(max_concurrency)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def complete(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+                       priority: int = LLM_PRIORITY_CHANNEL) -> str:
+        async with self._slots.slot(priority):
+            return await self._complete(messages, max_tokens)
+
+    def _payload(self, messages: List[Dict[str, str]], model: str, max_tokens: Optional[int] = None) -> Dict:
+        payload = {
+            "model": model,
+            "messages": messages,
+            **OPENROUTER_SAMPLING,
+        }
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        return payload
+
+    BACKOFF = 2.0
+
+    async def _next_target(self, attempt: int, exclude: Tuple[Target, ...] = ()) -> Optional[Target]:
+        """Самая здоровая пара; если все «остывают» — ждём ближайшую (не дольше 30 с)."""
+        ranked = self.router.ranked(exclude)
+        if not ranked:
+            return None
+        target = ranked[0]
+        wait = self.router.cooldown_left(target)
+        if wait > 0:
+            await asyncio.sleep(min(wait, 30.0, self.BACKOFF * (2 ** attempt)))
+        return target
+
+    async def _attempt(self, messages: List[Dict[str, str]], target: Target, max_tokens: Optional[int] = None) -> str:
+        model, url = target
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            r = await self._client.post(url, json=self._payload(messages, model, max_tokens))
+            if r.status_code == 429 or r.status_code >= 500:
+                outcome = "rate_limited" if r.status_code == 429 else "server_error"
+                wait = _retry_after_seconds(r)
+                cooldown = min(wait if wait is not None else self.BACKOFF * 2, 60.0)
+                self.router.record(target, None, False, cooldown)
+                raise _AttemptFailed(f"status {r.status_code}")
+            if r.status_code >= 400:
+                outcome = "client_error"
+                # 4xx (кроме 429): модель/URL недоступны — надолго убираем пару из ротации
+                self.router.record(target, None, False, 300.0)
+                raise _AttemptFailed(f"status {r.status_code}: {r.text[:200]}")
+            data = r.json()
+            content = (data["choices"][0]["message"]["content"] or "").strip()
+            self.usage.record(model, data.get("usage"))
+            outcome = "ok" if content else "empty"
+        except asyncio.CancelledError:
+            # Проигравший hedged-запрос не завершился: ни успеха, ни задержки в статистику пары
+            outcome = "cancelled"
+            raise
+        except (httpx.HTTPError, ValueError, KeyError, IndexError, TypeError) as e:
+            self.router.record(target, None, False, self.BACKOFF)
+            raise _AttemptFailed(str(e) or type(e).__name__) from e
+        finally:
+            METRICS.observe("newsbot_llm_request_seconds", time.monotonic() - started, model=model, outcome=outcome)
+        if not content:
+            self.router.record(target, None, False)
+            raise _AttemptFailed("empty response")
+        self.router.record(target, time.monotonic() - started, True)
+        return content
+
+    async def _hedged(self, messages: List[Dict[str, str]], target: Target, max_tokens: Optional[int] = None) -> str:
+        primary = asyncio.create_task(self._attempt(messages, target, max_tokens))
+        pending = {primary}
+        error: Optional[BaseException] = None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.router.hedge_delay(target))
+            if done:
+                return primary.result()
+            # Дублируем другой моделью: та же модель на другом эндпоинте обычно так же медленна
+            ranked = [t for t in self.router.ranked((target,))
+                      if t[0] != target[0] and self.router.cooldown_left(t) == 0]
+            if not ranked:
+                return await primary
+            print(f"[OpenRouter] hedging {target[0]} with {ranked[0][0]}")
+            METRICS.inc("newsbot_llm_hedges_total", model=target[0])
+            pending.add(asyncio.create_task(self._attempt(messages, ranked[0], max_tokens)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error or _AttemptFailed("hedged requests failed")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _complete(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> str:
+        for attempt in range(self.max_attempts):
+            target = await self._next_target(attempt)
+            if target is None:
+                break
+            if attempt:
+                METRICS.inc("newsbot_llm_retries_total", model=target[0])
+            try:
+                if self.hedge and len(self.router.targets) > 1:
+                    return await self._hedged(messages, target, max_tokens)
+                return await self._attempt(messages, target, max_tokens)
+            except _AttemptFailed as e:
+                print(f"[OpenRouter] {target[0]} @ {target[1]} failed: {e}")
+
+        raise RuntimeError("OpenRouter недоступен после попыток с разными моделями и URL")
+
+    async def stream(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None,
+                     priority: int = LLM_PRIORITY_CHANNEL) -> AsyncIterator[str]:
+        """Потоковый ответ (stream: true): отдаёт куски текста по мере генерации.
+
+        Повторы и смена модели/URL возможны только до первого куска; обрыв после него
+        пробрасывается вызывающему.
+        """
+        async with self._slots.slot(priority):
+            for attempt in range(self.max_attempts):
+                target = await self._next_target(attempt)
+                if target is None:
+                    break
+                if attempt:
+                    METRICS.inc("newsbot_llm_retries_total", model=target[0])
+                model, url = target
+                payload = {**self._payload(messages, model, max_tokens), "stream": True, "usage": {"include": True}}
+                started = time.monotonic()
+                emitted = False
+                try:
+                    async with self._client.stream("POST", url, json=payload) as r:
+                        if r.status_code == 429 or r.status_code >= 500:
+                            wait = _retry_after_seconds(r)
+                            self.router.record(target, None, False, min(wait if wait is not None else self.BACKOFF * 2, 60.0))
+                            print(f"[OpenRouter] stream {model} @ {url} status {r.status_code}")
+                            self._observe_stream(target, started, "rate_limited" if r.status_code == 429 else "server_error")
+                            continue
+                        if r.status_code >= 400:
+                            self.router.record(target, None, False, 300.0)
+                            print(f"[OpenRouter] stream {model} @ {url} status {r.status_code}")
+                            self._observe_stream(target, started, "client_error")
+                            continue
+                        async for line in r.aiter_lines():
+                            # SSE: полезные строки — "data: {...}", остальное — комментарии/keep-alive
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[5:].strip()
+                            if data == "[DONE]":
+                                break
+                            chunk = json.loads(data)
+                            if "error" in chunk:
+                                raise RuntimeError(f"OpenRouter stream error: {chunk['error']}")
+                            if chunk.get("usage"):
+                                self.usage.record(model, chunk["usage"])
+                            if not chunk.get("choices"):
+                                continue
+                            delta = (chunk["choices"][0].get("delta") or {}).get("content")
+                            if delta:
+                                emitted = True
+                                yield delta
+                except (httpx.HTTPError, ValueError, KeyError, IndexError, RuntimeError) as e:
+                    self.router.record(target, None, False, self.BACKOFF)
+                    self._observe_stream(target, started, "error")
+                    if emitted:
+                        raise
+                    print(f"[OpenRouter] stream {model} @ {url} failed: {e}")
+                    continue
+                if emitted:
+                    self.router.record(target, time.monotonic() - started, True)
+                    self._observe_stream(target, started, "ok")
+                    return
+                self.router.record(target, None, False)
+                self._observe_stream(target, started, "empty")
+                print(f"[OpenRouter] Empty stream from {model} @ {url}")
+
+        raise RuntimeError("OpenRouter недоступен после попыток с разными моделями и URL")
+
+    def _observe_stream(self, target: Target, started: float, outcome: str) -> None:
+        METRICS.observe("newsbot_llm_request_seconds", time.monotonic() - started, model=target[0], outcome=outcome)
+
+
+def _retry_after_seconds(r: httpx.Response) -> Optional[float]:
+    retry_after = r.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        return None
+
+
+_openrouter_client: Optional[OpenRouterClient] = None
+
+
+def get_openrouter_client(api_key: str, app_url: Optional[str]) -> OpenRouterClient:
+    """Возвращает общий на процесс клиент; пересоздаёт его только при смене ключа/URL."""
+    global _openrouter_client
+    client = _openrouter_client
+    if client is None or client.api_key != api_key or client.app_url != app_url:
+        if client is not None:
+            asyncio.get_running_loop().create_task(client.aclose())
+        client = OpenRouterClient(
+            api_key,
+            app_url,
+            max_concurrency=max(1, _env_int("OPENROUTER_CONCURRENCY", 4)),
+            timeout=_env_float("OPENROUTER_TIMEOUT", 60.0),
+            router=ModelRouter(
+                get_model_pool(),
+                get_endpoint_pool(),
+                window=max(5, _env_int("OPENROUTER_STATS_WINDOW", 50)),
+                default_latency=_env_float("OPENROUTER_HEDGE_DELAY", 10.0),
+            ),
+            hedge=os.getenv("OPENROUTER_HEDGE", "0").strip() == "1",
+            max_attempts=max(1, _env_int("OPENROUTER_MAX_ATTEMPTS", 6)),
+        )
+        _openrouter_client = client
+    return client
+
+
+async def close_openrouter_client() -> None:
+    global _openrouter_client
+    client, _openrouter_client = _openrouter_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def get_db_path() -> Path:
+    raw = os.getenv("NEWSBOT_DB", "").strip()
+    return Path(raw) if raw else Path(__file__).with_name("newsbot.db")
+
+
+_db: Optional[sqlite3.Connection] = None
+
+
+def get_db() -> sqlite3.Connection:
+    """Общее SQLite-подключение процесса (WAL, автокоммит)."""
+    global _db
+    if _db is None:
+        conn = sqlite3.connect(str(get_db_path()), timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db = conn
+    return _db
+
+
+class ParaphraseCache:
+    """Кеш ответов LLM в SQLite с ограничением размера и TTL."""
+
+    def __init__(self, conn: sqlite3.Connection, max_items: int, ttl: float) -> None:
+        self._conn = conn
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS paraphrase_cache ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS paraphrase_cache_created ON paraphrase_cache(created_at)")
+
+    @staticmethod
+    def make_key(cleaned_text: str, extra_style: Optional[str], model: str, params: Dict) -> str:
+        raw = json.dumps([cleaned_text, extra_style or "", model, params], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT result FROM paraphrase_cache WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, result: str) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO paraphrase_cache (key, result, created_at) VALUES (?, ?, ?)",
+            (key, result, time.time()),
+        )
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        self._conn.execute("DELETE FROM paraphrase_cache WHERE created_at < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM paraphrase_cache WHERE key IN ("
+            "SELECT key FROM paraphrase_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_items,),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_paraphrase_cache: Optional[ParaphraseCache] = None
+# Одинаковые запросы, уже летящие в OpenRouter (push + fallback одновременно)
+_inflight_paraphrases: Dict[str, "asyncio.Future[str]"] = {}
+
+
+def get_paraphrase_cache() -> Optional[ParaphraseCache]:
+    global _paraphrase_cache
+    max_items = _env_int("PARAPHRASE_CACHE_SIZE", 5000)
+    if max_items <= 0:
+        return None
+    if _paraphrase_cache is None:
+        _paraphrase_cache = ParaphraseCache(get_db(), max_items, _env_float("PARAPHRASE_CACHE_TTL", 86400.0))
+    return _paraphrase_cache
+
+
+async def _complete_cached(cache_key: Optional[str], messages: List[Dict[str, str]], max_tokens: int,
+                           api_key: str, app_url: Optional[str], compute: Optional[Callable[[], Awaitable[str]]] = None,
+                           priority: int = LLM_PRIORITY_CHANNEL) -> str:
+    """Кеш → уже летящий такой же запрос → compute() (по умолчанию обычный запрос к OpenRouter)."""
+    if compute is None:
+        def compute() -> Awaitable[str]:
+            return get_openrouter_client(api_key, app_url).complete(messages, max_tokens, priority)
+    cache = get_paraphrase_cache() if cache_key else None
+    if cache is None:
+        return await compute()
+    cached = cache.get(cache_key)
+    if cached:
+        return cached
+    pending = _inflight_paraphrases.get(cache_key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    fut: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+    _inflight_paraphrases[cache_key] = fut
+    try:
+        result = await compute()
+        if result and result.strip():
+            cache.put(cache_key, result)
+        fut.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        # Не даём asyncio ругаться на неполученное исключение, если ждущих нет
+        fut.exception()
+        raise
+    finally:
+        _inflight_paraphrases.pop(cache_key, None)
+
+
+class ParaphraseBatcher:
+    """Микро-батчи для всплесков: посты с одинаковым стилем, пришедшие в течение
+    window секунд (но не больше max_items), пересказываются одним запросом.
+
+    Модели отдаются пронумерованные новости, ответ ждём JSON-массивом строк.
+    Пункты, не прошедшие проверку, и весь батч при неразборчивом ответе
+    пересказываются по одному обычным запросом.
+    """
+
+    def __init__(self, window: float, max_items: int, max_chars: int) -> None:
+        self.window = window
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self._pending: Dict[str, List[Tuple[str, "asyncio.Future[str]"]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def paraphrase(self, cleaned_text: str, extra_style: Optional[str], api_key: str, app_url: Optional[str]) -> str:
+        if len(cleaned_text) > self.max_chars // 2:
+            # Длинный пост батч не ускорит — сразу обычным запросом
+            return await self._single(cleaned_text, extra_style, api_key, app_url)
+        style_key = extra_style or ""
+        fut: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+        group = self._pending.setdefault(style_key, [])
+        group.append((cleaned_text, fut))
+        total = sum(len(t) for t, _ in group)
+        if len(group) >= self.max_items or total >= self.max_chars:
+            self._flush(style_key, extra_style, api_key, app_url)
+        elif style_key not in self._timers:
+            self._timers[style_key] = asyncio.get_running_loop().call_later(
+                self.window, self._flush, style_key, extra_style, api_key, app_url
+            )
+        return await fut
+
+    def _flush(self, style_key: str, extra_style: Optional[str], api_key: str, app_url: Optional[str]) -> None:
+        timer = self._timers.pop(style_key, None)
+        if timer is not None:
+            timer.cancel()
+        group = self._pending.pop(style_key, [])
+        if group:
+            asyncio.get_running_loop().create_task(self._run(group, extra_style, api_key, app_url))
+
+    async def _single(self, cleaned_text: str, extra_style: Optional[str], api_key: str, app_url: Optional[str]) -> str:
+        messages, max_tokens = build_paraphrase_messages(cleaned_text, None, extra_style)
+        return await get_openrouter_client(api_key, app_url).complete(messages, max_tokens)
+
+    async def _run(self, group: List[Tuple[str, "asyncio.Future[str]"]], extra_style: Optional[str],
+                   api_key: str, app_url: Optional[str]) -> None:
+        results: List[Optional[str]] = [None] * len(group)
+        if len(group) > 1:
+            self.batches += 1
+            self.batched_items += len(group)
+            try:
+                messages, max_tokens = build_batch_messages([t for t, _ in group], extra_style)
+                raw = await get_openrouter_client(api_key, app_url).complete(messages, max_tokens)
+                results = parse_batch_response(raw, len(group))
+            except Exception as e:
+                print(f"[Batch] request for {len(group)} items failed: {e}")
+
+        async def finish(i: int) -> None:
+            text, fut = group[i]
+            if fut.done():
+                return
+            try:
+                result = results[i]
+                if result is None:
+                    if len(group) > 1:
+                        self.fallbacks += 1
+                    result = await self._single(text, extra_style, api_key, app_url)
+                fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+
+        await asyncio.gather(*(finish(i) for i in range(len(group))))
+
+
+def build_batch_messages(texts: List[str], extra_style: Optional[str]) -> Tuple[List[Dict[str, str]], int]:
+    budget = get_prompt_budget()
+    if extra_style:
+        extra_style = truncate_to_tokens(extra_style, budget.style_budget, keep_tail=True)
+    items = "\n\n".join(f"Новость {i}:\n{t}" for i, t in enumerate(texts, 1))
+    style_line = f"\n\nДополнительные указания стиля:\n{extra_style}" if extra_style else ""
+    prompt = (
+        f"Переформулируй каждую из {len(texts)} новостей отдельно, не смешивая их.\n"
+        f"Ответ — только JSON-массив из {len(texts)} строк в том же порядке, без пояснений и разметки.\n\n"
+        f"{items}{style_line}"
+    )
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] if budget.use_system else []
+    messages.append({"role": "user", "content": prompt})
+    max_tokens = sum(budget.output_tokens(estimate_tokens(t)) for t in texts) + 10 * len(texts)
+    return messages, min(max_tokens, 4 * budget.output_max)
+
+
+def parse_batch_response(raw: str, expected: int) -> List[Optional[str]]:
+    """Разбирает JSON-массив из ответа модели; негодные пункты — None."""
+    start, end = raw.find("["), raw.rfind("]")
+    if start < 0 or end <= start:
+        return [None] * expected
+    try:
+        items = json.loads(raw[start:end + 1])
+    except ValueError:
+        return [None] * expected
+    if not isinstance(items, list) or len(items) != expected:
+        return [None] * expected
+    return [item.strip() if isinstance(item, str) and item.strip() else None for item in items]
+
+
+_batcher: Optional[ParaphraseBatcher] = None
+
+
+def get_batcher() -> Optional[ParaphraseBatcher]:
+    global _batcher
+    if os.getenv("PARAPHRASE_BATCH", "0").strip() != "1":
+        return None
+    if _batcher is None:
+        # В батч попадают только одновременно ждущие посты, а их не больше, чем воркеров
+        # пересказа: иначе батч никогда не заполнится и каждый пост ждёт всё окно
+        max_items = min(max(2, _env_int("PARAPHRASE_BATCH_MAX", 4)),
+                        max(1, _env_int("PIPELINE_PARAPHRASE_WORKERS", 4)))
+        if max_items < 2:
+            return None
+        _batcher = ParaphraseBatcher(
+            window=_env_float("PARAPHRASE_BATCH_WINDOW_MS", 1500.0) / 1000.0,
+            max_items=max_items,
+            max_chars=max(500, _env_int("PARAPHRASE_BATCH_MAX_CHARS", 6000)),
+        )
+    return _batcher
 
 
 async def paraphrase(text: str, source: Optional[str], api_key: str, app_url: Optional[str], extra_style: Optional[str]) -> str:
+    """Пересказ по команде редактора: вне очереди постов каналов."""
     # Очищаем текст от тегов каналов и служебных символов
+    return await paraphrase_cleaned(clean_text(text), source, api_key, app_url, extra_style,
+                                    priority=LLM_PRIORITY_EDITOR)
+
+
+async def paraphrase_cleaned(cleaned_text: str, source: Optional[str], api_key: str, app_url: Optional[str],
+                             extra_style: Optional[str], allow_batch: bool = False,
+                             priority: int = LLM_PRIORITY_CHANNEL) -> str:
+    """allow_batch — можно объединить с другими постами (см. ParaphraseBatcher); только для автоматического потока.
+    priority — очередь к слотам OpenRouter (LLM_PRIORITY_EDITOR проходит раньше постов каналов)."""
+    messages, max_tokens = build_paraphrase_messages(cleaned_text, source, extra_style)
+    cache_key = ParaphraseCache.make_key(cleaned_text, extra_style, ",".join(get_model_pool()), paraphrase_cache_params())
+    batcher = get_batcher() if allow_batch else None
+    compute = None
+    if batcher is not None:
+        def compute() -> Awaitable[str]:
+            return batcher.paraphrase(cleaned_text, extra_style, api_key, app_url)
+    result = await _complete_cached(cache_key, messages, max_tokens, api_key, app_url, compute, priority)
+    return _finish_paraphrase(result, cleaned_text, source)
+
+
+async def paraphrase_stream(text: str, source: Optional[str], api_key: str, app_url: Optional[str],
+                            extra_style: Optional[str], on_partial: Callable[[str], Awaitable[None]]) -> str:
+    """Как paraphrase(), но сообщает накопленный текст в on_partial по мере генерации."""
     cleaned_text = clean_text(text)
-    prompt = build_paraphrase_prompt(cleaned_text, source, extra_style)
-    result = await asyncio.to_thread(_openrouter_request_sync, prompt, api_key, app_url)
-    
+    messages, max_tokens = build_paraphrase_messages(cleaned_text, source, extra_style)
+    cache_key = ParaphraseCache.make_key(cleaned_text, extra_style, ",".join(get_model_pool()), paraphrase_cache_params())
+    cache = get_paraphrase_cache()
+    result = cache.get(cache_key) if cache is not None else None
+    if not result:
+        parts: List[str] = []
+        async for delta in get_openrouter_client(api_key, app_url).stream(messages, max_tokens, LLM_PRIORITY_EDITOR):
+            parts.append(delta)
+            await on_partial("".join(parts))
+        result = "".join(parts).strip()
+        if result and cache is not None:
+            cache.put(cache_key, result)
+    return _finish_paraphrase(result, cleaned_text, source)
+
+
+def _finish_paraphrase(result: Optional[str], cleaned_text: str, source: Optional[str]) -> str:
     # Если результат пустой, возвращаем исходный текст с пометкой
     if not result or not result.strip():
         return f"[Ошибка API] {cleaned_text}"
@@ -154,6 +1375,71 @@ def resolve_target_chat_id(default_chat_id: Optional[int] = None) -> Optional[in
     return default_chat_id
 
 
+# Маршруты из ROUTES_FILE: (источники, получатели); None — файл не задан
+_routes: Optional[List[Tuple[Set[str], List[Dict[str, Any]]]]] = None
+
+
+def load_routes() -> None:
+    """Читает таблицу маршрутов ROUTES_FILE (JSON):
+
+    {"routes": [{"from": ["@source", "-100123", "*"],
+                 "to": [{"chat_id": -100456, "style": "коротко"}, {"chat_id": 42}]}]}
+
+    Без "style" получатель пересказывается в стиле своего чата (/style).
+    Без файла — один получатель из DEST_USER_ID/TARGET_CHAT_ID, как раньше.
+    """
+    global _routes
+    path = os.getenv("ROUTES_FILE", "").strip()
+    if not path:
+        _routes = None
+        return
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[Routes] cannot load {path}: {e}")
+        _routes = None
+        return
+    routes = []
+    for route in config.get("routes", []):
+        sources = {str(src).strip().lower() for src in route.get("from", [])}
+        targets = []
+        for dest in route.get("to", []):
+            try:
+                targets.append({"chat_id": int(dest["chat_id"]), "style": dest.get("style")})
+            except (KeyError, TypeError, ValueError):
+                print(f"[Routes] bad destination {dest!r}")
+        if sources and targets:
+            routes.append((sources, targets))
+    _routes = routes
+    print(f"[Routes] {len(routes)} routes to {len(route_destinations())} destinations")
+
+
+def route_destinations() -> List[int]:
+    """Все получатели из таблицы маршрутов (для проверки прав при старте и /check)."""
+    seen: Dict[int, None] = {}
+    for _, targets in _routes or []:
+        for target in targets:
+            seen.setdefault(target["chat_id"])
+    return list(seen)
+
+
+def resolve_targets(source_chat_id: int, source_username: Optional[str],
+                    default_chat_id: Optional[int]) -> List[Dict[str, Any]]:
+    """Получатели поста с их стилями; один чат получает пост один раз (первый маршрут выигрывает)."""
+    if _routes is None:
+        return [{"chat_id": default_chat_id, "style": None}] if default_chat_id is not None else []
+    keys = {str(source_chat_id), "*"}
+    if source_username:
+        keys.add(f"@{source_username.lstrip('@').lower()}")
+    targets: Dict[int, Dict[str, Any]] = {}
+    for sources, route_targets in _routes:
+        if sources & keys:
+            for target in route_targets:
+                targets.setdefault(target["chat_id"], dict(target))
+    return list(targets.values())
+
+
 async def can_send_to(bot, chat_id: int) -> bool:
     try:
         await bot.send_chat_action(chat_id=chat_id, action="typing")
@@ -163,16 +1449,384 @@ async def can_send_to(bot, chat_id: int) -> bool:
         return False
 
 
-def ptb_media_suffix(msg) -> str:
-    try:
-        has_photo = bool(getattr(msg, "photo", None))
-        has_video = bool(getattr(msg, "video", None) or getattr(msg, "animation", None))
-        if has_photo and has_video:
-            return " (есть изображение и видео)"
-        if has_video:
-            return " (есть видео)"
-        if has_photo:
-            return " (есть изображение)"
+def is_chat_unavailable_error(e: Exception) -> bool:
+    """Forbidden (бот заблокирован/удалён) или BadRequest «Chat not found»."""
+    if isinstance(e, Forbidden):
+        return True
+    return isinstance(e, BadRequest) and "chat not found" in str(e).lower()
+
+
+def telegram_retry_after(e: RetryAfter) -> float:
+    """RetryAfter.retry_after в секундах (в новых PTB это timedelta)."""
+    value = e.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class SendPermissionCache:
+    """Кеш права писать в чат вместо send_chat_action перед каждым сообщением.
+
+    Положительный ответ живёт ttl секунд, отрицательный — negative_ttl (чтобы быстро
+    заметить, что пользователь нажал /start). Фоновая задача обновляет записи заранее.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._state: Dict[int, Tuple[bool, float]] = {}
+
+    def get(self, chat_id: int) -> Optional[bool]:
+        entry = self._state.get(chat_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, chat_id: int, ok: bool) -> None:
+        ttl = self.ttl if ok else self.negative_ttl
+        self._state[chat_id] = (ok, time.monotonic() + ttl)
+
+    def invalidate(self, chat_id: int) -> None:
+        self._state.pop(chat_id, None)
+
+    async def allowed(self, bot, chat_id: int) -> bool:
+        cached = self.get(chat_id)
+        if cached is not None:
+            return cached
+        return await self.probe(bot, chat_id)
+
+    async def probe(self, bot, chat_id: int) -> bool:
+        """Живая проверка (как /check) с обновлением кеша."""
+        ok = await can_send_to(bot, chat_id)
+        self.set(chat_id, ok)
+        return ok
+
+    async def refresh_loop(self, bot) -> None:
+        while True:
+            await asyncio.sleep(max(5.0, self.negative_ttl / 2))
+            horizon = time.monotonic() + self.negative_ttl
+            for chat_id, (_, expires) in list(self._state.items()):
+                if expires <= horizon:
+                    try:
+                        await self.probe(bot, chat_id)
+                    except Exception as e:
+                        print(f"[Bot] send-permission refresh error for {chat_id}: {e}")
+
+
+def get_send_permissions(app: Application) -> SendPermissionCache:
+    cache = app.bot_data.get("send_permissions")
+    if cache is None:
+        cache = SendPermissionCache(
+            ttl=_env_float("SEND_PERMISSION_TTL", 1800.0),
+            negative_ttl=_env_float("SEND_PERMISSION_NEGATIVE_TTL", 60.0),
+        )
+        app.bot_data["send_permissions"] = cache
+    return cache
+
+
+class MediaCache:
+    """Медиа альбомов для повторной загрузки через send_media_group.
+
+    file_id из Bot API (посты, пришедшие боту) годятся для отправки как есть. Файлы,
+    увиденные через Pyrogram, скачиваются один раз (замок на ключ, байты — в LRU до
+    max_bytes); после первой загрузки запоминается file_id, который выдал Telegram,
+    и остальные получатели получают файл по нему, без скачивания и повторной загрузки.
+    """
+
+    def __init__(self, app: Application, max_bytes: int) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._bot_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.downloads = 0
+
+    @staticmethod
+    def key(item: Dict[str, Any]) -> str:
+        return f"{item['origin']}:{item['chat_id']}:{item['message_id']}"
+
+    async def source(self, item: Dict[str, Any]) -> Any:
+        """Что передать в InputMedia*: file_id Bot API или байты файла."""
+        if item["origin"] == "bot":
+            return item["file_id"]
+        key = self.key(item)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key in self._bot_ids:
+                return self._bot_ids[key]
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+                return data
+            pyro = self.app.bot_data.get("pyrogram_client")
+            if pyro is None:
+                raise RuntimeError("Pyrogram client is not running")
+            buf = await pyro.download_media(item["file_id"], in_memory=True)
+            data = bytes(buf.getbuffer()) if hasattr(buf, "getbuffer") else bytes(buf)
+            self.downloads += 1
+            METRICS.inc("newsbot_media_downloads_total", kind=item["type"])
+            self._store(key, data)
+            return data
+
+    def _store(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        self._data[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, old = self._data.popitem(last=False)
+            self._size -= len(old)
+
+    def remember(self, item: Dict[str, Any], sent) -> None:
+        """Запоминает file_id загруженного файла; байты больше не нужны."""
+        if item["origin"] == "bot" or sent is None:
+            return
+        media = sent.photo[-1] if getattr(sent, "photo", None) else getattr(sent, "video", None)
+        if media is None:
+            return
+        key = self.key(item)
+        self._bot_ids[key] = media.file_id
+        while len(self._bot_ids) > 10000:
+            self._bot_ids.popitem(last=False)
+        data = self._data.pop(key, None)
+        if data is not None:
+            self._size -= len(data)
+        lock = self._locks.get(key)
+        if lock is not None and not lock.locked():
+            del self._locks[key]
+
+
+def get_media_cache(app: Application) -> MediaCache:
+    cache = app.bot_data.get("media_cache")
+    if cache is None:
+        cache = MediaCache(app, max_bytes=max(1, _env_int("MEDIA_CACHE_MB", 64)) * 1024 * 1024)
+        app.bot_data["media_cache"] = cache
+    return cache
+
+
+class OutboundSender:
+    """Исходящие сообщения: по очереди и воркеру на каждый целевой чат.
+
+    Темп ограничен token bucket-ами (≈1 сообщение/с в ЛС, 20/мин в группах и каналах,
+    30/с на бота в целом). RetryAfter выдерживается, сетевые сбои повторяются с
+    экспоненциальной паузой. При preserve_order повтор держит очередь чата, иначе
+    сообщение уходит в конец очереди, не задерживая следующие.
+    Сообщение с media уходит альбомом (send_media_group) с текстом в подписи; если
+    Telegram альбом не принял или медиа недоступны — отправляется просто текст.
+    Сообщение с edit правит уже отправленное (текст или подпись); если править
+    нечего или уже нельзя — уходит новым сообщением.
+    """
+
+    def __init__(self, bot, permissions: SendPermissionCache, private_rate: float, group_rate: float,
+                 max_retries: int, preserve_order: bool, media: Optional[MediaCache] = None) -> None:
+        self.bot = bot
+        self.permissions = permissions
+        self.media = media
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.preserve_order = preserve_order
+        self._global = TokenBucket(rate=30.0, capacity=30.0)
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        # Повторы без preserve_order, ждущие паузы вне очереди чата
+        self._delayed: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def enqueue(self, chat_id: int, text: str, media: Optional[List[Dict[str, Any]]] = None,
+                caption: Optional[str] = None, edit: Optional[Tuple[int, str]] = None) -> "asyncio.Future[Any]":
+        """Ставит сообщение в очередь чата; future завершится отправленным Message или ошибкой.
+
+        caption — подпись альбома, если она отличается от текста для отправки без медиа;
+        edit — (id нашего сообщения, "text" | "caption"), если его нужно отредактировать.
+        """
+        chat_id = int(chat_id)
+        fut: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            rate = self.private_rate if chat_id > 0 else self.group_rate
+            bucket = TokenBucket(rate=rate, capacity=1.0 if chat_id > 0 else 3.0)
+            self._workers[chat_id] = asyncio.create_task(self._worker(queue, bucket))
+        queue.put_nowait({"chat_id": chat_id, "text": text, "media": media, "caption": caption, "edit": edit,
+                          "future": fut, "attempts": 0, "queued_at": time.monotonic()})
+        return fut
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues.values()) + len(self._delayed)
+
+    async def _worker(self, queue: asyncio.Queue, bucket: TokenBucket) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                await self._deliver(queue, item, bucket)
+            except Exception as e:
+                print(f"[Send] worker error: {e}")
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, queue: asyncio.Queue, item: Dict, bucket: TokenBucket) -> None:
+        fut: asyncio.Future = item["future"]
+        chat_id = item["chat_id"]
+        while not fut.done():
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                if item.get("edit"):
+                    msg = await self._edit(chat_id, item)
+                elif item.get("media") and self.media is not None:
+                    msg = await self._send_album(chat_id, item)
+                else:
+                    msg = await self.bot.send_message(chat_id=chat_id, text=item["text"])
+            except RetryAfter as e:
+                wait = telegram_retry_after(e)
+                self.retries += 1
+                METRICS.inc("newsbot_send_retries_total", reason="flood")
+                print(f"[Send] flood control for {chat_id}, waiting {wait:.0f}s")
+                await asyncio.sleep(wait + 0.5)
+                continue
+            except (BadRequest, Forbidden) as e:
+                if item.get("edit") and isinstance(e, BadRequest) and not is_chat_unavailable_error(e):
+                    if "not modified" in str(e).lower():
+                        fut.set_result(None)
+                        return
+                    print(f"[Send] cannot edit message {item['edit'][0]} in {chat_id}: {e}; sending a new one")
+                    item["edit"] = None
+                    continue
+                if item.get("media") and isinstance(e, BadRequest) and not is_chat_unavailable_error(e):
+                    print(f"[Send] album rejected for {chat_id}: {e}; sending text only")
+                    item["media"] = None
+                    continue
+                # Повтор не поможет (текст/права/чат) — отдаём ошибку вызывающему
+                if is_chat_unavailable_error(e):
+                    self.permissions.invalidate(chat_id)
+                self.failed += 1
+                METRICS.inc("newsbot_send_failures_total", reason="forbidden" if isinstance(e, Forbidden) else "bad_request")
+                fut.set_exception(e)
+                return
+            except NetworkError as e:
+                item["attempts"] += 1
+                if item["attempts"] > self.max_retries:
+                    self.failed += 1
+                    METRICS.inc("newsbot_send_failures_total", reason="network")
+                    fut.set_exception(e)
+                    return
+                self.retries += 1
+                METRICS.inc("newsbot_send_retries_total", reason="network")
+                delay = min(60.0, 2.0 ** item["attempts"])
+                print(f"[Send] transient error for {chat_id} (attempt {item['attempts']}): {e}; retry in {delay:.0f}s")
+                if not self.preserve_order:
+                    task = asyncio.create_task(self._retry_later(queue, item, delay))
+                    self._delayed.add(task)
+                    task.add_done_callback(self._delayed.discard)
+                    return
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                self.failed += 1
+                METRICS.inc("newsbot_send_failures_total", reason="other")
+                fut.set_exception(e)
+                return
+            self.sent += 1
+            METRICS.observe("newsbot_send_seconds", time.monotonic() - item["queued_at"],
+                            chat_type="private" if chat_id > 0 else "group")
+            fut.set_result(msg)
+
+    @staticmethod
+    async def _retry_later(queue: asyncio.Queue, item: Dict, delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            item["future"].cancel()
+            raise
+        queue.put_nowait(item)
+
+    async def _edit(self, chat_id: int, item: Dict) -> Any:
+        message_id, kind = item["edit"]
+        if kind == "caption":
+            return await self.bot.edit_message_caption(chat_id=chat_id, message_id=message_id,
+                                                       caption=item.get("caption") or item["text"])
+        return await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=item["text"])
+
+    async def _send_album(self, chat_id: int, item: Dict) -> Any:
+        """Альбом с подписью на первом элементе; подпись длиннее 1024 символов уходит
+        следующим сообщением. Возвращает сообщение с текстом."""
+        assert self.media is not None
+        caption = item.get("caption") or item["text"]
+        fits = len(caption) <= 1024
+        try:
+            sources = [await self.media.source(m) for m in item["media"]]
+        except Exception as e:
+            print(f"[Send] album media unavailable for {chat_id}: {e}; sending text only")
+            item["media"] = None
+            return await self.bot.send_message(chat_id=chat_id, text=item["text"])
+        group = []
+        for i, (m, src) in enumerate(zip(item["media"], sources)):
+            cls = InputMediaPhoto if m["type"] == "photo" else InputMediaVideo
+            group.append(cls(media=src, caption=caption if i == 0 and fits else None))
+        sent = await self.bot.send_media_group(chat_id=chat_id, media=group)
+        for m, msg in zip(item["media"], sent):
+            self.media.remember(m, msg)
+        # Альбом уже ушёл: повтор после RetryAfter/сбоя сети отправит только текст
+        item["media"] = None
+        if fits:
+            return sent[0]
+        item["text"] = caption
+        return await self.bot.send_message(chat_id=chat_id, text=caption)
+
+    async def drain(self) -> None:
+        """Ждёт отправки всего, что уже стоит в очередях, включая отложенные повторы."""
+        while True:
+            if self._delayed:
+                await asyncio.gather(*list(self._delayed), return_exceptions=True)
+            for queue in list(self._queues.values()):
+                await queue.join()
+            if not self._delayed:
+                return
+
+    async def close(self) -> None:
+        """Останавливает воркеры; future неотправленных сообщений отменяются
+        (задания остаются в NEWSBOT_DB и продолжатся при следующем запуске)."""
+        tasks = list(self._workers.values()) + list(self._delayed)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for queue in self._queues.values():
+            while not queue.empty():
+                queue.get_nowait()["future"].cancel()
+        self._workers.clear()
+        self._queues.clear()
+
+
+def get_outbound_sender(app: Application) -> OutboundSender:
+    sender = app.bot_data.get("outbound_sender")
+    if sender is None:
+        sender = OutboundSender(
+            app.bot,
+            get_send_permissions(app),
+            private_rate=_env_float("SEND_RATE_PRIVATE", 1.0),
+            group_rate=_env_float("SEND_RATE_GROUP_PER_MIN", 20.0) / 60.0,
+            max_retries=max(0, _env_int("SEND_MAX_RETRIES", 5)),
+            preserve_order=os.getenv("SEND_PRESERVE_ORDER", "1").strip() != "0",
+            media=get_media_cache(app),
+        )
+        METRICS.register_gauge("newsbot_queue_depth", lambda: [({"queue": "outbound"}, sender.pending())],
+                               key="outbound")
+        app.bot_data["outbound_sender"] = sender
+    return sender
+
+
+def ptb_media_suffix(msg) -> str:
+    try:
+        has_photo = bool(getattr(msg, "photo", None))
+        has_video = bool(getattr(msg, "video", None) or getattr(msg, "animation", None))
+        if has_photo and has_video:
+            return " (есть изображение и видео)"
+        if has_video:
+            return " (есть видео)"
+        if has_photo:
+            return " (есть изображение)"
     except Exception:
         pass
     return ""
@@ -193,26 +1847,1079 @@ def pyro_media_suffix(message) -> str:
     return ""
 
 
+# Что можно отправить одним альбомом через send_media_group
+ALBUM_MEDIA_TYPES = ("photo", "video")
+
+
+def _media_item(msg, origin: str, chat_id: int, message_id: int) -> Optional[Dict[str, Any]]:
+    photo = getattr(msg, "photo", None)
+    if isinstance(photo, (list, tuple)):
+        # Bot API присылает все размеры фото, последний — самый большой
+        photo = photo[-1] if photo else None
+    for kind, obj in (("photo", photo), ("video", getattr(msg, "video", None)),
+                      ("animation", getattr(msg, "animation", None)), ("document", getattr(msg, "document", None))):
+        if obj:
+            return {"type": kind, "file_id": obj.file_id, "origin": origin, "chat_id": chat_id, "message_id": message_id}
+    return None
+
+
+def pyro_media_item(message) -> Optional[Dict[str, Any]]:
+    return _media_item(message, "pyrogram", message.chat.id, message.id)
+
+
+def ptb_media_item(msg) -> Optional[Dict[str, Any]]:
+    return _media_item(msg, "bot", msg.chat_id, msg.message_id)
+
+
+def album_media_suffix(media: List[Dict[str, Any]]) -> str:
+    has_photo = any(m["type"] == "photo" for m in media)
+    has_video = any(m["type"] in ("video", "animation") for m in media)
+    if has_photo and has_video:
+        return " (есть изображение и видео)"
+    if has_video:
+        return " (есть видео)"
+    if has_photo:
+        return " (есть изображение)"
+    return ""
+
+
+class MediaGroupCollector:
+    """Собирает сообщения одного альбома (media_group_id) в один пост.
+
+    Telegram присылает каждую часть альбома отдельным сообщением, одну за другой.
+    Альбом считается собранным, когда window секунд не было новых частей, но не
+    позже max_wait от первой; тогда части целиком уходят в on_album.
+    """
+
+    def __init__(self, window: float, max_wait: float, on_album: Callable[[List[Any]], Awaitable[None]]) -> None:
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.on_album = on_album
+        self._groups: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add(self, chat_id: int, group_id: Any, message: Any) -> None:
+        loop = asyncio.get_running_loop()
+        key = (chat_id, str(group_id))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {"parts": [], "started": loop.time(), "timer": None}
+        group["parts"].append(message)
+        if group["timer"] is not None:
+            group["timer"].cancel()
+        delay = min(self.window, max(0.0, group["started"] + self.max_wait - loop.time()))
+        group["timer"] = loop.call_later(delay, self._flush, key)
+
+    def pending(self) -> int:
+        return len(self._groups)
+
+    def _flush(self, key: Tuple[int, str]) -> None:
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        task = asyncio.create_task(self._emit(key, group["parts"]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _emit(self, key: Tuple[int, str], parts: List[Any]) -> None:
+        try:
+            await self.on_album(parts)
+        except Exception as e:
+            print(f"[Album] chat={key[0]} group={key[1]} error: {e}")
+
+    async def close(self) -> None:
+        """Отдаёт недособранные альбомы как есть и ждёт их постановки в конвейер."""
+        for key in list(self._groups):
+            self._groups[key]["timer"].cancel()
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class PollScheduler:
+    """Адаптивное расписание fallback-опроса каналов.
+
+    Интервал канала — половина сглаженного промежутка между его постами в пределах
+    [min_interval, max_interval]; если посты канала исправно приходят push-ом,
+    интервал растягивается в push_factor раз.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, push_factor: float) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.push_factor = push_factor
+        self._state: Dict[int, Dict[str, float]] = {}
+
+    def _get(self, cid: int) -> Dict[str, float]:
+        st = self._state.get(cid)
+        if st is None:
+            # Новый канал опрашиваем сразу; промежуток между постами пока не знаем
+            st = {"next": 0.0, "gap": self.max_interval, "last_post": 0.0, "last_push": 0.0}
+            self._state[cid] = st
+        return st
+
+    def note_post(self, cid: int, posted_at: Optional[float] = None) -> None:
+        st = self._get(cid)
+        ts = posted_at or time.time()
+        if st["last_post"] and ts > st["last_post"]:
+            st["gap"] = 0.7 * st["gap"] + 0.3 * (ts - st["last_post"])
+        st["last_post"] = max(st["last_post"], ts)
+
+    def note_push(self, cid: int, posted_at: Optional[float] = None) -> None:
+        self.note_post(cid, posted_at)
+        self._get(cid)["last_push"] = time.time()
+
+    def interval(self, cid: int) -> float:
+        st = self._get(cid)
+        iv = min(self.max_interval, max(self.min_interval, st["gap"] / 2))
+        if time.time() - st["last_push"] < max(3 * st["gap"], 300.0):
+            iv = min(self.max_interval, iv * self.push_factor)
+        return iv
+
+    def due(self, cids: List[int]) -> List[int]:
+        now = time.time()
+        return [cid for cid in cids if self._get(cid)["next"] <= now]
+
+    def schedule(self, cid: int) -> None:
+        self._get(cid)["next"] = time.time() + self.interval(cid)
+
+    def forget(self, cid: int) -> None:
+        self._state.pop(cid, None)
+
+
+class WatermarkStore:
+    """Постоянные отметки обработанных постов по каналам.
+
+    claim() атомарно «забирает» пару (channel_id, message_id) перед обработкой, поэтому
+    push-обработчики и fallback-опрос (в т.ч. после перезапуска) не обрабатывают пост дважды.
+    Обработан ли пост, отвечает только is_processed(): high_id — верхняя отметка, а не
+    граница обработанного (ниже неё бывают пропущенные push-ом и снятые после сбоя посты).
+    """
+
+    def __init__(self, conn: sqlite3.Connection, keep_per_chat: int) -> None:
+        self._conn = conn
+        self.keep_per_chat = keep_per_chat
+        self._claims = 0
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_posts ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, claimed_at REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID"
+        )
+        # high_id — самый новый взятый в работу пост; floor_id — ниже него история уже подрезана
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            "chat_id INTEGER PRIMARY KEY, high_id INTEGER NOT NULL, floor_id INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(watermarks)")}
+        if "last_id" in columns:
+            # Прежнее имя подсказывало «всё до сих пор обработано», что неверно
+            conn.execute("ALTER TABLE watermarks RENAME COLUMN last_id TO high_id")
+        # checked_id — докуда fallback-опрос просмотрел историю канала (ниже он не перечитывает)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS backfill_checked (chat_id INTEGER PRIMARY KEY, checked_id INTEGER NOT NULL)"
+        )
+        # Посты, с которых сняли отметку после сбоя: fallback-опрос берёт их снова
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS released_posts ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, attempts INTEGER NOT NULL, "
+            "released_at REAL NOT NULL, PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID"
+        )
+
+    def claim(self, chat_id: int, message_id: int) -> bool:
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT floor_id FROM watermarks WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is not None and message_id < row[0]:
+                conn.execute("COMMIT")
+                return False
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO processed_posts (chat_id, message_id, claimed_at) VALUES (?, ?, ?)",
+                (chat_id, message_id, time.time()),
+            )
+            if cur.rowcount == 0:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO watermarks (chat_id, high_id) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET high_id = MAX(high_id, excluded.high_id)",
+                (chat_id, message_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._claims += 1
+        if self._claims % 200 == 0:
+            self.prune()
+        return True
+
+    def release(self, chat_id: int, message_id: int) -> None:
+        """Снимает отметку, если пост не удалось обработать, — его можно будет взять снова
+        (fallback-опрос догоняет такие посты, см. retry_ids)."""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM processed_posts WHERE chat_id = ? AND message_id = ?", (chat_id, message_id))
+            conn.execute(
+                "INSERT INTO released_posts (chat_id, message_id, attempts, released_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(chat_id, message_id) DO UPDATE SET attempts = attempts + 1, released_at = excluded.released_at",
+                (chat_id, message_id, time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def retry_ids(self, chat_id: int, max_attempts: int, since: float) -> Set[int]:
+        """Снятые после сбоя и ещё не взятые снова посты канала (не больше max_attempts попыток)."""
+        rows = self._conn.execute(
+            "SELECT message_id FROM released_posts r WHERE chat_id = ? AND attempts <= ? AND released_at >= ? "
+            "AND NOT EXISTS (SELECT 1 FROM processed_posts p WHERE p.chat_id = r.chat_id AND p.message_id = r.message_id)",
+            (chat_id, max_attempts, since),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def exhausted_ids(self, chat_id: int, max_attempts: int) -> Set[int]:
+        """Снятые после сбоя посты канала, попытки которых исчерпаны: их больше не берём."""
+        rows = self._conn.execute(
+            "SELECT message_id FROM released_posts WHERE chat_id = ? AND attempts > ?", (chat_id, max_attempts)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def is_processed(self, chat_id: int, message_id: int) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM processed_posts WHERE chat_id = ? AND message_id = ? "
+            "UNION ALL SELECT 1 FROM watermarks WHERE chat_id = ? AND floor_id > ?",
+            (chat_id, message_id, chat_id, message_id),
+        ).fetchone()
+        return row is not None
+
+    def floor_id(self, chat_id: int) -> int:
+        """Ниже этого id отметки подрезаны (prune): такие посты считаются обработанными."""
+        row = self._conn.execute("SELECT floor_id FROM watermarks WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def checked_id(self, chat_id: int) -> Optional[int]:
+        """Докуда догон уже просмотрел историю канала (None — ещё ни разу)."""
+        row = self._conn.execute("SELECT checked_id FROM backfill_checked WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_checked(self, chat_id: int, message_id: int) -> None:
+        self._conn.execute(
+            "INSERT INTO backfill_checked (chat_id, checked_id) VALUES (?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET checked_id = MAX(checked_id, excluded.checked_id)",
+            (chat_id, message_id),
+        )
+
+    def high_id(self, chat_id: int) -> Optional[int]:
+        """Самый новый взятый в работу пост канала (None — канал ещё не видели).
+
+        Не граница обработанного: посты ниже могут быть не взяты, см. is_processed().
+        """
+        row = self._conn.execute("SELECT high_id FROM watermarks WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def prune(self) -> None:
+        """Оставляет по keep_per_chat последних отметок на канал и поднимает floor_id."""
+        conn = self._conn
+        for (chat_id,) in conn.execute("SELECT chat_id FROM watermarks").fetchall():
+            row = conn.execute(
+                "SELECT message_id FROM processed_posts WHERE chat_id = ? "
+                "ORDER BY message_id DESC LIMIT 1 OFFSET ?",
+                (chat_id, self.keep_per_chat),
+            ).fetchone()
+            if row is None:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM processed_posts WHERE chat_id = ? AND message_id <= ?", (chat_id, row[0]))
+                conn.execute("UPDATE watermarks SET floor_id = MAX(floor_id, ?) WHERE chat_id = ?",
+                             (row[0] + 1, chat_id))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        conn.execute("DELETE FROM released_posts WHERE released_at < ?", (time.time() - 7 * 86400,))
+
+
+_watermark_store: Optional[WatermarkStore] = None
+
+
+def get_watermark_store() -> WatermarkStore:
+    global _watermark_store
+    if _watermark_store is None:
+        _watermark_store = WatermarkStore(get_db(), keep_per_chat=max(100, _env_int("WATERMARK_KEEP_PER_CHAT", 2000)))
+    return _watermark_store
+
+
+class PostFingerprintStore:
+    """Отпечатки обработанных постов и наши сообщения по ним — для обработки правок.
+
+    Отпечаток — хэш нормализованного текста и crc32 его слов (≈4 байта на слово).
+    Правка идёт в пересказ, только если доля изменённых слов (1 − ratio по
+    SequenceMatcher) не меньше порога: исправленная опечатка, добавленная ссылка или
+    другой эмодзи не стоят нового запроса к LLM и нового сообщения.
+    """
+
+    _WORD_RE = re.compile(r"\w+")
+    MAX_WORDS = 2000
+
+    def __init__(self, conn: sqlite3.Connection, retention: float) -> None:
+        self._conn = conn
+        self.retention = retention
+        self._writes = 0
+        # sent — JSON [[chat_id, message_id, "text" | "caption"], ...]: куда и каким сообщением пост уже ушёл
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS post_fingerprints ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, digest TEXT NOT NULL, words BLOB NOT NULL, "
+            "sent TEXT NOT NULL DEFAULT '[]', updated_at REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID"
+        )
+
+    @classmethod
+    def fingerprint(cls, text: str) -> Tuple[str, array]:
+        words = cls._WORD_RE.findall(text.lower())[:cls.MAX_WORDS]
+        digest = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8).hexdigest()
+        return digest, array("I", (zlib.crc32(w.encode("utf-8")) for w in words))
+
+    def change_ratio(self, chat_id: int, message_id: int, text: str) -> Optional[float]:
+        """Доля изменений относительно запомненной версии; None — пост не запомнен."""
+        row = self._conn.execute(
+            "SELECT digest, words FROM post_fingerprints WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        ).fetchone()
+        if row is None:
+            return None
+        digest, words = self.fingerprint(text)
+        if digest == row[0]:
+            return 0.0
+        old = array("I")
+        old.frombytes(row[1])
+        return 1.0 - difflib.SequenceMatcher(None, old, words, autojunk=False).ratio()
+
+    def remember(self, chat_id: int, message_id: int, text: str) -> None:
+        digest, words = self.fingerprint(text)
+        self._conn.execute(
+            "INSERT INTO post_fingerprints (chat_id, message_id, digest, words, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id, message_id) DO UPDATE SET digest = excluded.digest, words = excluded.words, "
+            "updated_at = excluded.updated_at",
+            (chat_id, message_id, digest, words.tobytes(), time.time()),
+        )
+        self._writes += 1
+        if self._writes % 200 == 0:
+            self.prune()
+
+    def add_sent(self, chat_id: int, message_id: int, dest_chat_id: int, sent_id: int, kind: str) -> None:
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT sent FROM post_fingerprints WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+            ).fetchone()
+            if row is not None:
+                sent = [s for s in json.loads(row[0]) if s[0] != dest_chat_id] + [[dest_chat_id, sent_id, kind]]
+                conn.execute(
+                    "UPDATE post_fingerprints SET sent = ? WHERE chat_id = ? AND message_id = ?",
+                    (json.dumps(sent), chat_id, message_id),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def sent(self, chat_id: int, message_id: int) -> Dict[int, Tuple[int, str]]:
+        """Наши сообщения по посту: получатель -> (id сообщения, "text" | "caption")."""
+        row = self._conn.execute(
+            "SELECT sent FROM post_fingerprints WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        ).fetchone()
+        return {s[0]: (s[1], s[2]) for s in json.loads(row[0])} if row else {}
+
+    def prune(self) -> None:
+        self._conn.execute("DELETE FROM post_fingerprints WHERE updated_at < ?", (time.time() - self.retention,))
+
+
+_fingerprint_store: Optional[PostFingerprintStore] = None
+
+
+def get_fingerprint_store() -> PostFingerprintStore:
+    global _fingerprint_store
+    if _fingerprint_store is None:
+        _fingerprint_store = PostFingerprintStore(get_db(), retention=_env_float("EDIT_TRACK_SEC", 7 * 86400.0))
+    return _fingerprint_store
+
+
+class ChannelCache:
+    """Разрешённые каналы WATCH_CHANNELS (username -> id), чтобы при старте не делать
+    join_chat/get_chat заново для каждого канала. Запись старше ttl разрешается снова.
+
+    Ключ — сессия Pyrogram и username: у каждой сессии (у воркеров шардов — своя)
+    свой кеш пиров, и канал, разрешённый другой сессией, для неё ещё неизвестен.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, ttl: float) -> None:
+        self._conn = conn
+        self.ttl = ttl
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(channels)")}
+        if columns and "session" not in columns:
+            # Кеш без сессии (прежний формат) — просто разрешим каналы заново
+            conn.execute("DROP TABLE channels")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS channels ("
+            "session TEXT NOT NULL, username TEXT NOT NULL, chat_id INTEGER NOT NULL, title TEXT, "
+            "resolved_at REAL NOT NULL, PRIMARY KEY (session, username))"
+        )
+
+    def get(self, session: str, username: str) -> Optional[int]:
+        row = self._conn.execute(
+            "SELECT chat_id FROM channels WHERE session = ? AND username = ? AND resolved_at >= ?",
+            (session, username.lower(), time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, session: str, username: str, chat_id: int, title: Optional[str]) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO channels (session, username, chat_id, title, resolved_at) VALUES (?, ?, ?, ?, ?)",
+            (session, username.lower(), chat_id, title, time.time()),
+        )
+
+    def forget(self, session: str, chat_id: int) -> None:
+        self._conn.execute("DELETE FROM channels WHERE session = ? AND chat_id = ?", (session, chat_id))
+
+
+_channel_cache: Optional[ChannelCache] = None
+
+
+def get_channel_cache() -> ChannelCache:
+    global _channel_cache
+    if _channel_cache is None:
+        _channel_cache = ChannelCache(get_db(), ttl=_env_float("CHANNEL_CACHE_TTL", 7 * 86400.0))
+    return _channel_cache
+
+
+class ConsistentHashRing:
+    """Кольцо согласованного хеширования: канал -> номер шарда.
+
+    У каждого шарда vnodes точек на кольце, поэтому каналы делятся примерно поровну,
+    а при изменении SHARD_COUNT к другому шарду переезжает лишь ~1/N каналов.
+    """
+
+    def __init__(self, nodes: int, vnodes: int = 160) -> None:
+        points = sorted((self._hash(f"shard-{node}#{v}"), node) for node in range(nodes) for v in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def node_for(self, key: str) -> int:
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+# Номер шарда, если процесс запущен воркером (python bot.py --shard N)
+_shard_index: Optional[int] = None
+
+
+def get_shard_count() -> int:
+    """SHARD_COUNT > 1 — каналы WATCH_CHANNELS делятся между процессами-воркерами."""
+    return max(1, _env_int("SHARD_COUNT", 1))
+
+
+def is_shard_worker() -> bool:
+    return _shard_index is not None
+
+
+def is_shard_coordinator() -> bool:
+    return _shard_index is None and get_shard_count() > 1
+
+
+def shard_channels(usernames: List[str]) -> List[str]:
+    """Каналы, которые достались этому воркеру."""
+    ring = ConsistentHashRing(get_shard_count())
+    return [u for u in usernames if ring.node_for(u.lower()) == _shard_index]
+
+
+class JobStore:
+    """Постоянная очередь заданий конвейера: received → paraphrased → sent.
+
+    Задание арендуется процессом (owner, lease_until) и продлевается, пока процесс жив.
+    После падения аренда истекает, и задание продолжается с сохранённого шага:
+    готовый пересказ не запрашивается повторно, а пост не теряется.
+    """
+
+    ACTIVE_STATES = ("received", "paraphrased")
+
+    def __init__(self, conn: sqlite3.Connection, lease: float, retention: float) -> None:
+        self._conn = conn
+        self.lease = lease
+        self.retention = retention
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT NOT NULL, payload TEXT NOT NULL, "
+            "owner TEXT, lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+            "updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_lease ON jobs(state, lease_until)")
+
+    def create(self, payload: Dict) -> int:
+        now = time.time()
+        cur = self._conn.execute(
+            "INSERT INTO jobs (state, payload, owner, lease_until, updated_at) VALUES ('received', ?, ?, ?, ?)",
+            (json.dumps(payload, ensure_ascii=False), self.owner, now + self.lease, now),
+        )
+        return cur.lastrowid
+
+    def update(self, job_id: int, state: str, payload: Optional[Dict] = None) -> None:
+        if payload is None:
+            self._conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), job_id))
+        else:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, payload = ?, updated_at = ? WHERE id = ?",
+                (state, json.dumps(payload, ensure_ascii=False), time.time(), job_id),
+            )
+
+    def delete(self, job_id: int) -> None:
+        self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def renew(self) -> None:
+        self._conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND state IN ('received', 'paraphrased')",
+            (time.time() + self.lease, self.owner),
+        )
+
+    def release_owned(self) -> int:
+        """Отдаёт незавершённые задания процесса: следующий запуск подберёт их сразу,
+        не дожидаясь конца аренды."""
+        cur = self._conn.execute(
+            "UPDATE jobs SET lease_until = 0 WHERE owner = ? AND state IN ('received', 'paraphrased')", (self.owner,)
+        )
+        return cur.rowcount
+
+    def hand_off(self, job_id: int, payload: Dict) -> None:
+        """Шард-воркер отдаёт пересказанное задание координатору: без владельца и аренды,
+        координатор забирает его через lease_expired."""
+        self._conn.execute(
+            "UPDATE jobs SET state = 'paraphrased', payload = ?, owner = NULL, lease_until = 0, updated_at = ? "
+            "WHERE id = ?",
+            (json.dumps(payload, ensure_ascii=False), time.time(), job_id),
+        )
+
+    def lease_expired(self, limit: int = 100, states: Tuple[str, ...] = ACTIVE_STATES) -> List[Tuple[int, str, Dict]]:
+        """Забирает задания, аренда которых истекла (процесс-владелец упал или отдал их)."""
+        conn = self._conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT id, state, payload FROM jobs WHERE state IN ({','.join('?' * len(states))}) "
+                "AND lease_until < ? ORDER BY id LIMIT ?",
+                (*states, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                [(self.owner, now + self.lease, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [(job_id, state, json.loads(payload)) for job_id, state, payload in rows]
+
+    def prune(self) -> None:
+        self._conn.execute(
+            "DELETE FROM jobs WHERE state = 'sent' AND updated_at < ?", (time.time() - self.retention,)
+        )
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+_job_store: Optional[JobStore] = None
+
+
+def get_job_store() -> JobStore:
+    global _job_store
+    if _job_store is None:
+        _job_store = JobStore(
+            get_db(),
+            lease=max(10.0, _env_float("JOB_LEASE_SEC", 60.0)),
+            retention=_env_float("JOB_RETENTION_SEC", 86400.0),
+        )
+    return _job_store
+
+
+class NearDuplicateIndex:
+    """Поиск почти-дубликатов: MinHash по шинглам слов + LSH-корзины.
+
+    Хранит подписи недавних постов в скользящем окне по времени и не больше
+    max_items записей (≈0.4 КБ на пост), так что десятки тысяч постов укладываются
+    в десяток мегабайт.
+    """
+
+    _PRIME = (1 << 61) - 1
+    _WORD_RE = re.compile(r"\w+")
+    _NOISE_RE = re.compile(r"@\w+|https?://\S+|t\.me/\S+")
+
+    def __init__(self, threshold: float, window: float, max_items: int,
+                 num_perm: int = 64, bands: int = 16, shingle_size: int = 3) -> None:
+        self.threshold = threshold
+        self.window = window
+        self.max_items = max_items
+        self.shingle_size = shingle_size
+        self._rows = num_perm // bands
+        self._bands = bands
+        rnd = random.Random(20240501)
+        self._perms = [(rnd.randrange(1, self._PRIME), rnd.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        # key -> (время добавления, подпись, ключи LSH-корзин)
+        self._entries: "OrderedDict[str, Tuple[float, array, array]]" = OrderedDict()
+        self._buckets: Dict[int, Set[str]] = {}
+        self.dropped = 0
+
+    def _shingles(self, text: str) -> Set[int]:
+        words = self._WORD_RE.findall(self._NOISE_RE.sub(" ", text.lower()))
+        n = self.shingle_size
+        if len(words) < n:
+            grams = [" ".join(words)] if words else []
+        else:
+            grams = [" ".join(words[i:i + n]) for i in range(len(words) - n + 1)]
+        return {zlib.crc32(g.encode("utf-8")) for g in grams}
+
+    def _signature(self, shingles: Set[int]) -> array:
+        p = self._PRIME
+        return array("I", (min((a * x + b) % p for x in shingles) & 0xFFFFFFFF for a, b in self._perms))
+
+    def _band_keys(self, sig: array) -> array:
+        r = self._rows
+        return array("q", (hash((i,) + tuple(sig[i * r:(i + 1) * r])) for i in range(self._bands)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for bk in entry[2]:
+            bucket = self._buckets.get(bk)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[bk]
+
+    def _expire(self, now: float) -> None:
+        while self._entries:
+            key, (ts, _, _) = next(iter(self._entries.items()))
+            if ts >= now - self.window and len(self._entries) <= self.max_items:
+                break
+            self._remove(key)
+
+    def check_and_add(self, key: str, text: str) -> Optional[str]:
+        """Возвращает ключ похожего поста из окна или запоминает текст под key и возвращает None."""
+        shingles = self._shingles(text)
+        if not shingles:
+            return None
+        now = time.time()
+        self._expire(now)
+        sig = self._signature(shingles)
+        bands = self._band_keys(sig)
+        candidates: Set[str] = set()
+        for bk in bands:
+            candidates.update(self._buckets.get(bk, ()))
+        candidates.discard(key)
+        total = len(sig)
+        for other in candidates:
+            other_sig = self._entries[other][1]
+            same = sum(1 for x, y in zip(sig, other_sig) if x == y)
+            if same / total >= self.threshold:
+                self.dropped += 1
+                return other
+        self._remove(key)
+        self._entries[key] = (now, sig, bands)
+        for bk in bands:
+            self._buckets.setdefault(bk, set()).add(key)
+        return None
+
+    def discard(self, key: str) -> None:
+        self._remove(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedDuplicateIndex(NearDuplicateIndex):
+    """Тот же MinHash/LSH, но подписи и корзины лежат в NEWSBOT_DB: почти-дубликаты
+    ловятся между процессами-шардами. Проверка и запись — одной транзакцией."""
+
+    def __init__(self, conn: sqlite3.Connection, threshold: float, window: float, max_items: int) -> None:
+        super().__init__(threshold, window, max_items)
+        self._conn = conn
+        self._adds = 0
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedupe_entries (key TEXT PRIMARY KEY, added_at REAL NOT NULL, sig BLOB NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedupe_bands (band INTEGER NOT NULL, key TEXT NOT NULL, "
+            "PRIMARY KEY (band, key)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS dedupe_entries_added ON dedupe_entries(added_at)")
+
+    def check_and_add(self, key: str, text: str) -> Optional[str]:
+        shingles = self._shingles(text)
+        if not shingles:
+            return None
+        now = time.time()
+        sig = self._signature(shingles)
+        bands = self._band_keys(sig)
+        total = len(sig)
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT e.key, e.sig FROM dedupe_entries e WHERE e.added_at >= ? AND e.key != ? AND e.key IN "
+                f"(SELECT key FROM dedupe_bands WHERE band IN ({','.join('?' * len(bands))}))",
+                (now - self.window, key, *bands),
+            ).fetchall()
+            for other, raw in rows:
+                other_sig = array("I")
+                other_sig.frombytes(raw)
+                same = sum(1 for x, y in zip(sig, other_sig) if x == y)
+                if same / total >= self.threshold:
+                    conn.execute("COMMIT")
+                    self.dropped += 1
+                    return other
+            conn.execute("DELETE FROM dedupe_bands WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO dedupe_entries (key, added_at, sig) VALUES (?, ?, ?)",
+                         (key, now, sig.tobytes()))
+            conn.executemany("INSERT OR IGNORE INTO dedupe_bands (band, key) VALUES (?, ?)", [(bk, key) for bk in bands])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._adds += 1
+        if self._adds % 200 == 0:
+            self._expire(now)
+        return None
+
+    def _expire(self, now: float) -> None:
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM dedupe_entries WHERE added_at < ? OR key IN ("
+                "SELECT key FROM dedupe_entries ORDER BY added_at DESC LIMIT -1 OFFSET ?)",
+                (now - self.window, self.max_items),
+            )
+            conn.execute("DELETE FROM dedupe_bands WHERE key NOT IN (SELECT key FROM dedupe_entries)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def discard(self, key: str) -> None:
+        self._conn.execute("DELETE FROM dedupe_entries WHERE key = ?", (key,))
+        self._conn.execute("DELETE FROM dedupe_bands WHERE key = ?", (key,))
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM dedupe_entries").fetchone()[0]
+
+
+def get_duplicate_index(app: Application) -> Optional[NearDuplicateIndex]:
+    threshold = _env_float("DEDUP_THRESHOLD", 0.7)
+    if threshold <= 0:
+        return None
+    index = app.bot_data.get("duplicate_index")
+    if index is None:
+        params = dict(
+            threshold=min(threshold, 1.0),
+            window=_env_float("DEDUP_WINDOW_SEC", 6 * 3600.0),
+            max_items=max(1, _env_int("DEDUP_MAX_ITEMS", 50000)),
+        )
+        # При шардировании один и тот же сюжет может прийти в каналы разных воркеров
+        index = SharedDuplicateIndex(get_db(), **params) if get_shard_count() > 1 else NearDuplicateIndex(**params)
+        app.bot_data["duplicate_index"] = index
+    return index
+
+
+StateKey = Tuple[str, int]
+
+
+class StateBackend(abc.ABC):
+    """Хранилище состояния чатов за ChatStateStore: загрузка целиком и пакетная запись."""
+
+    @abc.abstractmethod
+    def load(self) -> List[Tuple[str, int, Any, float]]:
+        ...
+
+    @abc.abstractmethod
+    def save(self, upserts: List[Tuple[str, int, Any, float]], deletes: List[StateKey]) -> None:
+        ...
+
+    def prune(self, kind: str, keep: int, older_than: float) -> None:
+        pass
+
+
+class SqliteStateBackend(StateBackend):
+    """Таблица chat_state в NEWSBOT_DB. Своё подключение — запись идёт из фонового потока."""
+
+    def __init__(self, path: Path) -> None:
+        self._conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_state ("
+            "kind TEXT NOT NULL, chat_id INTEGER NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (kind, chat_id))"
+        )
+
+    def load(self) -> List[Tuple[str, int, Any, float]]:
+        rows = self._conn.execute("SELECT kind, chat_id, value, updated_at FROM chat_state ORDER BY updated_at").fetchall()
+        return [(kind, chat_id, json.loads(value), updated_at) for kind, chat_id, value, updated_at in rows]
+
+    def save(self, upserts: List[Tuple[str, int, Any, float]], deletes: List[StateKey]) -> None:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chat_state (kind, chat_id, value, updated_at) VALUES (?, ?, ?, ?)",
+                [(kind, chat_id, json.dumps(value, ensure_ascii=False), ts) for kind, chat_id, value, ts in upserts],
+            )
+            self._conn.executemany("DELETE FROM chat_state WHERE kind = ? AND chat_id = ?", deletes)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def prune(self, kind: str, keep: int, older_than: float) -> None:
+        self._conn.execute("DELETE FROM chat_state WHERE kind = ? AND updated_at < ?", (kind, older_than))
+        self._conn.execute(
+            "DELETE FROM chat_state WHERE kind = ? AND chat_id IN ("
+            "SELECT chat_id FROM chat_state WHERE kind = ? ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (kind, kind, keep),
+        )
+
+
+class JsonFileStateBackend(StateBackend):
+    """JSON-файл, переписываемый целиком через временный файл (атомарно)."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._data: Dict[str, List] = {}
+
+    def load(self) -> List[Tuple[str, int, Any, float]]:
+        try:
+            self._data = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            self._data = {}
+        entries = []
+        for key, (value, ts) in self._data.items():
+            kind, chat_id = key.split(":", 1)
+            entries.append((kind, int(chat_id), value, ts))
+        return sorted(entries, key=lambda e: e[3])
+
+    def save(self, upserts: List[Tuple[str, int, Any, float]], deletes: List[StateKey]) -> None:
+        for kind, chat_id, value, ts in upserts:
+            self._data[f"{kind}:{chat_id}"] = [value, ts]
+        for kind, chat_id in deletes:
+            self._data.pop(f"{kind}:{chat_id}", None)
+        self._dump()
+
+    def prune(self, kind: str, keep: int, older_than: float) -> None:
+        prefix = f"{kind}:"
+        keys = sorted((k for k in self._data if k.startswith(prefix)), key=lambda k: self._data[k][1], reverse=True)
+        stale = [k for i, k in enumerate(keys) if i >= keep or self._data[k][1] < older_than]
+        if stale:
+            for k in stale:
+                del self._data[k]
+            self._dump()
+
+    def _dump(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self._data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+class ChatStateStore:
+    """Стиль (/style) и последний вход (/revise) по чатам.
+
+    Чтения и записи идут только в память (один поток событий — без блокировок),
+    изменения сбрасываются в бэкенд пачкой раз в flush_interval секунд и при
+    остановке. Последние входы — LRU на max_inputs записей с TTL.
+    """
+
+    def __init__(self, backend: StateBackend, max_inputs: int, input_ttl: float, flush_interval: float) -> None:
+        self.backend = backend
+        self.max_inputs = max_inputs
+        self.input_ttl = input_ttl
+        self.flush_interval = flush_interval
+        self._styles: Dict[int, str] = {}
+        self._inputs: "OrderedDict[int, Tuple[Dict[str, Optional[str]], float]]" = OrderedDict()
+        self._dirty: Set[StateKey] = set()
+        horizon = time.time() - input_ttl
+        for kind, chat_id, value, ts in backend.load():
+            if kind == "style":
+                self._styles[chat_id] = value
+            elif kind == "input" and ts >= horizon:
+                self._inputs[chat_id] = (value, ts)
+        while len(self._inputs) > max_inputs:
+            self._inputs.popitem(last=False)
+
+    def get_style(self, chat_id: int) -> Optional[str]:
+        return self._styles.get(chat_id)
+
+    def set_style(self, chat_id: int, text: Optional[str]) -> None:
+        if text:
+            self._styles[chat_id] = text
+        else:
+            self._styles.pop(chat_id, None)
+        self._dirty.add(("style", chat_id))
+
+    def get_last_input(self, chat_id: int) -> Optional[Dict[str, Optional[str]]]:
+        entry = self._inputs.get(chat_id)
+        if entry is None:
+            return None
+        value, ts = entry
+        if ts < time.time() - self.input_ttl:
+            del self._inputs[chat_id]
+            self._dirty.add(("input", chat_id))
+            return None
+        self._inputs.move_to_end(chat_id)
+        return value
+
+    def set_last_input(self, chat_id: int, text: str, source: Optional[str]) -> None:
+        self._inputs[chat_id] = ({"text": text, "source": source}, time.time())
+        self._inputs.move_to_end(chat_id)
+        self._dirty.add(("input", chat_id))
+        while len(self._inputs) > self.max_inputs:
+            evicted, _ = self._inputs.popitem(last=False)
+            self._dirty.add(("input", evicted))
+
+    def _take_dirty(self) -> Tuple[List[Tuple[str, int, Any, float]], List[StateKey]]:
+        upserts: List[Tuple[str, int, Any, float]] = []
+        deletes: List[StateKey] = []
+        now = time.time()
+        for kind, chat_id in self._dirty:
+            if kind == "style" and chat_id in self._styles:
+                upserts.append((kind, chat_id, self._styles[chat_id], now))
+            elif kind == "input" and chat_id in self._inputs:
+                value, ts = self._inputs[chat_id]
+                upserts.append((kind, chat_id, value, ts))
+            else:
+                deletes.append((kind, chat_id))
+        self._dirty.clear()
+        return upserts, deletes
+
+    def _write(self, upserts: List[Tuple[str, int, Any, float]], deletes: List[StateKey]) -> None:
+        self.backend.save(upserts, deletes)
+        self.backend.prune("input", self.max_inputs, time.time() - self.input_ttl)
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        upserts, deletes = self._take_dirty()
+        try:
+            await asyncio.to_thread(self._write, upserts, deletes)
+        except Exception as e:
+            print(f"[State] flush error: {e}")
+            # Вернуть ключи в грязные, если их не переписали заново за время записи
+            self._dirty.update((kind, chat_id) for kind, chat_id, _, _ in upserts)
+            self._dirty.update(deletes)
+
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def reload_styles(self) -> None:
+        """Перечитывает стили из бэкенда — в шард-воркере, где /style задают у координатора."""
+        self._styles = {chat_id: value for kind, chat_id, value, _ in self.backend.load() if kind == "style"}
+
+    async def reload_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.reload_styles()
+
+
+def get_state_store(app: Application) -> ChatStateStore:
+    store = app.bot_data.get("chat_state")
+    if store is None:
+        kind = os.getenv("STATE_BACKEND", "sqlite").strip().lower()
+        if kind == "file":
+            raw = os.getenv("STATE_FILE", "").strip()
+            backend: StateBackend = JsonFileStateBackend(Path(raw) if raw else Path(__file__).with_name("chat_state.json"))
+        else:
+            backend = SqliteStateBackend(get_db_path())
+        store = ChatStateStore(
+            backend,
+            max_inputs=max(1, _env_int("STATE_MAX_INPUTS", 1000)),
+            input_ttl=_env_float("STATE_INPUT_TTL", 7 * 86400.0),
+            flush_interval=max(0.1, _env_float("STATE_FLUSH_INTERVAL", 2.0)),
+        )
+        app.bot_data["chat_state"] = store
+    return store
+
+
 def get_style_for_chat(app: Application, chat_id: int) -> Optional[str]:
-    styles: Dict[int, str] = app.bot_data.get("style_by_chat", {})
-    return styles.get(chat_id)
+    return get_state_store(app).get_style(chat_id)
 
 
 def set_style_for_chat(app: Application, chat_id: int, text: Optional[str]) -> None:
-    styles: Dict[int, str] = app.bot_data.setdefault("style_by_chat", {})
-    if text:
-        styles[chat_id] = text.strip()
-    else:
-        styles.pop(chat_id, None)
+    get_state_store(app).set_style(chat_id, text.strip() if text else None)
+
+
+def set_last_input_for_chat(app: Application, chat_id: int, text: str, source: Optional[str]) -> None:
+    get_state_store(app).set_last_input(chat_id, text, source)
+
 
+def get_last_input_for_chat(app: Application, chat_id: int) -> Optional[Dict[str, Optional[str]]]:
+    return get_state_store(app).get_last_input(chat_id)
+
+
+async def reply_paraphrase(chat, text: str, source: Optional[str], api_key: str, app_url: Optional[str],
+                           extra_style: Optional[str], error_prefix: str) -> bool:
+    """Отвечает пересказом в чат. При STREAM_INTERACTIVE=1 сначала шлёт заглушку
+    и дописывает её через edit_message_text по мере генерации (не чаще
+    STREAM_EDIT_INTERVAL секунд, чтобы не упереться в лимиты на правки)."""
+    if os.getenv("STREAM_INTERACTIVE", "0").strip() != "1":
+        try:
+            result = await paraphrase(text, source, api_key, app_url, extra_style)
+            if not result or not result.strip():
+                await chat.send_message("Получен пустой ответ от API. Попробуйте другую модель или проверьте настройки.")
+                return False
+        except Exception as e:
+            await chat.send_message(f"{error_prefix}: {e}")
+            return False
+        await chat.send_message(result)
+        return True
 
-def set_last_input_for_chat(app: Application, chat_id: int, text: str, source: Optional[str]) -> None:
-    app.bot_data.setdefault("last_input_by_chat", {})[chat_id] = {"text": text, "source": source}
+    interval = _env_float("STREAM_EDIT_INTERVAL", 1.5)
+    placeholder = await chat.send_message("✍️ Пишу…")
+    next_edit = time.monotonic() + interval
+    shown = ""
 
+    async def on_partial(partial: str) -> None:
+        nonlocal next_edit, shown
+        now = time.monotonic()
+        if now < next_edit or len(partial) - len(shown) < 20:
+            return
+        next_edit = now + interval
+        try:
+            await placeholder.edit_text(f"{partial} …")
+            shown = partial
+        except RetryAfter as e:
+            next_edit = now + telegram_retry_after(e)
+        except BadRequest:
+            # «message is not modified» и т.п. — просто ждём следующего куска
+            pass
 
-def get_last_input_for_chat(app: Application, chat_id: int) -> Optional[Dict[str, Optional[str]]]:
-    store: Dict[int, Dict[str, Optional[str]]] = app.bot_data.get("last_input_by_chat", {})
-    return store.get(chat_id)
+    try:
+        result = await paraphrase_stream(text, source, api_key, app_url, extra_style, on_partial)
+    except Exception as e:
+        await placeholder.edit_text(f"{error_prefix}: {e}")
+        return False
+    try:
+        await placeholder.edit_text(result)
+    except RetryAfter as e:
+        await asyncio.sleep(telegram_retry_after(e))
+        await placeholder.edit_text(result)
+    return True
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -257,26 +2964,71 @@ async def cmd_revise(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     base_style = get_style_for_chat(context.application, chat_id)
     extra = (base_style + "\n\n" if base_style else "") + f"Правки редактора: {instr}"
-    try:
-        result = await paraphrase(last["text"] or "", last.get("source"), api_key, app_url, extra)
-        if not result or not result.strip():
-            await update.effective_chat.send_message("Получен пустой ответ от API. Попробуйте другую модель или проверьте настройки.")
-            return
-    except Exception as e:
-        await update.effective_chat.send_message(f"Ошибка правки: {e}")
-        return
-    await update.effective_chat.send_message(result)
+    await reply_paraphrase(update.effective_chat, last["text"] or "", last.get("source"), api_key, app_url, extra, "Ошибка правки")
 
 
 async def cmd_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    permissions = get_send_permissions(context.application)
+    if _routes is not None:
+        dests = route_destinations()
+        if not dests:
+            await update.effective_chat.send_message("В ROUTES_FILE нет получателей.")
+            return
+        results = await asyncio.gather(*[permissions.probe(context.bot, d) for d in dests])
+        lines = [f"{d}: {'ОК' if ok else 'НЕТ'}" for d, ok in zip(dests, results)]
+        await update.effective_chat.send_message("Получатели из маршрутов:\n" + "\n".join(lines))
+        return
     chat_id = resolve_target_chat_id()
     if chat_id is None:
         await update.effective_chat.send_message("Целевой чат не задан (DEST_USER_ID/TARGET_CHAT_ID).")
         return
-    ok = await can_send_to(context.bot, chat_id)
+    ok = await permissions.probe(context.bot, chat_id)
     await update.effective_chat.send_message("ОК: могу писать." if ok else "НЕТ: не могу писать. Проверьте, что вы нажали /start боту или права в канале.")
 
 
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = []
+    cache = get_paraphrase_cache()
+    if cache is not None:
+        st = cache.stats()
+        lines.append(f"Кеш пересказов: попаданий {st['hits']}, промахов {st['misses']}")
+    else:
+        lines.append("Кеш пересказов выключен.")
+    normalizers = list({id(n): n for n in _normalizers.values()}.values())
+    chars_in = sum(n.chars_in for n in normalizers)
+    if chars_in:
+        saved_chars = sum(sum(n.saved_chars.values()) for n in normalizers)
+        saved_tokens = sum(n.saved_tokens for n in normalizers)
+        lines.append(f"Очистка текста: убрано {saved_chars} символов ({saved_chars / chars_in:.0%}), ~{saved_tokens} токенов")
+    if _batcher is not None:
+        lines.append(f"Батчи: {_batcher.batches} запросов на {_batcher.batched_items} постов, поштучных повторов {_batcher.fallbacks}")
+    if _openrouter_client is not None:
+        for st in _openrouter_client.router.stats():
+            p50 = f"{st['p50']:.1f}с" if st["p50"] is not None else "—"
+            p95 = f"{st['p95']:.1f}с" if st["p95"] is not None else "—"
+            lines.append(f"{st['model']} @ {st['url']}: p50 {p50}, p95 {p95}, ошибок {st['errors']:.0%} из {st['samples']}")
+        for model, totals in _openrouter_client.usage.by_model.items():
+            lines.append(f"Токены {model}: {totals['prompt_tokens']} вход / {totals['completion_tokens']} выход за {totals['requests']} запросов")
+    index = get_duplicate_index(context.application)
+    if index is not None:
+        lines.append(f"Почти-дубликаты: отброшено {index.dropped}, в окне {len(index)}")
+    pipeline = get_pipeline(context.application)
+    depths = ", ".join(f"{k}={v}" for k, v in pipeline.depths().items())
+    c = pipeline.counters
+    lines.append(f"Конвейер: принято {c['received']}, отброшено {c['dropped']}, ошибок {c['failed']}, к отправке {c['sent']}; очереди: {depths}")
+    scheduler = pipeline.scheduler
+    lines.append(f"Очередь к LLM: {scheduler.qsize()} постов, на квоте {scheduler.throttled()} каналов; "
+                 f"сброшено устаревших {scheduler.dropped['stale']}, при перегрузке {scheduler.dropped['overload']}")
+    job_counts = get_job_store().counts()
+    lines.append("Задания: " + (", ".join(f"{k}={v}" for k, v in sorted(job_counts.items())) or "нет"))
+    sender = get_outbound_sender(context.application)
+    lines.append(f"Отправка: ушло {sender.sent}, ошибок {sender.failed}, повторов {sender.retries}, в очереди {sender.pending()}")
+    shards: Optional[ShardSupervisor] = context.application.bot_data.get("shard_supervisor")
+    if shards is not None:
+        lines.append(f"Шарды: работает {shards.alive()} из {shards.count} (статистика LLM и очистки — в их /metrics и логах)")
+    await update.effective_chat.send_message("\n".join(lines))
+
+
 async def cmd_paraphrase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     api_key = os.getenv("OPENROUTER_API_KEY")
     app_url = os.getenv("APP_URL")
@@ -307,27 +3059,849 @@ async def cmd_paraphrase(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
+    extra_style = get_style_for_chat(context.application, update.effective_chat.id)
+    if not await reply_paraphrase(update.effective_chat, text, source, api_key, app_url, extra_style, "Ошибка переформулирования"):
+        return
+    set_last_input_for_chat(context.application, update.effective_chat.id, text, source)
+
+
+@dataclass
+class PostJob:
+    """Пост канала, проходящий через конвейер."""
+    source_chat_id: int
+    message_id: Optional[int]
+    text: str
+    source: Optional[str]
+    suffix: str
+    # Получатели: [{"chat_id": ..., "style": ...}]; style=None — стиль чата из /style.
+    # После пересказа у каждого появляется "effective" — ключ его текста в results
+    targets: List[Dict[str, Any]]
+    tag: str
+    # False — для правок: сам пост уже был обработан, отметку не проверяем
+    claim: bool = True
+    cleaned: str = ""
+    # Пересказ по стилю: один запрос к LLM на каждый различающийся стиль
+    results: Dict[str, str] = field(default_factory=dict)
+    delivered: List[int] = field(default_factory=list)
+    claimed: bool = False
+    job_id: Optional[int] = None
+    seq: int = 0
+    received_at: float = field(default_factory=time.time)
+    # Время публикации исходного поста (для сквозной задержки)
+    posted_at: Optional[float] = None
+    # Медиа альбома для повторной загрузки с пересказом в подписи (MEDIA_REUPLOAD)
+    media: List[Dict[str, Any]] = field(default_factory=list)
+    # @username канала — для весов и квот LLM_SCHEDULE_FILE, заданных по имени
+    source_username: Optional[str] = None
+
+    @property
+    def dedupe_key(self) -> str:
+        return f"{self.source_chat_id}:{self.message_id}"
+
+    def to_payload(self) -> Dict:
+        payload = asdict(self)
+        for key in ("job_id", "seq", "claimed"):
+            payload.pop(key)
+        return payload
+
+    @classmethod
+    def from_payload(cls, payload: Dict) -> "PostJob":
+        if "targets" not in payload and "out_chat_id" in payload:
+            # Задание, сохранённое до появления маршрутов: один получатель и один результат
+            payload = dict(payload, targets=[{"chat_id": payload["out_chat_id"], "style": None, "effective": ""}])
+            if payload.get("result") is not None:
+                payload["results"] = {"": payload["result"]}
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in payload.items() if k in known})
+
+    def pending_targets(self) -> List[Dict[str, Any]]:
+        """Получатели, которым ещё не доставлено и для чьего стиля есть текст."""
+        return [t for t in self.targets
+                if t["chat_id"] not in self.delivered and t.get("effective") in self.results]
+
+
+def load_llm_schedule() -> Dict[str, Dict[str, float]]:
+    """Веса и квоты каналов для LLMScheduler из LLM_SCHEDULE_FILE (JSON):
+
+    {"default": {"weight": 1, "tpm": 0},
+     "channels": {"@rbc_news": {"weight": 4}, "-100123": {"weight": 0.5, "tpm": 20000}}}
+
+    weight — доля LLM относительно других каналов, tpm — потолок токенов в минуту
+    (0 — без квоты). Настройки канала дополняют "default". Ключ "" — значения по умолчанию.
+    """
+    schedule: Dict[str, Dict[str, float]] = {"": {"weight": 1.0, "tpm": 0.0}}
+    path = os.getenv("LLM_SCHEDULE_FILE", "").strip()
+    if not path:
+        return schedule
     try:
-        extra_style = get_style_for_chat(context.application, update.effective_chat.id)
-        result = await paraphrase(text, source, api_key, app_url, extra_style)
-        if not result or not result.strip():
-            await update.effective_chat.send_message("Получен пустой ответ от API. Попробуйте другую модель или проверьте настройки.")
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[Scheduler] cannot load {path}: {e}")
+        return schedule
+
+    def section(raw: Dict, base: Dict[str, float], where: str) -> Dict[str, float]:
+        result = dict(base)
+        for name in ("weight", "tpm"):
+            if name in raw:
+                try:
+                    result[name] = max(0.0, float(raw[name]))
+                except (TypeError, ValueError):
+                    print(f"[Scheduler] {where}: bad {name} {raw[name]!r}")
+        return result
+
+    schedule[""] = section(config.get("default", {}), schedule[""], "default")
+    for key, raw in config.get("channels", {}).items():
+        schedule[str(key).strip().lower()] = section(raw, schedule[""], str(key))
+    print(f"[Scheduler] {len(schedule) - 1} channel settings from {path}")
+    return schedule
+
+
+class LLMScheduler:
+    """Очередь стадии paraphrase: вместо FIFO — взвешенная справедливая очередь каналов.
+
+    Посты одного канала идут по порядку, а между каналами следующим берётся пост
+    с наименьшей виртуальной меткой начала (start-time fair queueing; стоимость —
+    оценка токенов запроса, делённая на вес канала). Всплеск одного канала не задерживает
+    остальные, канал с весом 4 получает вчетверо большую долю LLM. Квота tpm жёсткая:
+    сверх неё посты канала ждут, пока квота восстановится.
+
+    При перегрузке посты сбрасываются: прождавший дольше max_wait («stale») и, если
+    очередь полна, а пришёл пост с меньшей меткой, — последний в очереди обслуживания
+    («overload»). Сброшенные get() отдаёт первыми, стадия узнаёт их через shed_reason().
+    Интерфейс — как у asyncio.Queue, которую очередь заменяет в PostPipeline.
+    """
+
+    def __init__(self, maxsize: int, schedule: Dict[str, Dict[str, float]], max_wait: float) -> None:
+        self.maxsize = maxsize
+        self.max_wait = max_wait
+        self._schedule = schedule
+        # Ключ канала (id) -> посты в порядке поступления: (метка, seq, время постановки, токены, пост)
+        self._queues: Dict[str, deque] = {}
+        self._finish: Dict[str, float] = {}
+        self._quota: Dict[str, List[float]] = {}
+        self._vtime = 0.0
+        self._seq = 0
+        self._size = 0
+        self._unfinished = 0
+        self._shed: deque = deque()
+        self._reasons: Dict[int, str] = {}
+        self._changed = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self.dropped = {"stale": 0, "overload": 0}
+        self._overhead = sum(estimate_tokens(m["content"]) for m in build_paraphrase_messages("")[0])
+
+    def settings(self, job: "PostJob") -> Dict[str, float]:
+        found = self._schedule.get(str(job.source_chat_id))
+        if found is None and job.source_username:
+            found = self._schedule.get(f"@{job.source_username.lstrip('@').lower()}")
+        return found or self._schedule[""]
+
+    def cost(self, job: "PostJob") -> float:
+        """Оценка токенов на пост: запрос и ответ на каждый различающийся стиль получателей."""
+        tokens = estimate_tokens(job.cleaned)
+        styles = len({t.get("style") for t in job.targets}) or 1
+        return styles * (self._overhead + tokens + get_prompt_budget().output_tokens(tokens))
+
+    def qsize(self) -> int:
+        return self._size
+
+    def throttled(self) -> int:
+        """Каналы с постами в очереди, упёршиеся в квоту."""
+        now = time.monotonic()
+        return sum(1 for key in self._queues if self._quota_wait(key, now) > 0)
+
+    def _quota_wait(self, key: str, now: float) -> float:
+        """Через сколько секунд у канала снова будет квота (0 — есть сейчас)."""
+        bucket = self._quota.get(key)
+        if bucket is None:
+            return 0.0
+        tpm, tokens, updated = bucket
+        tokens = min(tpm, tokens + (now - updated) * tpm / 60.0)
+        bucket[1], bucket[2] = tokens, now
+        return 0.0 if tokens > 0 else -tokens * 60.0 / tpm + 0.01
+
+    async def put(self, job: "PostJob") -> None:
+        key = str(job.source_chat_id)
+        settings = self.settings(job)
+        cost = self.cost(job)
+        while self._size >= self.maxsize:
+            if self._evict(max(self._vtime, self._finish.get(key, 0.0))):
+                break
+            self._not_full.clear()
+            await self._not_full.wait()
+        if settings["tpm"] > 0 and key not in self._quota:
+            self._quota[key] = [settings["tpm"], settings["tpm"], time.monotonic()]
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        self._finish[key] = start + cost / max(settings["weight"], 0.01)
+        self._seq += 1
+        self._queues.setdefault(key, deque()).append((start, self._seq, time.monotonic(), cost, job))
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._changed.set()
+
+    def _evict(self, start: float) -> bool:
+        """Полная очередь: освобождает место, если в ней есть пост с большей меткой, чем у нового."""
+        worst_key = max(self._queues, key=lambda k: self._queues[k][-1][:2], default=None)
+        if worst_key is None or self._queues[worst_key][-1][0] <= start:
+            return False
+        queue = self._queues[worst_key]
+        entry = queue.pop()
+        # Следующие посты канала не платят за сброшенный
+        self._finish[worst_key] = entry[0]
+        if not queue:
+            del self._queues[worst_key]
+        self._shed_entry(entry[4], "overload")
+        return True
+
+    def _shed_entry(self, job: "PostJob", reason: str) -> None:
+        self._size -= 1
+        self.dropped[reason] += 1
+        self._shed.append((job, reason))
+        self._not_full.set()
+        self._changed.set()
+
+    def shed_reason(self, job: "PostJob") -> Optional[str]:
+        """Причина сброса поста, выданного get(), или None — пост надо пересказать."""
+        return self._reasons.pop(id(job), None)
+
+    def _next(self) -> Tuple[Optional["PostJob"], Optional[float]]:
+        """Следующий пост или (None, через сколько секунд проверить снова; None — ждать put)."""
+        if self._shed:
+            job, reason = self._shed.popleft()
+            self._reasons[id(job)] = reason
+            return job, None
+        now = time.monotonic()
+        best: Optional[str] = None
+        retry: Optional[float] = None
+        for key, queue in list(self._queues.items()):
+            start, seq, enqueued, _, job = queue[0]
+            if self.max_wait > 0 and now - enqueued > self.max_wait:
+                queue.popleft()
+                if not queue:
+                    del self._queues[key]
+                self._shed_entry(job, "stale")
+                return self._next()
+            wait = self._quota_wait(key, now)
+            if self.max_wait > 0:
+                wait_stale = enqueued + self.max_wait - now
+                retry = wait_stale if retry is None else min(retry, wait_stale)
+            if wait > 0:
+                retry = wait if retry is None else min(retry, wait)
+                continue
+            if best is None or (start, seq) < self._queues[best][0][:2]:
+                best = key
+        if best is None:
+            return None, retry
+        queue = self._queues[best]
+        start, _, enqueued, cost, job = queue.popleft()
+        if not queue:
+            del self._queues[best]
+        self._vtime = start
+        if best in self._quota:
+            self._quota[best][1] -= cost
+        self._size -= 1
+        self._not_full.set()
+        METRICS.observe("newsbot_llm_queue_wait_seconds", now - enqueued)
+        return job, None
+
+    async def get(self) -> "PostJob":
+        while True:
+            job, retry = self._next()
+            if job is not None:
+                return job
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), retry)
+            except asyncio.TimeoutError:
+                pass
+
+    def task_done(self) -> None:
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._finished.set()
+
+    async def join(self) -> None:
+        await self._finished.wait()
+
+
+class PostPipeline:
+    """Конвейер ingest → clean → dedupe → paraphrase → send на ограниченных очередях.
+
+    submit() ждёт места в первой очереди, поэтому при перегрузке тормозят сами
+    обработчики (backpressure). Число воркеров каждой стадии настраивается отдельно.
+    Стадия send одна: она возвращает постам исходный порядок в пределах канала
+    (preserve_order) и передаёт их в OutboundSender. Отброшенные посты тоже доходят
+    до send с result=None, чтобы не держать очередь канала.
+    """
+
+    STAGES = ("clean", "dedupe", "paraphrase", "send")
+
+    def __init__(self, application: Application, workers: Dict[str, int], queue_size: int, preserve_order: bool,
+                 scheduler: LLMScheduler) -> None:
+        self.application = application
+        self.workers = workers
+        self.preserve_order = preserve_order
+        self._queues: Dict[str, Any] = {name: asyncio.Queue(maxsize=queue_size) for name in self.STAGES}
+        # Перед LLM — не FIFO, а очередь с весами и квотами каналов
+        self._queues["paraphrase"] = scheduler
+        self.scheduler = scheduler
+        self._tasks: List[asyncio.Task] = []
+        self._next_seq: Dict[int, int] = {}
+        self._next_send: Dict[int, int] = {}
+        self._reorder: Dict[int, Dict[int, PostJob]] = {}
+        self.counters: Dict[str, int] = {"received": 0, "dropped": 0, "failed": 0, "sent": 0}
+
+    def start(self) -> None:
+        handlers = {
+            "clean": self._clean,
+            "dedupe": self._dedupe,
+            "paraphrase": self._paraphrase,
+            "send": self._send,
+        }
+        for name in self.STAGES:
+            count = 1 if name == "send" else max(1, self.workers.get(name, 1))
+            for _ in range(count):
+                self._tasks.append(asyncio.create_task(self._run(name, handlers[name])))
+        self._tasks.append(asyncio.create_task(self._log_depths(_env_float("PIPELINE_STATS_INTERVAL", 60.0))))
+        self._tasks.append(asyncio.create_task(self._lease_loop()))
+        if is_shard_coordinator():
+            self._tasks.append(asyncio.create_task(self._handoff_loop(_env_float("SHARD_POLL_INTERVAL", 0.5))))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def drain(self) -> None:
+        """Ждёт, пока все принятые посты пройдут конвейер до отправки.
+
+        Стадии дожидаются по порядку: в стадию попадают посты только из предыдущих,
+        а отброшенные — сразу в send, поэтому после send в конвейере ничего не остаётся.
+        """
+        for name in self.STAGES:
+            await self._queues[name].join()
+
+    async def submit(self, job: PostJob) -> None:
+        seq = self._next_seq.get(job.source_chat_id, 0)
+        self._next_seq[job.source_chat_id] = seq + 1
+        job.seq = seq
+        self.counters["received"] += 1
+        await self._queues["clean"].put(job)
+
+    def depths(self) -> Dict[str, int]:
+        return {name: q.qsize() for name, q in self._queues.items()}
+
+    async def _lease_loop(self) -> None:
+        """Продлевает аренду своих заданий и подбирает брошенные упавшим процессом."""
+        jobs = get_job_store()
+        # Воркер шарда не отправляет сам — пересказанные задания подбирает координатор
+        states = ("received",) if is_shard_worker() else JobStore.ACTIVE_STATES
+        last_prune = 0.0
+        while True:
+            try:
+                jobs.renew()
+                for job_id, state, payload in jobs.lease_expired(states=states):
+                    await self._resume(job_id, state, payload)
+                if time.time() - last_prune > 3600:
+                    jobs.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"[Pipeline] job lease error: {e}")
+            await asyncio.sleep(jobs.lease / 3)
+
+    async def accept_handoffs(self) -> int:
+        """Координатор: забирает задания, пересказанные шард-воркерами, в стадию send.
+
+        lease_expired отдаёт задания пачками, поэтому берём, пока пачка не окажется пустой.
+        """
+        total = 0
+        while True:
+            handed = get_job_store().lease_expired(states=("paraphrased",))
+            if not handed:
+                return total
+            for job_id, state, payload in handed:
+                await self._resume(job_id, state, payload, log=False)
+            total += len(handed)
+
+    async def _handoff_loop(self, interval: float) -> None:
+        while True:
+            try:
+                await self.accept_handoffs()
+            except Exception as e:
+                print(f"[Pipeline] handoff error: {e}")
+            await asyncio.sleep(interval)
+
+    async def _resume(self, job_id: int, state: str, payload: Dict, log: bool = True) -> None:
+        job = PostJob.from_payload(payload)
+        job.job_id = job_id
+        job.claimed = job.claim
+        seq = self._next_seq.get(job.source_chat_id, 0)
+        self._next_seq[job.source_chat_id] = seq + 1
+        job.seq = seq
+        if log:
+            print(f"[Pipeline] resume job {job_id} ({state}) chat={job.source_chat_id} mid={job.message_id}")
+        if state == "paraphrased" and job.results:
+            await self._queues["send"].put(job)
+        else:
+            await self._queues["paraphrase"].put(job)
+
+    async def _log_depths(self, interval: float) -> None:
+        last = dict(self.counters)
+        while True:
+            await asyncio.sleep(interval)
+            depths = self.depths()
+            if any(depths.values()) or self.counters != last:
+                print(f"[Pipeline] queues {depths} counters {self.counters}")
+                last = dict(self.counters)
+
+    async def _run(self, name: str, handler: Callable) -> None:
+        queue = self._queues[name]
+        while True:
+            job = await queue.get()
+            started = time.monotonic()
+            try:
+                await handler(job)
+            except Exception as e:
+                print(f"[Pipeline] {name} error for {job.dedupe_key}: {e}")
+                await self._fail(job, name)
+            finally:
+                METRICS.observe("newsbot_stage_seconds", time.monotonic() - started, stage=name)
+                queue.task_done()
+
+    async def _drop(self, job: PostJob, reason: str) -> None:
+        self.counters["dropped"] += 1
+        METRICS.inc("newsbot_dropped_total", reason=reason)
+        job.results = {}
+        await self._queues["send"].put(job)
+
+    async def _fail(self, job: PostJob, stage: str) -> None:
+        self.counters["failed"] += 1
+        METRICS.inc("newsbot_pipeline_failed_total", stage=stage)
+        self.release(job)
+        job.results = {}
+        if stage == "send":
+            # Воркер send единственный: ждать места в собственной очереди нельзя
             return
-    except Exception as e:
-        await update.effective_chat.send_message(f"Ошибка переформулирования: {e}")
+        await self._queues["send"].put(job)
+
+    def release(self, job: PostJob) -> None:
+        """Снимает отметку и запись дедупликации, чтобы пост можно было обработать снова."""
+        if job.job_id is not None:
+            get_job_store().delete(job.job_id)
+            job.job_id = None
+        if job.claimed and job.message_id is not None:
+            get_watermark_store().release(job.source_chat_id, job.message_id)
+            job.claimed = False
+        index = get_duplicate_index(self.application)
+        if index is not None:
+            index.discard(job.dedupe_key)
+
+    async def _clean(self, job: PostJob) -> None:
+        job.cleaned = clean_text(job.text, job.source_chat_id)
+        if not job.cleaned:
+            if job.claim and job.message_id is not None:
+                # Отмечаем, чтобы догон не подбирал пустой пост при каждом опросе
+                get_watermark_store().claim(job.source_chat_id, job.message_id)
+            await self._drop(job, "empty")
+            return
+        await self._queues["dedupe"].put(job)
+
+    async def _dedupe(self, job: PostJob) -> None:
+        if job.claim and job.message_id is not None:
+            if not get_watermark_store().claim(job.source_chat_id, job.message_id):
+                await self._drop(job, "processed")
+                return
+            job.claimed = True
+        if job.message_id is not None:
+            fingerprints = get_fingerprint_store()
+            if not job.claim:
+                change = fingerprints.change_ratio(job.source_chat_id, job.message_id, job.cleaned)
+                if change is not None and change < _env_float("EDIT_CHANGE_THRESHOLD", 0.1):
+                    print(f"[{job.tag}] minor edit chat={job.source_chat_id} mid={job.message_id} "
+                          f"change={change:.2f}, skip")
+                    await self._drop(job, "minor_edit")
+                    return
+            fingerprints.remember(job.source_chat_id, job.message_id, job.cleaned)
+        index = get_duplicate_index(self.application)
+        if index is not None:
+            dup_of = index.check_and_add(job.dedupe_key, job.cleaned)
+            if dup_of:
+                print(f"[{job.tag}] near-duplicate chat={job.source_chat_id} mid={job.message_id} of {dup_of}, skip")
+                await self._drop(job, "near_duplicate")
+                return
+        job.job_id = get_job_store().create(job.to_payload())
+        await self._queues["paraphrase"].put(job)
+
+    async def _paraphrase(self, job: PostJob) -> None:
+        reason = self.scheduler.shed_reason(job)
+        if reason is not None:
+            print(f"[{job.tag}] shed ({reason}) chat={job.source_chat_id} mid={job.message_id}, skip")
+            if job.job_id is not None:
+                get_job_store().delete(job.job_id)
+                job.job_id = None
+            await self._drop(job, reason)
+            return
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            await self._fail(job, "paraphrase")
+            return
+        for target in job.targets:
+            style = target.get("style")
+            if style is None:
+                style = get_style_for_chat(self.application, target["chat_id"])
+            target["effective"] = style or ""
+        # Один запрос на каждый различающийся стиль, все стили — параллельно
+        styles = sorted({t["effective"] for t in job.targets} - set(job.results))
+        outcomes = await asyncio.gather(*[
+            paraphrase_cleaned(job.cleaned, job.source, api_key, os.getenv("APP_URL"), style or None, allow_batch=True)
+            for style in styles
+        ], return_exceptions=True)
+        failed = False
+        for style, outcome in zip(styles, outcomes):
+            if isinstance(outcome, BaseException):
+                print(f"[{job.tag}] paraphrase error (style {style[:30]!r}): {outcome}")
+                failed = True
+                continue
+            job.results[style] = f"{outcome}{job.suffix}" if job.suffix else outcome
+        if failed or not job.results:
+            # Не отправляем частично: получатели упавшего стиля остались бы без поста, а задание
+            # — отмеченным отправленным. Пост освобождается для повторной обработки
+            await self._fail(job, "paraphrase")
+            return
+        if job.job_id is not None:
+            get_job_store().update(job.job_id, "paraphrased", job.to_payload())
+        await self._queues["send"].put(job)
+
+    async def _send(self, job: PostJob) -> None:
+        if not self.preserve_order:
+            await self._deliver_or_fail(job)
+            return
+        src = job.source_chat_id
+        pending = self._reorder.setdefault(src, {})
+        pending[job.seq] = job
+        nxt = self._next_send.get(src, 0)
+        while nxt in pending:
+            await self._deliver_or_fail(pending.pop(nxt))
+            nxt += 1
+        self._next_send[src] = nxt
+        if not pending:
+            self._reorder.pop(src, None)
+
+    async def _deliver_or_fail(self, job: PostJob) -> None:
+        """Ошибка одного поста не должна останавливать очередь канала при preserve_order."""
+        try:
+            await self._deliver(job)
+        except Exception as e:
+            print(f"[Pipeline] send error for {job.dedupe_key}: {e}")
+            await self._fail(job, "send")
+
+    async def _deliver(self, job: PostJob) -> None:
+        if not job.results:
+            return
+        if is_shard_worker() and job.job_id is not None:
+            # Bot API — у координатора: отдаём задание ему через NEWSBOT_DB
+            get_job_store().hand_off(job.job_id, job.to_payload())
+        else:
+            await deliver_post(self.application, job)
+        self.counters["sent"] += 1
+
+
+def get_pipeline(app: Application) -> PostPipeline:
+    pipeline = app.bot_data.get("pipeline")
+    if pipeline is None:
+        queue_size = max(1, _env_int("PIPELINE_QUEUE_SIZE", 100))
+        pipeline = PostPipeline(
+            app,
+            workers={
+                "clean": _env_int("PIPELINE_CLEAN_WORKERS", 1),
+                "dedupe": _env_int("PIPELINE_DEDUPE_WORKERS", 1),
+                "paraphrase": _env_int("PIPELINE_PARAPHRASE_WORKERS", 4),
+            },
+            queue_size=queue_size,
+            preserve_order=os.getenv("PIPELINE_PRESERVE_ORDER", "1").strip() != "0",
+            scheduler=LLMScheduler(
+                maxsize=queue_size,
+                schedule=load_llm_schedule(),
+                max_wait=_env_float("LLM_MAX_WAIT_SEC", 600.0),
+            ),
+        )
+        pipeline.start()
+        METRICS.register_gauge("newsbot_queue_depth", lambda: [({"queue": k}, v) for k, v in pipeline.depths().items()],
+                               key="pipeline")
+        app.bot_data["pipeline"] = pipeline
+    return pipeline
+
+
+async def deliver_post(application: Application, job: PostJob) -> None:
+    """Ставит готовый пост в очереди отправки всех получателей сразу; порядок
+    вызовов сохраняется в пределах каждого чата.
+
+    Задание считается отправленным, когда доставлено хотя бы одному получателю;
+    если не доставлено никому — снимается отметка, и пост можно обработать снова.
+    Правка поста при EDIT_UPDATE_SENT=1 редактирует наше прежнее сообщение, а не
+    публикует новое.
+    """
+    permissions = get_send_permissions(application)
+    pipeline = get_pipeline(application)
+    targets = job.pending_targets()
+    allowed = await asyncio.gather(*[permissions.allowed(application.bot, t["chat_id"]) for t in targets])
+    targets = [t for t, ok in zip(targets, allowed) if ok]
+    if not targets:
+        if not job.delivered:
+            pipeline.release(job)
         return
 
-    await update.effective_chat.send_message(result)
-    set_last_input_for_chat(context.application, update.effective_chat.id, text, source)
+    def on_sent(fut: asyncio.Future, chat_id: int) -> None:
+        if fut.cancelled():
+            return
+        send_e = fut.exception()
+        if send_e is not None:
+            print(f"[{job.tag}] send error to {chat_id}: {send_e}")
+            return
+        job.delivered.append(chat_id)
+        msg = fut.result()
+        sent_id = getattr(msg, "message_id", None)
+        if job.message_id is not None and sent_id is not None:
+            kind = "caption" if getattr(msg, "caption", None) else "text"
+            get_fingerprint_store().add_sent(job.source_chat_id, job.message_id, chat_id, sent_id, kind)
+        if job.job_id is not None and len(job.targets) > 1:
+            # Чтобы после падения не слать повторно тем, кому уже доставлено
+            get_job_store().update(job.job_id, "paraphrased", job.to_payload())
+        set_last_input_for_chat(application, chat_id, job.text, job.source)
 
+    def on_done(_: asyncio.Future) -> None:
+        if any(fut.cancelled() for fut in futures):
+            # Остановка: задание остаётся в NEWSBOT_DB и продолжится при следующем запуске
+            return
+        if not job.delivered:
+            pipeline.release(job)
+            return
+        if job.job_id is not None:
+            get_job_store().update(job.job_id, "sent", job.to_payload())
+        now = time.time()
+        METRICS.observe("newsbot_pipeline_seconds", now - job.received_at)
+        if job.posted_at is not None:
+            METRICS.observe("newsbot_end_to_end_seconds", now - job.posted_at)
 
-async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    app_url = os.getenv("APP_URL")
-    if not api_key:
+    sender = get_outbound_sender(application)
+    previous: Dict[int, Tuple[int, str]] = {}
+    if not job.claim and job.message_id is not None and os.getenv("EDIT_UPDATE_SENT", "0").strip() == "1":
+        previous = get_fingerprint_store().sent(job.source_chat_id, job.message_id)
+    futures = []
+    for target in targets:
+        text = job.results[target["effective"]]
+        edit = previous.get(target["chat_id"])
+        caption = None
+        if (job.media or (edit and edit[1] == "caption")) and job.suffix and text.endswith(job.suffix):
+            # В подписи к самим медиа пометка «(есть изображение)» не нужна
+            caption = text[:-len(job.suffix)]
+        fut = sender.enqueue(target["chat_id"], text, media=job.media or None, caption=caption, edit=edit)
+        fut.add_done_callback(lambda f, chat_id=target["chat_id"]: on_sent(f, chat_id))
+        futures.append(fut)
+    asyncio.gather(*futures, return_exceptions=True).add_done_callback(on_done)
+
+
+async def submit_post(application: Application, *, source_chat_id: int, message_id: Optional[int],
+                      text: str, source: Optional[str], suffix: str, out_chat_id: Optional[int], tag: str,
+                      claim: bool = True, posted_at: Optional[float] = None,
+                      source_username: Optional[str] = None, media: Optional[List[Dict[str, Any]]] = None) -> None:
+    """Общий вход для постов из каналов: ставит пост в конвейер (ждёт, если он переполнен).
+
+    out_chat_id — получатель по умолчанию; при ROUTES_FILE получателей задают маршруты.
+    media — части альбома для повторной загрузки вместе с пересказом.
+    """
+    METRICS.inc("newsbot_ingest_total", channel=source_chat_id, source=tag.lower(), kind="post" if claim else "edit")
+    targets = resolve_targets(source_chat_id, source_username, out_chat_id)
+    if not os.getenv("OPENROUTER_API_KEY") or not targets:
+        return
+    await get_pipeline(application).submit(PostJob(
+        source_chat_id=source_chat_id,
+        message_id=message_id,
+        text=text,
+        source=source,
+        suffix=suffix,
+        targets=targets,
+        tag=tag,
+        claim=claim,
+        posted_at=posted_at,
+        media=media or [],
+        source_username=source_username,
+    ))
+
+
+def _message_id(msg) -> int:
+    mid = getattr(msg, "message_id", None)
+    return mid if mid is not None else msg.id
+
+
+async def submit_album(application: Application, parts: List[Any], *, origin: str, out_chat_id: Optional[int],
+                       tag: str) -> None:
+    """Сливает части альбома в один пост: подписи — в общий текст, медиа — в список.
+
+    Пост получает id первой части с подписью — так push и fallback-опрос отмечают
+    один и тот же пост. Без подписей альбом пропускается, как и одиночное медиа без текста.
+    """
+    parts = sorted(parts, key=_message_id)
+    captions = [(p, getattr(p, "text", None) or getattr(p, "caption", None)) for p in parts]
+    captions = [(p, text) for p, text in captions if text]
+    if not captions:
         return
+    first = captions[0][0]
+    make_item = pyro_media_item if origin == "pyrogram" else ptb_media_item
+    items = [item for item in (make_item(p) for p in parts) if item]
+    METRICS.inc("newsbot_album_parts_total", len(parts), source=tag.lower())
+    reupload = (os.getenv("MEDIA_REUPLOAD", "0").strip() == "1" and len(items) == len(parts) >= 2
+                and all(item["type"] in ALBUM_MEDIA_TYPES for item in items))
+    chat = getattr(first, "chat", None)
+    print(f"[Album] chat={chat.id if chat else None} mid={_message_id(first)} parts={len(parts)} "
+          f"captions={len(captions)} reupload={reupload}")
+    await submit_post(
+        application,
+        source_chat_id=chat.id,
+        message_id=_message_id(first),
+        text="\n\n".join(text for _, text in captions),
+        source=chat.title if chat else None,
+        suffix=album_media_suffix(items),
+        out_chat_id=out_chat_id,
+        tag=tag,
+        source_username=getattr(chat, "username", None) if chat else None,
+        posted_at=first.date.timestamp() if first.date else None,
+        media=items if reupload else None,
+    )
+
+
+def get_album_collector(application: Application, origin: str) -> MediaGroupCollector:
+    """Сборщик альбомов для источника origin: "pyrogram" (аккаунт) или "bot" (Bot API)."""
+    key = f"album_collector_{origin}"
+    collector = application.bot_data.get(key)
+    if collector is None:
+        if origin == "pyrogram":
+            async def on_album(parts: List[Any]) -> None:
+                await submit_album(application, parts, origin=origin, out_chat_id=resolve_target_chat_id(),
+                                   tag="Pyrogram")
+        else:
+            async def on_album(parts: List[Any]) -> None:
+                await submit_album(application, parts, origin=origin,
+                                   out_chat_id=resolve_target_chat_id(default_chat_id=parts[0].chat_id), tag="Channel")
+        collector = MediaGroupCollector(
+            window=_env_float("MEDIA_GROUP_WINDOW_MS", 1500.0) / 1000.0,
+            max_wait=_env_float("MEDIA_GROUP_MAX_WAIT_MS", 5000.0) / 1000.0,
+            on_album=on_album,
+        )
+        application.bot_data[key] = collector
+    return collector
+
+
+async def backfill_channel(application: Application, pyro: PyroClient, cid: int) -> int:
+    """Догоняет пропущенные посты канала (простой, всплески, сбои push).
+
+    История читается от новых к старым до места, докуда догон уже просмотрел её в
+    прошлый раз (checked_id), но не старше BACKFILL_MAX_AGE_SEC, не ниже подрезанной
+    истории отметок и не больше BACKFILL_MAX_SCAN сообщений. Берётся всё, что не
+    отмечено обработанным: верхняя отметка high_id не граница, под ней бывают посты,
+    пропущенные push-ом или снятые после сбоя. За раз в конвейер уходит не больше
+    BACKFILL_MAX_COUNT постов — от старых к новым, остальные при следующем опросе.
+    """
+    watermarks = get_watermark_store()
+    checked_id = watermarks.checked_id(cid)
+    floor_id = watermarks.floor_id(cid)
+    max_count = max(1, _env_int("BACKFILL_MAX_COUNT", 30))
+    max_scan = max(max_count, _env_int("BACKFILL_MAX_SCAN", 1000))
+    max_attempts = max(1, _env_int("BACKFILL_RETRY_ATTEMPTS", 3))
+    cutoff = time.time() - _env_float("BACKFILL_MAX_AGE_SEC", 6 * 3600.0)
+    # Посты, снятые после сбоя LLM или отправки, повторяются не больше max_attempts раз
+    retry = watermarks.retry_ids(cid, max_attempts, cutoff)
+    exhausted = watermarks.exhausted_ids(cid, max_attempts)
+    # Снятые после сбоя посты бывают и в уже просмотренной части истории
+    stop_id = min([checked_id, *(mid - 1 for mid in retry)]) if checked_id is not None else None
+
+    top_id = None
+    scanned = 0
+    candidates = []
+    async for msg in pyro.get_chat_history(cid, limit=max_scan):
+        if top_id is None:
+            top_id = msg.id
+        scanned += 1
+        if stop_id is not None and msg.id <= stop_id:
+            break
+        if msg.id < floor_id:
+            break
+        if msg.date and msg.date.timestamp() < cutoff:
+            break
+        if getattr(msg, "text", None) or getattr(msg, "caption", None) or getattr(msg, "media_group_id", None):
+            candidates.append(msg)
+    else:
+        if scanned >= max_scan and checked_id is not None:
+            print(f"[Pyrogram/Fallback] chat={cid}: over {max_scan} messages since mid={checked_id}, "
+                  "older ones are not caught up")
+    # Части альбома (соседние сообщения с одним media_group_id) — один пост
+    posts: List[List[Any]] = []
+    for msg in candidates:
+        group_id = getattr(msg, "media_group_id", None)
+        if group_id and posts and getattr(posts[-1][0], "media_group_id", None) == group_id:
+            posts[-1].append(msg)
+        else:
+            posts.append([msg])
+    # Альбом отмечен по одной из частей, поэтому пропускаем его целиком, если отмечена любая
+    posts = [p for p in posts
+             if any(getattr(m, "text", None) or getattr(m, "caption", None) for m in p)
+             and not any(m.id in exhausted or watermarks.is_processed(cid, m.id) for m in p)]
+    if checked_id is None and watermarks.high_id(cid) is None:
+        # Канал видим впервые — не разгребаем историю до запуска мониторинга: из неё берём
+        # только последний пост. Вышедшие после запуска не теряем: их отметки может ещё
+        # не быть, пока они в конвейере (отметка ставится на стадии dedupe)
+        started = application.bot_data.get("pyrogram_started_at")
+        posts = posts[:1] + [p for p in posts[1:]
+                             if started is not None and p[0].date and p[0].date.timestamp() >= started]
+    posts.reverse()
+    if len(posts) > max_count:
+        posts = posts[:max_count]
+        # Дальше — при следующем опросе, с места последнего взятого поста
+        top_id = max(m.id for m in posts[-1])
+    if not posts:
+        watermarks.set_checked(cid, top_id or 0)
+        return 0
+    scheduler: Optional[PollScheduler] = application.bot_data.get("poll_scheduler")
+    if scheduler is not None:
+        for parts in posts:
+            scheduler.note_post(cid, parts[0].date.timestamp() if parts[0].date else None)
+    print(f"[Pyrogram/Fallback] catch-up chat={cid} posts={len(posts)} after mid={checked_id}"
+          + (f", retrying {sorted(retry)}" if retry else ""))
+
+    for parts in posts:
+        if getattr(parts[0], "media_group_id", None):
+            await submit_album(application, parts, origin="pyrogram", out_chat_id=resolve_target_chat_id(),
+                               tag="Fallback")
+            continue
+        msg = parts[0]
+        await submit_post(
+            application,
+            source_chat_id=cid,
+            message_id=msg.id,
+            text=getattr(msg, "text", None) or getattr(msg, "caption", None),
+            source=msg.chat.title if getattr(msg, "chat", None) else None,
+            suffix=pyro_media_suffix(msg),
+            out_chat_id=resolve_target_chat_id(),
+            tag="Fallback",
+            source_username=getattr(msg.chat, "username", None) if getattr(msg, "chat", None) else None,
+            posted_at=msg.date.timestamp() if msg.date else None,
+        )
+    watermarks.set_checked(cid, top_id)
+    return len(posts)
 
+
+async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     msg = update.effective_message
+    # Правка поста приходит отдельным edited_channel_post: сам пост уже обработан, отметку не проверяем
+    edited = getattr(update, "edited_channel_post", None) is not None
+    if msg is not None and getattr(msg, "media_group_id", None) and not edited:
+        get_album_collector(context.application, "bot").add(msg.chat_id, msg.media_group_id, msg)
+        return
     post_text = None
     if msg:
         post_text = getattr(msg, "text", None) or getattr(msg, "caption", None)
@@ -335,26 +3909,19 @@ async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     source = msg.chat.title if getattr(msg, "chat", None) else None
-    try:
-        extra_style = get_style_for_chat(context.application, resolve_target_chat_id(default_chat_id=msg.chat_id) or msg.chat_id)
-        result = await paraphrase(post_text, source, api_key, app_url, extra_style)
-        if not result or not result.strip():
-            print(f"[Channel] Empty response from API for chat {msg.chat_id}")
-            return
-    except Exception:
-        return
-
-    suffix = ptb_media_suffix(msg)
-    if suffix:
-        result = f"{result}{suffix}"
-
-    chat_id = resolve_target_chat_id(default_chat_id=msg.chat_id)
-    if chat_id is None:
-        return
-    if not await can_send_to(context.bot, chat_id):
-        return
-    await context.bot.send_message(chat_id=chat_id, text=result)
-    set_last_input_for_chat(context.application, chat_id, post_text, source)
+    await submit_post(
+        context.application,
+        source_chat_id=msg.chat_id,
+        message_id=msg.message_id,
+        text=post_text,
+        source=source,
+        suffix=ptb_media_suffix(msg),
+        out_chat_id=resolve_target_chat_id(default_chat_id=msg.chat_id),
+        tag="Channel",
+        source_username=getattr(msg.chat, "username", None) if getattr(msg, "chat", None) else None,
+        claim=not edited,
+        posted_at=None if edited or not msg.date else msg.date.timestamp(),
+    )
 
 
 async def start_pyrogram_monitor(application: Application) -> None:
@@ -386,24 +3953,54 @@ async def start_pyrogram_monitor(application: Application) -> None:
         return
 
     session = os.getenv("PYROGRAM_SESSION", "pyrogram")
+    if is_shard_coordinator():
+        print(f"[Pyrogram] sharded mode: {len(usernames)} channels are watched by {get_shard_count()} shard workers")
+        return
+    if is_shard_worker():
+        # У каждого воркера своя сессия (авторизуется один раз: python bot.py --shard N)
+        usernames = shard_channels(usernames)
+        session = f"{session}_{_shard_index}"
+        print(f"[Pyrogram] shard {_shard_index}/{get_shard_count()}: {len(usernames)} channels")
+        if not usernames:
+            return
     pyro = PyroClient(name=session, api_id=api_id_int, api_hash=api_hash)
 
     await pyro.start()
     print("[Pyrogram] started session", session)
 
-    watched_ids: Set[int] = set()
-    for u in usernames:
-        try:
+    # Каналы из кеша берём сразу; остальные вступаем и разрешаем параллельно
+    channels = get_channel_cache()
+    resolve_sem = asyncio.Semaphore(max(1, _env_int("CHANNEL_RESOLVE_CONCURRENCY", 8)))
+    resolve_started = time.monotonic()
+
+    async def resolve(u: str) -> Optional[int]:
+        cached = channels.get(session, u)
+        if cached is not None:
+            return cached
+        async with resolve_sem:
             try:
-                await pyro.join_chat(u)
-                print(f"[Pyrogram] joined @{u}")
-            except Exception as e_join:
-                print(f"[Pyrogram] join @{u} skip/err: {e_join}")
-            chat = await pyro.get_chat(u)
-            watched_ids.add(chat.id)
-            print(f"[Pyrogram] watching @{u} -> id {chat.id}")
-        except Exception as e:
-            print(f"[Pyrogram] failed to resolve @{u}: {e}")
+                try:
+                    await pyro.join_chat(u)
+                    print(f"[Pyrogram] joined @{u}")
+                except Exception as e_join:
+                    print(f"[Pyrogram] join @{u} skip/err: {e_join}")
+                chat = await pyro.get_chat(u)
+            except Exception as e:
+                print(f"[Pyrogram] failed to resolve @{u}: {e}")
+                return None
+        channels.put(session, u, chat.id, getattr(chat, "title", None))
+        return chat.id
+
+    watched_ids: Set[int] = set()
+    cached_count = sum(1 for u in usernames if channels.get(session, u) is not None)
+    for u, chat_id in zip(usernames, await asyncio.gather(*[resolve(u) for u in usernames])):
+        if chat_id is None:
+            continue
+        watched_ids.add(chat_id)
+        bind_channel_rules(u, chat_id)
+        print(f"[Pyrogram] watching @{u} -> id {chat_id}")
+    print(f"[Pyrogram] resolved {len(watched_ids)}/{len(usernames)} channels ({cached_count} cached) "
+          f"in {time.monotonic() - resolve_started:.1f}s")
 
     if not watched_ids:
         print("[Pyrogram] no channels resolved, monitor disabled")
@@ -411,6 +4008,12 @@ async def start_pyrogram_monitor(application: Application) -> None:
         return
 
     id_list: List[int] = list(watched_ids)
+    scheduler = PollScheduler(
+        min_interval=_env_float("POLL_MIN_INTERVAL", 15.0),
+        max_interval=_env_float("POLL_MAX_INTERVAL", 300.0),
+        push_factor=_env_float("POLL_PUSH_FACTOR", 4.0),
+    )
+    application.bot_data["poll_scheduler"] = scheduler
 
     @pyro.on_message(pyro_filters.channel)
     async def on_new_message(client, message):
@@ -419,30 +4022,26 @@ async def start_pyrogram_monitor(application: Application) -> None:
             if chat_id not in watched_ids:
                 return
             text = getattr(message, "text", None) or getattr(message, "caption", None)
-            has_suffix = pyro_media_suffix(message)
             print(f"[Pyrogram] on_message chat={chat_id} has_text={bool(text)}")
-            if not text:
+            scheduler.note_push(chat_id, message.date.timestamp() if message.date else None)
+            if getattr(message, "media_group_id", None):
+                get_album_collector(application, "pyrogram").add(chat_id, message.media_group_id, message)
                 return
-            api_key = os.getenv("OPENROUTER_API_KEY")
-            if not api_key:
+            if not text:
                 return
-            app_url = os.getenv("APP_URL")
             source = message.chat.title if getattr(message, "chat", None) else None
-            try:
-                extra_style = get_style_for_chat(application, resolve_target_chat_id() or chat_id)
-                result = await paraphrase(text, source, api_key, app_url, extra_style)
-            except Exception as inner_e:
-                print(f"[Pyrogram] paraphrase error: {inner_e}")
-                return
-            if has_suffix:
-                result = f"{result}{has_suffix}"
-            out_chat_id = resolve_target_chat_id()
-            if out_chat_id and await can_send_to(application.bot, out_chat_id):
-                try:
-                    await application.bot.send_message(chat_id=int(out_chat_id), text=result)
-                    set_last_input_for_chat(application, out_chat_id, text, source)
-                except Exception as send_e:
-                    print(f"[Pyrogram] send error: {send_e}")
+            await submit_post(
+                application,
+                source_chat_id=chat_id,
+                message_id=message.id,
+                text=text,
+                source=source,
+                suffix=pyro_media_suffix(message),
+                out_chat_id=resolve_target_chat_id(),
+                tag="Pyrogram",
+                source_username=getattr(message.chat, "username", None),
+                posted_at=message.date.timestamp() if message.date else None,
+            )
         except (ValueError, KeyError) as peer_e:
             print(f"[Pyrogram] Peer error (channel may be deleted): {peer_e}")
             # Удаляем канал из списка отслеживаемых
@@ -458,30 +4057,22 @@ async def start_pyrogram_monitor(application: Application) -> None:
             if chat_id not in watched_ids:
                 return
             text = getattr(message, "text", None) or getattr(message, "caption", None)
-            has_suffix = pyro_media_suffix(message)
             print(f"[Pyrogram] on_edited chat={chat_id} has_text={bool(text)}")
             if not text:
                 return
-            api_key = os.getenv("OPENROUTER_API_KEY")
-            if not api_key:
-                return
-            app_url = os.getenv("APP_URL")
             source = message.chat.title if getattr(message, "chat", None) else None
-            try:
-                extra_style = get_style_for_chat(application, resolve_target_chat_id() or chat_id)
-                result = await paraphrase(text, source, api_key, app_url, extra_style)
-            except Exception as inner_e:
-                print(f"[Pyrogram] paraphrase error: {inner_e}")
-                return
-            if has_suffix:
-                result = f"{result}{has_suffix}"
-            out_chat_id = resolve_target_chat_id()
-            if out_chat_id and await can_send_to(application.bot, out_chat_id):
-                try:
-                    await application.bot.send_message(chat_id=int(out_chat_id), text=result)
-                    set_last_input_for_chat(application, out_chat_id, text, source)
-                except Exception as send_e:
-                    print(f"[Pyrogram] send error: {send_e}")
+            await submit_post(
+                application,
+                source_chat_id=chat_id,
+                message_id=message.id,
+                text=text,
+                source=source,
+                suffix=pyro_media_suffix(message),
+                out_chat_id=resolve_target_chat_id(),
+                tag="Pyrogram",
+                source_username=getattr(message.chat, "username", None),
+                claim=False,
+            )
         except (ValueError, KeyError) as peer_e:
             print(f"[Pyrogram] Edited message peer error (channel may be deleted): {peer_e}")
             # Удаляем канал из списка отслеживаемых
@@ -492,92 +4083,309 @@ async def start_pyrogram_monitor(application: Application) -> None:
 
     application.bot_data["pyrogram_client"] = pyro
     application.bot_data["pyrogram_watch_ids"] = watched_ids
+    # С этого момента посты новых каналов — наши: догон не ограничивается последним постом
+    application.bot_data.setdefault("pyrogram_started_at", time.time())
     print("[Pyrogram] monitor ready; handlers registered for ids:", id_list)
 
     async def poll_fallback():
-        last_id_by_chat: Dict[int, int] = {}
+        # Общий бюджет запросов к MTProto на все каналы
+        budget = TokenBucket(rate=_env_float("POLL_RATE", 1.0), capacity=_env_float("POLL_BURST", 3.0))
+        sem = asyncio.Semaphore(max(1, _env_int("POLL_CONCURRENCY", 4)))
+        running: Dict[int, asyncio.Task] = {}
+
+        async def poll_one(cid: int) -> None:
+            try:
+                await budget.acquire()
+                async with sem:
+                    await backfill_channel(application, pyro, cid)
+            except (ValueError, KeyError) as peer_e:
+                print(f"[Fallback] Channel {cid} no longer accessible: {peer_e}")
+                watched_ids.discard(cid)
+                scheduler.forget(cid)
+                # При следующем запуске канал будет разрешён заново
+                channels.forget(session, cid)
+            except Exception as one_e:
+                print(f"[Fallback] history error for {cid}: {one_e}")
+            finally:
+                if cid in watched_ids:
+                    scheduler.schedule(cid)
+                running.pop(cid, None)
+
         while True:
             try:
-                for cid in list(watched_ids):
-                    try:
-                        # Проверяем, доступен ли канал
-                        try:
-                            await pyro.get_chat(cid)
-                        except (ValueError, KeyError) as e:
-                            print(f"[Fallback] Channel {cid} no longer accessible: {e}")
-                            watched_ids.discard(cid)  # Удаляем из списка отслеживаемых
-                            continue
-                        
-                        async for msg in pyro.get_chat_history(cid, limit=1):
-                            mid = msg.id
-                            if last_id_by_chat.get(cid) == mid:
-                                continue
-                            last_id_by_chat[cid] = mid
-                            text = getattr(msg, "text", None) or getattr(msg, "caption", None)
-                            if not text:
-                                continue
-                            suffix = pyro_media_suffix(msg)
-                            print(f"[Pyrogram/Fallback] fetched chat={cid} mid={mid}")
-                            api_key = os.getenv("OPENROUTER_API_KEY")
-                            if not api_key:
-                                continue
-                            app_url = os.getenv("APP_URL")
-                            source = msg.chat.title if getattr(msg, "chat", None) else None
-                            try:
-                                extra_style = get_style_for_chat(application, resolve_target_chat_id() or cid)
-                                result = await paraphrase(text, source, api_key, app_url, extra_style)
-                            except Exception as inner_e:
-                                print(f"[Fallback] paraphrase error: {inner_e}")
-                                continue
-                            if suffix:
-                                result = f"{result}{suffix}"
-                            out_chat_id = resolve_target_chat_id()
-                            if out_chat_id and await can_send_to(application.bot, out_chat_id):
-                                try:
-                                    await application.bot.send_message(chat_id=int(out_chat_id), text=result)
-                                    set_last_input_for_chat(application, out_chat_id, text, source)
-                                except Exception as send_e:
-                                    print(f"[Fallback] send error: {send_e}")
-                    except (ValueError, KeyError) as peer_e:
-                        print(f"[Fallback] Channel {cid} no longer accessible: {peer_e}")
-                        watched_ids.discard(cid)
-                    except Exception as one_e:
-                        print(f"[Fallback] history error for {cid}: {one_e}")
+                for cid in scheduler.due(list(watched_ids)):
+                    if cid not in running:
+                        running[cid] = asyncio.create_task(poll_one(cid))
             except Exception as loop_e:
                 print(f"[Fallback] loop error: {loop_e}")
-            await asyncio.sleep(30)
+            await asyncio.sleep(1.0)
+
+    application.bot_data["pyrogram_fallback_task"] = asyncio.create_task(supervise("poll_fallback", poll_fallback))
+
+
+async def supervise(name: str, run: Callable[[], Awaitable[None]], max_delay: float = 60.0) -> None:
+    """Держит фоновый компонент запущенным: упавшую корутину запускает заново на месте
+    с растущей паузой (1, 2, 4… до max_delay секунд), не перезапуская весь бот."""
+    delay = 1.0
+    while True:
+        started = time.monotonic()
+        try:
+            await run()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if time.monotonic() - started > 10 * max_delay:
+                delay = 1.0
+            METRICS.inc("newsbot_component_restarts_total", component=name)
+            print(f"[Supervisor] {name} failed: {e!r}; restart in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(max_delay, delay * 2)
+
 
-    application.bot_data["pyrogram_fallback_task"] = asyncio.create_task(poll_fallback())
+class ShardSupervisor:
+    """Координатор: процессы-воркеры шардов (python bot.py --shard N).
+
+    Упавший воркер перезапускается с растущей паузой; при остановке воркеры получают
+    SIGTERM и дописывают принятые посты (SHUTDOWN_DRAIN_SEC), как и сам бот.
+    """
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self._procs: Dict[int, asyncio.subprocess.Process] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        for index in range(self.count):
+            self._tasks.append(asyncio.create_task(self._run(index)))
+
+    def alive(self) -> int:
+        return sum(1 for proc in self._procs.values() if proc.returncode is None)
+
+    async def _run(self, index: int) -> None:
+        delay = 1.0
+        env = dict(os.environ, NEWSBOT_SHARD_PARENT=str(os.getpid()))
+        while not self._stopping:
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, str(Path(__file__).resolve()), "--shard", str(index), env=env)
+            self._procs[index] = proc
+            print(f"[Shard] worker {index} started, pid {proc.pid}")
+            code = await proc.wait()
+            if self._stopping:
+                return
+            if time.monotonic() - started > 600:
+                delay = 1.0
+            METRICS.inc("newsbot_component_restarts_total", component=f"shard{index}")
+            print(f"[Shard] worker {index} exited with code {code}; restart in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(60.0, delay * 2)
+
+    async def stop(self, timeout: float) -> None:
+        self._stopping = True
+        running = [proc for proc in self._procs.values() if proc.returncode is None]
+        for proc in running:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        try:
+            await asyncio.wait_for(asyncio.gather(*[proc.wait() for proc in running]), timeout)
+        except asyncio.TimeoutError:
+            for proc in running:
+                if proc.returncode is None:
+                    print(f"[Shard] worker pid {proc.pid} did not stop in {timeout:.0f}s, killing")
+                    proc.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class ShardWorkerApp:
+    """То, что конвейеру и монитору каналов нужно от Application в воркере шарда:
+    bot_data без Bot API — готовые посты отправляет координатор."""
+
+    bot = None
+
+    def __init__(self) -> None:
+        self.bot_data: Dict[str, Any] = {}
+
+
+async def run_shard_worker(index: int) -> None:
+    """Воркер шарда: свой Pyrogram-клиент для своей доли каналов, очистка, дедупликация
+    и пересказ; результат — в NEWSBOT_DB для координатора."""
+    app = ShardWorkerApp()
+    load_normalizers()
+    load_routes()
+    get_pipeline(app)
+    app.bot_data["metrics_server"] = await start_metrics_server()
+    log_interval = _env_float("METRICS_LOG_INTERVAL", 60.0)
+    if log_interval > 0:
+        app.bot_data["metrics_log_task"] = asyncio.create_task(
+            supervise("metrics_log", lambda: metrics_log_loop(log_interval)))
+    state = get_state_store(app)
+    app.bot_data["chat_state_task"] = asyncio.create_task(supervise("chat_state", state.reload_loop))
+    app.bot_data["pyrogram_monitor_task"] = asyncio.create_task(
+        supervise("pyrogram_monitor", lambda: start_pyrogram_monitor(app)))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    parent = os.getenv("NEWSBOT_SHARD_PARENT")
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+        if parent and os.getppid() != int(parent):
+            print(f"[Shard] coordinator {parent} is gone, stopping worker {index}")
+            break
+    await on_stop(app)
+    await before_shutdown(app)
 
 
 async def after_init(application: Application) -> None:
-    await start_pyrogram_monitor(application)
+    load_normalizers()
+    load_routes()
+    # Конвейер стартует сразу, чтобы подобрать задания, оставшиеся с прошлого запуска
+    get_pipeline(application)
+    application.bot_data["metrics_server"] = await start_metrics_server()
+    log_interval = _env_float("METRICS_LOG_INTERVAL", 60.0)
+    if log_interval > 0:
+        application.bot_data["metrics_log_task"] = asyncio.create_task(
+            supervise("metrics_log", lambda: metrics_log_loop(log_interval)))
+    state = get_state_store(application)
+    application.bot_data["chat_state_task"] = asyncio.create_task(supervise("chat_state", state.flush_loop))
+    # Монитор каналов поднимается в фоне: Bot API готов сразу, а сбой старта Pyrogram
+    # повторяется на месте
+    application.bot_data["pyrogram_monitor_task"] = asyncio.create_task(
+        supervise("pyrogram_monitor", lambda: start_pyrogram_monitor(application)))
+    if is_shard_coordinator():
+        shards = ShardSupervisor(get_shard_count())
+        shards.start()
+        application.bot_data["shard_supervisor"] = shards
+    permissions = get_send_permissions(application)
+    application.bot_data["send_permission_task"] = asyncio.create_task(
+        supervise("send_permissions", lambda: permissions.refresh_loop(application.bot)))
     try:
-        dest = resolve_target_chat_id()
-        if dest:
-            ok = await can_send_to(application.bot, dest)
+        dests = route_destinations() if _routes is not None else [d for d in [resolve_target_chat_id()] if d]
+        for dest in dests:
+            ok = await permissions.probe(application.bot, dest)
             print(f"[Bot] send-permission to {dest}: {'OK' if ok else 'NO'}")
-        else:
+        if not dests:
             print("[Bot] no DEST_USER_ID/TARGET_CHAT_ID set for send-permission check")
     except Exception as e:
         print(f"[Bot] send-permission check error: {e}")
 
 
+async def _cancel_task(application: Application, key: str) -> None:
+    task: Optional[asyncio.Task] = application.bot_data.pop(key, None)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def on_stop(application: Application) -> None:
+    """SIGTERM/SIGINT: приём новых постов остановлен, дожидаемся уже принятых.
+
+    Вызывается после остановки polling, но до закрытия Bot API-клиента, поэтому
+    посты в конвейере и очередях отправки успевают уйти. Что не успело за
+    SHUTDOWN_DRAIN_SEC, остаётся в NEWSBOT_DB и продолжится при следующем запуске.
+    """
+    await _cancel_task(application, "pyrogram_monitor_task")
+    await _cancel_task(application, "pyrogram_fallback_task")
+    pyro = application.bot_data.pop("pyrogram_client", None)
+    if pyro is not None:
+        try:
+            await pyro.stop()
+        except Exception as e:
+            print(f"[Pyrogram] stop error: {e}")
+    for origin in ("pyrogram", "bot"):
+        collector: Optional[MediaGroupCollector] = application.bot_data.get(f"album_collector_{origin}")
+        if collector is not None:
+            await collector.close()
+    pipeline: Optional[PostPipeline] = application.bot_data.get("pipeline")
+    timeout = _env_float("SHUTDOWN_DRAIN_SEC", 25.0)
+    shards: Optional[ShardSupervisor] = application.bot_data.pop("shard_supervisor", None)
+    if shards is not None:
+        # Сначала воркеры дописывают свои посты, затем координатор их отправляет
+        await shards.stop(max(timeout, 1.0))
+        if pipeline is not None:
+            await pipeline.accept_handoffs()
+    if pipeline is None or timeout <= 0:
+        return
+    sender = None if is_shard_worker() else get_outbound_sender(application)
+    started = time.monotonic()
+    print(f"[Bot] draining: queues {pipeline.depths()}, outbound {sender.pending() if sender else 0}")
+
+    async def drain() -> None:
+        await pipeline.drain()
+        if sender is not None:
+            await sender.drain()
+        # Колбэки отправленных future (отметка sent в NEWSBOT_DB) выполняются следующей итерацией цикла
+        await asyncio.sleep(0)
+
+    try:
+        await asyncio.wait_for(drain(), timeout)
+        print(f"[Bot] drained in {time.monotonic() - started:.1f}s")
+    except asyncio.TimeoutError:
+        print(f"[Bot] drain timeout after {timeout:.0f}s: queues {pipeline.depths()}, "
+              f"outbound {sender.pending() if sender else 0}; the rest resumes on next start")
+
+
+async def before_shutdown(application: Application) -> None:
+    shards: Optional[ShardSupervisor] = application.bot_data.pop("shard_supervisor", None)
+    if shards is not None:
+        await shards.stop(_env_float("SHUTDOWN_DRAIN_SEC", 25.0))
+    for origin in ("pyrogram", "bot"):
+        collector: Optional[MediaGroupCollector] = application.bot_data.get(f"album_collector_{origin}")
+        if collector is not None:
+            await collector.close()
+    await _cancel_task(application, "pyrogram_monitor_task")
+    await _cancel_task(application, "pyrogram_fallback_task")
+    await _cancel_task(application, "send_permission_task")
+    pipeline: Optional[PostPipeline] = application.bot_data.get("pipeline")
+    if pipeline is not None:
+        await pipeline.close()
+    sender: Optional[OutboundSender] = application.bot_data.get("outbound_sender")
+    if sender is not None:
+        await sender.close()
+    if pipeline is not None:
+        # Незавершённые задания — сразу следующему запуску, без ожидания конца аренды
+        released = get_job_store().release_owned()
+        if released:
+            print(f"[Pipeline] {released} unfinished jobs left for the next start")
+    state: Optional[ChatStateStore] = application.bot_data.get("chat_state")
+    if state is not None:
+        await _cancel_task(application, "chat_state_task")
+        await state.flush()
+    await _cancel_task(application, "metrics_log_task")
+    server: Optional[asyncio.AbstractServer] = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    pyro = application.bot_data.pop("pyrogram_client", None)
+    if pyro is not None:
+        try:
+            await pyro.stop()
+        except Exception as e:
+            print(f"[Pyrogram] stop error: {e}")
+    await close_openrouter_client()
+
+
 async def ignore_status_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Игнорирует обновления статуса (например, новые участники, удаления сообщений и т.д.)"""
     pass
 
 
-def main() -> None:
-    script_dir_env = Path(__file__).with_name('.env')
-    load_dotenv(dotenv_path=script_dir_env)
-    load_dotenv()
-
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        raise RuntimeError("TELEGRAM_BOT_TOKEN не задан в окружении")
-
-    application = Application.builder().token(token).post_init(after_init).build()
+def build_application(token: str) -> Application:
+    application = (
+        Application.builder().token(token)
+        .post_init(after_init).post_stop(on_stop).post_shutdown(before_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CommandHandler("me", cmd_me))
@@ -585,16 +4393,58 @@ def main() -> None:
     application.add_handler(CommandHandler("revise", cmd_revise))
     application.add_handler(CommandHandler("check", cmd_check))
     application.add_handler(CommandHandler("paraphrase", cmd_paraphrase))
+    application.add_handler(CommandHandler("stats", cmd_stats))
     application.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.ALL, on_channel_post))
     application.add_handler(MessageHandler(filters.StatusUpdate.ALL, ignore_status_update))
+    return application
 
-    try:
-        application.run_polling(allowed_updates=["message", "channel_post", "edited_channel_post"])
-    except Exception as e:
-        print(f"[Bot] Fatal error: {e}")
-        print("[Bot] Restarting in 10 seconds...")
-        time.sleep(10)
-        main() 
+
+def _reset_loop_state() -> None:
+    """Сбрасывает синглтоны, привязанные к event loop упавшего запуска."""
+    global _openrouter_client, _batcher
+    _openrouter_client = None
+    _batcher = None
+    # Future из прежнего loop никогда не завершатся — новые запросы их не ждут
+    _inflight_paraphrases.clear()
+
+
+def main() -> None:
+    global _shard_index
+    script_dir_env = Path(__file__).with_name('.env')
+    load_dotenv(dotenv_path=script_dir_env)
+    load_dotenv()
+
+    if "--shard" in sys.argv:
+        # Воркер шарда запускает координатор (SHARD_COUNT > 1); вручную — для входа в его сессию
+        _shard_index = int(sys.argv[sys.argv.index("--shard") + 1])
+        if not 0 <= _shard_index < get_shard_count():
+            raise RuntimeError(f"--shard {_shard_index}: SHARD_COUNT={get_shard_count()}")
+        asyncio.run(run_shard_worker(_shard_index))
+        return
+
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN не задан в окружении")
+
+    # Перезапуск после фатальной ошибки — в цикле, на новом event loop; SIGTERM/SIGINT
+    # завершают run_polling штатно (с дренажом в on_stop), и процесс выходит
+    base_delay = max(1.0, _env_float("RESTART_DELAY_SEC", 10.0))
+    max_delay = max(base_delay, _env_float("RESTART_MAX_DELAY_SEC", 300.0))
+    delay = base_delay
+    while True:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        started = time.monotonic()
+        try:
+            build_application(token).run_polling(allowed_updates=["message", "channel_post", "edited_channel_post"])
+            return
+        except Exception as e:
+            print(f"[Bot] Fatal error: {e!r}")
+        _reset_loop_state()
+        if time.monotonic() - started > 10 * max_delay:
+            delay = base_delay
+        print(f"[Bot] Restarting in {delay:.0f} seconds...")
+        time.sleep(delay)
+        delay = min(max_delay, delay * 2)
 
 
 if __name__ == "__main__":
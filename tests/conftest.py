@@ -0,0 +1,16 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Подключение как у get_db(): WAL, автокоммит."""
+    conn = sqlite3.connect(str(tmp_path / "newsbot.db"), timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    yield conn
+    conn.close()
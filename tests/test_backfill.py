@@ -0,0 +1,143 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from bench.feeds import FakePyroClient, pyrogram_message
+
+CHAT = -100
+
+
+@pytest.fixture
+def env(db, monkeypatch):
+    store = bot.WatermarkStore(db, keep_per_chat=3)
+    monkeypatch.setattr(bot, "_watermark_store", store)
+    submitted = []
+
+    async def submit_post(application, **kw):
+        submitted.append(kw["message_id"])
+
+    async def submit_album(application, parts, **kw):
+        submitted.append(tuple(p.id for p in parts))
+
+    monkeypatch.setattr(bot, "submit_post", submit_post)
+    monkeypatch.setattr(bot, "submit_album", submit_album)
+    pyro = FakePyroClient({"c": {"chat_id": CHAT, "username": "c", "title": "C"}})
+    return SimpleNamespace(store=store, pyro=pyro, submitted=submitted, app=SimpleNamespace(bot_data={}))
+
+
+def publish(env, message_id, text="post", **record):
+    asyncio.run(env.pyro.publish({"chat_id": CHAT, "username": "c", "title": "C", "message_id": message_id,
+                                  "text": f"{text} {message_id}", **record}))
+
+
+def backfill(env):
+    return asyncio.run(bot.backfill_channel(env.app, env.pyro, CHAT))
+
+
+def test_post_missed_by_push_below_high_id(env):
+    for mid in (9, 10):
+        publish(env, mid)
+    env.store.claim(CHAT, 10)
+    assert backfill(env) == 1
+    assert env.submitted == [9]
+
+
+def test_gaps_go_out_oldest_first_and_once(env):
+    for mid in range(1, 8):
+        publish(env, mid)
+    for mid in (1, 3, 4, 7):
+        env.store.claim(CHAT, mid)
+    backfill(env)
+    assert env.submitted == [2, 5, 6]
+    for mid in env.submitted:
+        env.store.claim(CHAT, mid)
+    assert backfill(env) == 0
+
+
+def test_released_post_retried_until_attempts_run_out(env, monkeypatch):
+    monkeypatch.setenv("BACKFILL_RETRY_ATTEMPTS", "2")
+    for mid in (1, 2):
+        publish(env, mid)
+        env.store.claim(CHAT, mid)
+    for attempt in range(3):
+        env.store.release(CHAT, 1)
+        env.submitted.clear()
+        backfill(env)
+        assert env.submitted == ([1] if attempt < 2 else [])
+        if env.submitted:
+            env.store.claim(CHAT, 1)
+
+
+def test_album_skipped_when_any_part_is_marked(env):
+    publish(env, 1)
+    env.store.claim(CHAT, 1)
+    for mid in (2, 3):
+        publish(env, mid, media="photo", media_group_id="a")
+    for mid in (4, 5):
+        publish(env, mid, media="photo", media_group_id="b")
+    env.store.claim(CHAT, 3)
+    backfill(env)
+    assert env.submitted == [(5, 4)]
+
+
+def test_first_seen_channel_takes_only_latest(env):
+    for mid in (1, 2, 3):
+        publish(env, mid)
+    backfill(env)
+    assert env.submitted == [3]
+
+
+def test_history_below_floor_is_not_taken(env):
+    for mid in range(1, 9):
+        publish(env, mid)
+    for mid in (1, 2, 5, 6, 7, 8):
+        env.store.claim(CHAT, mid)
+    env.store.prune()
+    assert env.store.floor_id(CHAT) == 6
+    assert backfill(env) == 0
+
+
+def test_age_cutoff(env, monkeypatch):
+    monkeypatch.setenv("BACKFILL_MAX_AGE_SEC", "3600")
+    old = datetime.now(timezone.utc) - timedelta(hours=2)
+    env.pyro._history[CHAT] = [pyrogram_message({"chat_id": CHAT, "message_id": 1, "text": "old"}, date=old)]
+    publish(env, 2)
+    publish(env, 3)
+    env.store.claim(CHAT, 3)
+    backfill(env)
+    assert env.submitted == [2]
+
+
+def test_gap_older_than_count_window_is_caught(env, monkeypatch):
+    monkeypatch.setenv("BACKFILL_MAX_COUNT", "5")
+    publish(env, 1)
+    env.store.claim(CHAT, 1)
+    backfill(env)
+    assert env.store.checked_id(CHAT) == 1
+    # Пост 2 потерян push-ом, за ним ещё 40 пришедших push-ом
+    for mid in range(2, 43):
+        publish(env, mid)
+        if mid != 2:
+            env.store.claim(CHAT, mid)
+    backfill(env)
+    assert env.submitted == [2]
+    assert env.store.checked_id(CHAT) == 42
+
+
+def test_long_catch_up_is_paged(env, monkeypatch):
+    monkeypatch.setenv("BACKFILL_MAX_COUNT", "3")
+    publish(env, 1)
+    env.store.claim(CHAT, 1)
+    backfill(env)
+    for mid in range(2, 10):
+        publish(env, mid)
+    backfill(env)
+    assert env.submitted == [2, 3, 4]
+    assert env.store.checked_id(CHAT) == 4
+    backfill(env)
+    backfill(env)
+    assert env.submitted == [2, 3, 4, 5, 6, 7, 8, 9]
+    assert env.store.checked_id(CHAT) == 9
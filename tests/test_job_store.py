@@ -0,0 +1,74 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    return now
+
+
+def make_store(db):
+    return bot.JobStore(db, lease=60.0, retention=3600.0)
+
+
+def test_lease_blocks_other_processes_until_it_expires(db, clock):
+    owner, other = make_store(db), make_store(db)
+    job_id = owner.create({"text": "a"})
+    assert other.lease_expired() == []
+    clock[0] += 61
+    assert other.lease_expired() == [(job_id, "received", {"text": "a"})]
+    # Теперь аренда у другого процесса
+    assert owner.lease_expired() == []
+
+
+def test_renew_keeps_the_lease(db, clock):
+    owner, other = make_store(db), make_store(db)
+    owner.create({"text": "a"})
+    for _ in range(3):
+        clock[0] += 40
+        owner.renew()
+        assert other.lease_expired() == []
+
+
+def test_resume_keeps_saved_step(db, clock):
+    owner, other = make_store(db), make_store(db)
+    job_id = owner.create({"text": "a"})
+    owner.update(job_id, "paraphrased", {"text": "a", "results": {"": "b"}})
+    clock[0] += 61
+    assert other.lease_expired() == [(job_id, "paraphrased", {"text": "a", "results": {"": "b"}})]
+    attempts = db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+    assert attempts == 1
+
+
+def test_sent_jobs_are_not_resumed_and_get_pruned(db, clock):
+    store = make_store(db)
+    job_id = store.create({"text": "a"})
+    store.update(job_id, "sent")
+    clock[0] += 61
+    assert store.lease_expired() == []
+    store.prune()
+    assert store.counts() == {"sent": 1}
+    clock[0] += 3600
+    store.prune()
+    assert store.counts() == {}
+
+
+def test_release_owned_frees_jobs_at_once(db, clock):
+    owner, other = make_store(db), make_store(db)
+    job_id = owner.create({"text": "a"})
+    assert owner.release_owned() == 1
+    assert [row[0] for row in other.lease_expired()] == [job_id]
+
+
+def test_lease_expired_respects_limit_and_states(db, clock):
+    store = make_store(db)
+    ids = [store.create({"n": i}) for i in range(5)]
+    store.update(ids[0], "paraphrased")
+    clock[0] += 61
+    taker = make_store(db)
+    assert [row[0] for row in taker.lease_expired(states=("paraphrased",))] == [ids[0]]
+    assert [row[0] for row in taker.lease_expired(limit=2)] == ids[1:3]
+    assert [row[0] for row in taker.lease_expired()] == ids[3:]
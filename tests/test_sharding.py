@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CHANNELS = [f"channel_{i}" for i in range(2000)]
+
+
+def test_ring_is_deterministic():
+    a, b = bot.ConsistentHashRing(4), bot.ConsistentHashRing(4)
+    assert [a.node_for(c) for c in CHANNELS] == [b.node_for(c) for c in CHANNELS]
+
+
+def test_ring_spreads_channels_evenly():
+    ring = bot.ConsistentHashRing(4)
+    counts = [0] * 4
+    for c in CHANNELS:
+        counts[ring.node_for(c)] += 1
+    assert all(0.15 < n / len(CHANNELS) < 0.35 for n in counts)
+
+
+def test_adding_a_shard_moves_only_its_share():
+    old, new = bot.ConsistentHashRing(4), bot.ConsistentHashRing(5)
+    moved = [c for c in CHANNELS if old.node_for(c) != new.node_for(c)]
+    assert 0.1 < len(moved) / len(CHANNELS) < 0.3
+    # Переезжают только на новый шард, между старыми каналы не перемешиваются
+    assert {new.node_for(c) for c in moved} == {4}
+
+
+def test_shard_channels_partition_the_watch_list(monkeypatch):
+    monkeypatch.setenv("SHARD_COUNT", "3")
+    owned = []
+    for index in range(3):
+        monkeypatch.setattr(bot, "_shard_index", index)
+        owned.append(bot.shard_channels(CHANNELS[:300]))
+    assert sorted(c for part in owned for c in part) == sorted(CHANNELS[:300])
+    assert all(part for part in owned)
+
+
+def payload(message_id):
+    return bot.PostJob(source_chat_id=-1, message_id=message_id, text="t", source=None, suffix="",
+                       targets=[{"chat_id": 7, "style": None, "effective": ""}], tag="T",
+                       results={"": "p"}).to_payload()
+
+
+def test_hand_off_goes_to_the_coordinator(db):
+    worker = bot.JobStore(db, lease=60.0, retention=3600.0)
+    coordinator = bot.JobStore(db, lease=60.0, retention=3600.0)
+    job_id = worker.create(payload(1))
+    assert coordinator.lease_expired(states=("paraphrased",)) == []
+    worker.hand_off(job_id, payload(1))
+    # Продление аренды воркером не возвращает отданное задание
+    worker.renew()
+    taken = coordinator.lease_expired(states=("paraphrased",))
+    assert [(row[0], row[1]) for row in taken] == [(job_id, "paraphrased")]
+    assert worker.lease_expired(states=("paraphrased",)) == []
+
+
+def test_accept_handoffs_takes_every_batch(db, monkeypatch):
+    worker = bot.JobStore(db, lease=60.0, retention=3600.0)
+    monkeypatch.setattr(bot, "_job_store", bot.JobStore(db, lease=60.0, retention=3600.0))
+    for mid in range(250):
+        worker.hand_off(worker.create(payload(mid)), payload(mid))
+
+    async def run():
+        pipeline = bot.PostPipeline(SimpleNamespace(bot_data={}), workers={}, queue_size=1000, preserve_order=True,
+                                    scheduler=bot.LLMScheduler(1000, {}, 60.0))
+        return await pipeline.accept_handoffs(), pipeline.depths()["send"]
+
+    assert asyncio.run(run()) == (250, 250)
@@ -0,0 +1,79 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def store(db):
+    return bot.WatermarkStore(db, keep_per_chat=3)
+
+
+def test_claim_is_exactly_once(store):
+    assert store.claim(-1, 5)
+    assert not store.claim(-1, 5)
+    assert store.claim(-2, 5)
+    assert store.is_processed(-1, 5)
+
+
+def test_high_id_is_not_a_processed_bound(store):
+    assert store.high_id(-1) is None
+    store.claim(-1, 10)
+    assert store.high_id(-1) == 10
+    # Пост ниже верхней отметки, пропущенный push-ом, не обработан
+    assert not store.is_processed(-1, 9)
+    assert store.claim(-1, 9)
+    assert store.high_id(-1) == 10
+
+
+def test_release_and_retry_attempts(store):
+    store.claim(-1, 7)
+    store.release(-1, 7)
+    assert not store.is_processed(-1, 7)
+    assert store.retry_ids(-1, max_attempts=2, since=0) == {7}
+    assert store.exhausted_ids(-1, max_attempts=2) == set()
+    # Взятый снова пост — уже не в повторе
+    store.claim(-1, 7)
+    assert store.retry_ids(-1, max_attempts=2, since=0) == set()
+    store.release(-1, 7)
+    store.release(-1, 7)
+    assert store.retry_ids(-1, max_attempts=2, since=0) == set()
+    assert store.exhausted_ids(-1, max_attempts=2) == {7}
+
+
+def test_prune_raises_floor(store):
+    for mid in range(1, 7):
+        store.claim(-1, mid)
+    store.prune()
+    assert store.floor_id(-1) == 4
+    assert store.is_processed(-1, 2)
+    assert not store.claim(-1, 1)
+    assert store.is_processed(-1, 6)
+
+
+def test_prune_rolls_back_on_error(db, store):
+    class Failing:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def execute(self, sql, *args):
+            if sql.startswith("UPDATE watermarks"):
+                raise RuntimeError("disk I/O error")
+            return self.conn.execute(sql, *args)
+
+    for mid in range(1, 7):
+        store.claim(-1, mid)
+    store._conn = Failing(db)
+    with pytest.raises(RuntimeError):
+        store.prune()
+    assert not db.in_transaction
+    assert db.execute("SELECT COUNT(*) FROM processed_posts").fetchone()[0] == 6
+
+
+def test_legacy_last_id_column_is_renamed(db):
+    db.execute("CREATE TABLE watermarks (chat_id INTEGER PRIMARY KEY, last_id INTEGER NOT NULL, "
+               "floor_id INTEGER NOT NULL DEFAULT 0)")
+    db.execute("INSERT INTO watermarks VALUES (-1, 50, 0)")
+    store = bot.WatermarkStore(db, keep_per_chat=100)
+    assert store.high_id(-1) == 50
+    store.claim(-1, 60)
+    assert store.high_id(-1) == 60